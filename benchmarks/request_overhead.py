@@ -0,0 +1,90 @@
+# -*- coding: utf8 -*-
+"""
+measures how much time flask-profiler adds to a single request.
+
+the view functions are called directly inside a pushed request context, so
+the numbers contain only the cost of the profiler's wrapper; routing, the
+test client and the storage are left out. run it from the repository root:
+
+    python benchmarks/request_overhead.py
+"""
+import sys
+import timeit
+from os import path
+
+from flask import Flask
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from flask_profiler import flask_profiler  # noqa: E402
+from flask_profiler.storage.base import BaseStorage  # noqa: E402
+
+NUMBER = 20000
+REPEAT = 5
+
+
+class NullStorage(BaseStorage):
+    """discards every measurement"""
+
+    def insert(self, measurement):
+        pass
+
+    def insert_many(self, measurements):
+        pass
+
+    def truncate(self):
+        return True
+
+
+def createApp():
+    app = Flask(__name__)
+    app.config["flask_profiler"] = {
+        "enabled": True,
+        "storage": {"engine": "sqlite", "FILE": ":memory:"},
+        "basicAuth": {"enabled": True, "username": "a", "password": "a"},
+        "ignore": ["^/static/.*", "^/health$", "^/api/internal/.*"]
+    }
+
+    @app.route("/api/people/<firstname>")
+    def sayHello(firstname):
+        return firstname
+
+    @app.route("/static/<path:filename>")
+    def staticFile(filename):
+        return filename
+
+    originals = dict(app.view_functions)
+    flask_profiler.init_app(app)
+    flask_profiler.collection = NullStorage()
+    return app, originals
+
+
+def bench(app, view, url, kwargs):
+    with app.test_request_context(url, headers={"User-Agent": "bench"}):
+        # calling request.url_rule requires routing to be done
+        from flask import request
+        request.url_rule, request.view_args = \
+            app.url_map.bind("localhost").match(url, return_rule=True)
+        timer = timeit.Timer(lambda: view(**kwargs))
+        best = min(timer.repeat(repeat=REPEAT, number=NUMBER))
+    return best / NUMBER * 1e6
+
+
+def main():
+    app, originals = createApp()
+    cases = [
+        ("profiled endpoint", "sayHello", "/api/people/john",
+            {"firstname": "john"}),
+        ("ignored endpoint", "staticFile", "/static/a.png",
+            {"filename": "a.png"}),
+    ]
+    for title, endpoint, url, kwargs in cases:
+        plain = bench(app, originals[endpoint], url, kwargs)
+        wrapped = bench(app, app.view_functions[endpoint], url, kwargs)
+        print("{0:<20} plain {1:7.2f} us  wrapped {2:7.2f} us  "
+              "overhead {3:7.2f} us".format(
+                  title, plain, wrapped, wrapped - plain))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,3 +4,5 @@ from .flask_profiler import (
     profile,
     init_app,
     Profiler)
+from .queries import instrumentSqlalchemy, traceSqlite
+from .spans import span
@@ -0,0 +1,86 @@
+# -*- coding: utf8 -*-
+import random
+import threading
+import tracemalloc
+
+# allocations of tracemalloc itself are not reported
+FILTERS = (tracemalloc.Filter(False, tracemalloc.__file__), )
+
+
+class AllocationTracker(object):
+    """
+    traces the memory allocations of a fraction of the measured calls with
+    tracemalloc. it records the peak and the net number of bytes allocated
+    during the call, and the source lines which allocated the most. it is
+    configured through the "allocations" key of flask-profiler's config:
+
+        "allocations": {
+            "enabled": True,
+            "fraction": 0.01,  # probability of tracing a request
+            "top": 10,  # number of allocation sites kept
+            "frames": 1  # frames of the traceback kept by tracemalloc
+        }
+
+    tracing slows down every allocation of the process, so it is only
+    turned on for the sampled calls, and only one call is traced at a time.
+    allocations of other threads meanwhile are counted as well.
+    """
+
+    def __init__(self, conf=None):
+        super(AllocationTracker, self).__init__()
+        conf = conf or {}
+        self.fraction = float(conf.get("fraction", 0.01))
+        self.top = int(conf.get("top", 10))
+        self.frames = int(conf.get("frames", 1))
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        :return: the state of the trace if the call is going to be traced,
+            otherwise None
+        """
+        if random.random() >= self.fraction:
+            return None
+        if not self._lock.acquire(False):
+            return None
+        # tracing which was started by someone else is left running
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(self.frames)
+        snapshot = tracemalloc.take_snapshot() if self.top else None
+        tracemalloc.reset_peak()
+        return started, snapshot, tracemalloc.get_traced_memory()[0]
+
+    def finish(self, state):
+        """
+        :return: (peak bytes, net bytes, top allocation sites) of the call
+        """
+        started, before, size = state
+        try:
+            current, peak = tracemalloc.get_traced_memory()
+            sites = None
+            if before is not None:
+                sites = self.topSites(
+                    tracemalloc.take_snapshot().filter_traces(FILTERS),
+                    before.filter_traces(FILTERS))
+            if started:
+                tracemalloc.stop()
+        finally:
+            self._lock.release()
+        return peak - size, current - size, sites
+
+    def topSites(self, after, before):
+        sites = []
+        for stat in after.compare_to(before, "lineno"):
+            if stat.size_diff <= 0:
+                continue
+            frame = stat.traceback[0]
+            sites.append({
+                "file": frame.filename,
+                "line": frame.lineno,
+                "bytes": stat.size_diff,
+                "count": stat.count_diff
+            })
+            if len(sites) >= self.top:
+                break
+        return sites
@@ -0,0 +1,90 @@
+# -*- coding: utf8 -*-
+
+CONTEXT_FIELDS = ("url", "args", "form", "body", "headers", "func", "ip")
+
+TEXT_MIMETYPES = (
+    "application/json",
+    "application/xml",
+    "application/javascript",
+    "application/x-www-form-urlencoded",
+    "application/graphql"
+)
+
+
+def isTextMimetype(mimetype):
+    if not mimetype:
+        return True
+    return mimetype.startswith("text/") or mimetype in TEXT_MIMETYPES or \
+        mimetype.endswith("+json") or mimetype.endswith("+xml")
+
+
+class ContextCapture(object):
+    """
+    collects the request context which is stored along with a measurement.
+    it is configured once through the "context" key of flask-profiler's
+    config and called only for the requests that are going to be stored:
+
+        "context": {
+            "include": ["url", "args", "form", "body", "headers", "func", "ip"],
+            "headers": ["User-Agent", "Content-Type"],  # None keeps all
+            "maxBodySize": 16384,  # longer bodies are truncated
+            "skipBinaryBody": True  # multipart and binary bodies are skipped
+        }
+    """
+    DEFAULT_MAX_BODY_SIZE = 16384
+
+    def __init__(self, conf=None):
+        super(ContextCapture, self).__init__()
+        conf = conf or {}
+        include = conf.get("include", CONTEXT_FIELDS)
+        unknown = set(include) - set(CONTEXT_FIELDS)
+        if unknown:
+            raise Exception(
+                "unknown context fields for flask-profiler: {0}".format(
+                    ", ".join(sorted(unknown))))
+        self.include = tuple(f for f in CONTEXT_FIELDS if f in include)
+
+        headers = conf.get("headers", None)
+        self.headers = None if headers is None else \
+            frozenset(h.lower() for h in headers)
+        self.maxBodySize = conf.get("maxBodySize", self.DEFAULT_MAX_BODY_SIZE)
+        self.skipBinaryBody = conf.get("skipBinaryBody", True)
+
+    def __call__(self, request):
+        context = {}
+        for field in self.include:
+            context[field] = getattr(self, "_" + field)(request)
+        return context
+
+    def _url(self, request):
+        return request.base_url
+
+    def _args(self, request):
+        return dict(request.args.items())
+
+    def _form(self, request):
+        return dict(request.form.items())
+
+    def _headers(self, request):
+        if self.headers is None:
+            return dict(request.headers.items())
+        return dict(
+            (k, v) for k, v in request.headers.items()
+            if k.lower() in self.headers)
+
+    def _func(self, request):
+        return request.endpoint
+
+    def _ip(self, request):
+        return request.remote_addr
+
+    def _body(self, request):
+        if self.skipBinaryBody and not isTextMimetype(request.mimetype):
+            return "<{0} body of {1} bytes is not captured>".format(
+                request.mimetype, request.content_length or 0)
+
+        data = request.get_data(cache=True)
+        if self.maxBodySize is not None and len(data) > self.maxBodySize:
+            return data[:self.maxBodySize].decode("utf-8", "replace") + \
+                "<truncated, {0} bytes in total>".format(len(data))
+        return data.decode("utf-8", "replace")
@@ -0,0 +1,238 @@
+# -*- coding: utf8 -*-
+"""
+ships measurements of pre-fork workers to a single collector process, which
+is the only one writing to the storage.
+
+    flask --app app profiler collect
+    flask-profiler-collector --address /tmp/flask-profiler.sock \\
+        --storage '{"engine": "sqlite", "FILE": "flask_profiler.sql"}'
+"""
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import zlib
+
+from .export import _default
+from .writer import WriteBehindQueue
+
+logger = logging.getLogger("flask-profiler")
+
+DEFAULT_ADDRESS = "/tmp/flask-profiler.sock"
+# records bigger than this are compressed before they are sent
+COMPRESS_ABOVE = 1024
+# a datagram can not be bigger than this over udp
+MAX_DATAGRAM = 65507
+# compressed records start with this byte, json ones with "{"
+COMPRESSED = b"z"
+
+
+def parseAddress(address):
+    """
+    :param address: path of a unix domain socket, or "udp://host:port"
+    :return: (socket family, address to bind or send to)
+    """
+    if address.startswith("udp://"):
+        host, _, port = address[len("udp://"):].rpartition(":")
+        if not host or not port.isdigit():
+            raise ValueError(
+                "collector address must look like udp://host:port, "
+                "not {0}".format(address))
+        return socket.AF_INET, (host.strip("[]"), int(port))
+    if address.startswith("unix://"):
+        address = address[len("unix://"):]
+    return socket.AF_UNIX, address
+
+
+def encode(measurement):
+    """:return: the measurement as a compact datagram"""
+    data = json.dumps(
+        measurement, separators=(",", ":"), default=_default).encode("utf8")
+    if len(data) > COMPRESS_ABOVE:
+        data = COMPRESSED + zlib.compress(data, 1)
+    return data
+
+
+def decode(data):
+    if data[:1] == COMPRESSED:
+        data = zlib.decompress(data[1:])
+    return json.loads(data.decode("utf8"))
+
+
+class CollectorClient(object):
+    """
+    sends measurements to the collector with a non-blocking sendto. when the
+    collector is not running or can not keep up, measurements are dropped
+    and counted instead of blocking the request.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS):
+        super(CollectorClient, self).__init__()
+        self.address = address
+        self.family, self._target = parseAddress(address)
+        self.sent = 0
+        self.dropped = 0
+        self._socket = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def send(self, measurement):
+        """:return: False if the measurement is dropped"""
+        data = encode(measurement)
+        try:
+            if len(data) > MAX_DATAGRAM:
+                raise ValueError("the measurement does not fit a datagram")
+            self._connection().sendto(data, self._target)
+        except (OSError, ValueError):
+            with self._lock:
+                self.dropped += 1
+            return False
+        with self._lock:
+            self.sent += 1
+        return True
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def stats(self):
+        return {
+            "address": self.address,
+            "sent": self.sent,
+            "dropped": self.dropped
+        }
+
+    def _connection(self):
+        # workers forked from a master which has already sent get a socket
+        # of their own
+        if self._socket is None or self._pid != os.getpid():
+            with self._lock:
+                if self._socket is None or self._pid != os.getpid():
+                    s = socket.socket(self.family, socket.SOCK_DGRAM)
+                    s.setblocking(False)
+                    self._socket, self._pid = s, os.getpid()
+        return self._socket
+
+
+class Collector(object):
+    """
+    receives the measurements sent by CollectorClient and writes them to the
+    storage in batches through a write-behind queue.
+    """
+
+    def __init__(self, collection, address=DEFAULT_ADDRESS, queueSize=10000,
+                 flushInterval=1.0, maxBatch=500, receiveBuffer=4 * 1024 ** 2):
+        super(Collector, self).__init__()
+        self.address = address
+        self.family, self._bound = parseAddress(address)
+        self.received = 0
+        self.invalid = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+        if self.family == socket.AF_UNIX and os.path.exists(self._bound):
+            # left behind by a collector which did not exit cleanly
+            os.unlink(self._bound)
+        self._socket = socket.socket(self.family, socket.SOCK_DGRAM)
+        try:
+            # absorbs bursts while a batch is being written
+            self._socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, receiveBuffer)
+        except OSError:
+            pass
+        self._socket.bind(self._bound)
+        self._socket.settimeout(0.5)
+        self.writer = WriteBehindQueue(
+            collection, queueSize=queueSize, flushInterval=flushInterval,
+            maxBatch=maxBatch)
+
+    def serve(self):
+        """receives measurements until close() is called"""
+        while not self._stopped.is_set():
+            try:
+                data = self._socket.recv(MAX_DATAGRAM + 1)
+            except socket.timeout:
+                continue
+            except OSError:
+                if self._stopped.is_set():
+                    break
+                raise
+            try:
+                measurement = decode(data)
+            except (ValueError, zlib.error):
+                self.invalid += 1
+                continue
+            self.received += 1
+            self.writer.put(measurement)
+
+    def start(self):
+        """serves in a background thread"""
+        self._thread = threading.Thread(
+            target=self.serve, name="flask-profiler-collector")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def close(self):
+        """stops receiving and writes what is left to the storage"""
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(5)
+        self._socket.close()
+        if self.family == socket.AF_UNIX and os.path.exists(self._bound):
+            os.unlink(self._bound)
+        self.writer.close()
+
+    def stats(self):
+        return dict(
+            self.writer.stats(), address=self.address,
+            received=self.received, invalid=self.invalid)
+
+
+def run(collector, log=None):
+    """serves in the foreground until SIGINT or SIGTERM"""
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        collector.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        collector.close()
+        if log is not None:
+            log("collector stopped: {received} received, {written} written, "
+                "{dropped} dropped, {invalid} invalid".format(
+                    **collector.stats()))
+
+
+def main(argv=None):
+    from . import storage
+
+    parser = argparse.ArgumentParser(
+        prog="flask-profiler-collector",
+        description="writes the measurements sent by flask-profiler workers "
+                    "to the storage")
+    parser.add_argument("--address", default=DEFAULT_ADDRESS,
+                        help="unix socket path or udp://host:port")
+    parser.add_argument("--storage", default='{"engine": "sqlite"}',
+                        help="storage config as json")
+    parser.add_argument("--flush-interval", type=float, default=1.0)
+    parser.add_argument("--max-batch", type=int, default=500)
+    args = parser.parse_args(argv)
+
+    collection = storage.getCollection(json.loads(args.storage))
+    collector = Collector(
+        collection, args.address, flushInterval=args.flush_interval,
+        maxBatch=args.max_batch)
+    logging.basicConfig(level=logging.INFO)
+    logger.info("collecting measurements on {0}".format(args.address))
+    run(collector, logger.info)
+    collection.close()
@@ -0,0 +1,161 @@
+# -*- coding: utf8 -*-
+import csv
+import gzip
+import io
+import json
+import zlib
+from decimal import Decimal
+
+# the columns of a csv export, the structured ones are written as json
+CSV_COLUMNS = (
+    "id", "method", "name", "startedAt", "endedAt", "elapsed", "cpuTime",
+    "userTime", "sysTime", "queries", "dbTime", "peakBytes", "netBytes",
+    "ttfb", "ttlb", "responseSize", "viewTime", "weight", "args", "kwargs",
+    "context")
+JSON_COLUMNS = ("args", "kwargs", "context")
+# the csv columns which are read back as numbers
+NUMBER_COLUMNS = (
+    "startedAt", "endedAt", "elapsed", "cpuTime", "userTime", "sysTime",
+    "queries", "dbTime", "peakBytes", "netBytes", "ttfb", "ttlb",
+    "responseSize", "viewTime", "weight")
+
+FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv", "csv")
+}
+
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+
+def ndjsonLines(measurements):
+    """yields every measurement as a line of json"""
+    for m in measurements:
+        yield json.dumps(m, default=_default) + "\n"
+
+
+def csvLines(measurements, chunkSize=1000):
+    """yields the header and then the measurements, chunkSize rows at once"""
+    buf = io.StringIO()
+    out = csv.writer(buf)
+    out.writerow(CSV_COLUMNS)
+    count = 0
+    for m in measurements:
+        row = []
+        for column in CSV_COLUMNS:
+            value = m.get(column, None)
+            if column in JSON_COLUMNS:
+                value = json.dumps(value, default=_default)
+            elif isinstance(value, Decimal):
+                value = float(value)
+            row.append(value)
+        out.writerow(row)
+        count += 1
+        if count % chunkSize == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def gzipped(chunks):
+    """compresses the given text chunks as one gzip stream"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def exportMeasurements(collection, criteria, format="ndjson", compress=False,
+                       chunkSize=1000):
+    """
+    streams the measurements which match the criteria of filter(). unlike
+    filter(), it exports the whole database unless startedAt is given.
+    :return: (iterable of chunks, mimetype, file extension)
+    """
+    if format not in FORMATS:
+        raise ValueError("unknown export format: {0}".format(format))
+    mimetype, extension = FORMATS[format]
+    criteria = dict(criteria)
+    criteria.setdefault("startedAt", 0)
+    measurements = collection.iterate(criteria, chunkSize=chunkSize)
+    if format == "csv":
+        chunks = csvLines(measurements, chunkSize)
+    else:
+        chunks = ndjsonLines(measurements)
+    if compress:
+        return gzipped(chunks), "application/gzip", extension + ".gz"
+    return chunks, mimetype, extension
+
+
+def readNdjson(lines):
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+
+def readCsv(lines):
+    for row in csv.DictReader(lines):
+        m = {}
+        for column, value in row.items():
+            if column in JSON_COLUMNS:
+                value = json.loads(value) if value else None
+            elif column in NUMBER_COLUMNS:
+                value = float(value) if value else None
+            m[column] = value
+        yield m
+
+
+def openExport(path):
+    """opens an export as text, gzip compressed ones are detected"""
+    stream = open(path, "rb")
+    if stream.peek(2)[:2] == b"\x1f\x8b":
+        stream = gzip.GzipFile(fileobj=stream)
+    return io.TextIOWrapper(stream, encoding="utf-8", newline="")
+
+
+def formatOf(path):
+    """guesses the format of an export from its file name"""
+    name = path[:-3] if path.endswith(".gz") else path
+    return "csv" if name.endswith(".csv") else "ndjson"
+
+
+def importMeasurements(collection, lines, format="ndjson", batchSize=1000,
+                       progress=None):
+    """
+    reads measurements in an export format and stores them with
+    collection.insert_many, batchSize at once. the ids of the export are not
+    kept, the storage gives new ones.
+    :param lines: iterable of the lines of an export, e.g. a file object
+    :param progress: function(count) called after every batch with the
+        number of measurements imported so far
+    :return: the number of measurements imported
+    """
+    if format not in FORMATS:
+        raise ValueError("unknown export format: {0}".format(format))
+    measurements = readCsv(lines) if format == "csv" else readNdjson(lines)
+    count = 0
+    batch = []
+    for m in measurements:
+        m.pop("id", None)
+        if m.get("args") is not None:
+            m["args"] = tuple(m["args"])
+        batch.append(m)
+        if len(batch) >= batchSize:
+            collection.insert_many(batch)
+            count += len(batch)
+            batch = []
+            if progress is not None:
+                progress(count)
+    if batch:
+        collection.insert_many(batch)
+        count += len(batch)
+        if progress is not None:
+            progress(count)
+    return count
@@ -1,22 +1,55 @@
 # -*- coding: utf8 -*-
 
 import functools
+import inspect
+import os
 import re
+import threading
 import time
 
 from pprint import pprint as pp
 
 import logging
 
+import click
 from flask import Blueprint
+from flask import Response
+from flask import current_app
 from flask import jsonify
 from flask import request
+from flask.cli import AppGroup
 from flask_httpauth import HTTPBasicAuth
 
+from . import queries
+from . import spans
 from . import storage
+from .allocations import AllocationTracker
+from .capture import ContextCapture
+from .collector import Collector, CollectorClient, DEFAULT_ADDRESS, run
+from .export import exportMeasurements, formatOf, importMeasurements
+from .export import openExport
+from .middleware import ENVIRON_KEY, ProfilerMiddleware
+from .profiling import ProfileCapture
+from .queries import QueryTracker
+from .retention import Pruner
+from .sampling import Sampler
+from .writer import WriteBehindQueue
 
 CONF = {}
 collection = None
+writer = None
+# sends the measurements to the collector process, see collector.py
+sender = None
+# the write-behind queue of coroutines, see storeNowait
+asyncWriter = None
+_asyncWriterLock = threading.Lock()
+sampler = None
+# the sampling_function of the config, set by init_app
+samplingFunction = None
+profiling = None
+queryTracker = None
+allocationTracker = None
+pruner = None
 auth = HTTPBasicAuth()
 
 logger = logging.getLogger("flask-profiler")
@@ -38,7 +71,7 @@ def verify_password(username, password):
 
 class Measurement(object):
     """represents an endpoint measurement"""
-    DECIMAL_PLACES = 6
+    DECIMAL_PLACES = 9
 
     def __init__(self, name, args, kwargs, method, context=None):
         super(Measurement, self).__init__()
@@ -50,6 +83,22 @@ class Measurement(object):
         self.startedAt = 0
         self.endedAt = 0
         self.elapsed = 0
+        self.cpuTime = 0
+        self.userTime = 0
+        self.sysTime = 0
+        self.weight = 1
+        self.profile = None
+        self.spans = []
+        self.queries = None
+        self.dbTime = None
+        self.statements = None
+        self.peakBytes = None
+        self.netBytes = None
+        self.allocations = None
+        self.ttfb = None
+        self.ttlb = None
+        self.responseSize = None
+        self.viewTime = None
 
     def __json__(self):
         return {
@@ -60,94 +109,328 @@ class Measurement(object):
             "startedAt": self.startedAt,
             "endedAt": self.endedAt,
             "elapsed": self.elapsed,
-            "context": self.context
+            "cpuTime": self.cpuTime,
+            "userTime": self.userTime,
+            "sysTime": self.sysTime,
+            "weight": self.weight,
+            "context": self.context,
+            "profile": self.profile,
+            "spans": self.spans,
+            "queries": self.queries,
+            "dbTime": self.dbTime,
+            "statements": self.statements,
+            "peakBytes": self.peakBytes,
+            "netBytes": self.netBytes,
+            "allocations": self.allocations,
+            "ttfb": self.ttfb,
+            "ttlb": self.ttlb,
+            "responseSize": self.responseSize,
+            "viewTime": self.viewTime
         }
 
     def __str__(self):
         return str(self.__json__())
 
     def start(self):
-        # we use default_timer to get the best clock available.
-        # see: http://stackoverflow.com/a/25823885/672798
+        # wall clock time is only used to tell when the measurement started.
+        # elapsed time comes from the monotonic, high resolution
+        # perf_counter, which is not affected by system clock updates.
         self.startedAt = time.time()
+        self._times = os.times()
+        self._threadTime = time.thread_time_ns()
+        self._counter = time.perf_counter_ns()
 
     def stop(self):
-        self.endedAt = time.time()
+        counter = time.perf_counter_ns()
+        threadTime = time.thread_time_ns()
+        times = os.times()
+
         self.elapsed = round(
-            self.endedAt - self.startedAt, self.DECIMAL_PLACES)
+            (counter - self._counter) / 1e9, self.DECIMAL_PLACES)
+        self.endedAt = self.startedAt + self.elapsed
+        # cpu time spent by the thread serving this request; the rest of
+        # the elapsed time is spent waiting, e.g. for I/O.
+        self.cpuTime = round(
+            (threadTime - self._threadTime) / 1e9, self.DECIMAL_PLACES)
+        # user and system cpu time of the whole process meanwhile
+        self.userTime = round(times.user - self._times.user, 6)
+        self.sysTime = round(times.system - self._times.system, 6)
+
+
+def compileIgnorePatterns(conf):
+    """
+    joins all the ignore patterns into one regular expression so that an
+    endpoint name can be checked against all of them with a single search.
+    """
+    ignore_patterns = conf.get("ignore", [])
+    if not ignore_patterns:
+        return None
+    return re.compile(
+        "|".join("(?:{0})".format(pattern) for pattern in ignore_patterns))
 
 
 def is_ignored(name, conf):
-    ignore_patterns = conf.get("ignore", [])
-    for pattern in ignore_patterns:
-        if re.search(pattern, name):
-            return True
-    return False
+    pattern = compileIgnorePatterns(conf)
+    return pattern is not None and pattern.search(name) is not None
 
 
-def measure(f, name, method, context=None):
-    logger.debug("{0} is being processed.".format(name))
-    if is_ignored(name, CONF):
-        logger.debug("{0} is ignored.".format(name))
-        return f
+def getSamplingFunction(conf):
+    if 'sampling_function' not in conf:
+        return None
+    if not callable(conf['sampling_function']):
+        raise Exception(
+            "if sampling_function is provided to flask-profiler via config, "
+            "it must be callable, refer to: "
+            "https://github.com/muatik/flask-profiler#sampling")
+    return conf['sampling_function']
 
-    @functools.wraps(f)
-    def wrapper(*args, **kwargs):
-        if 'sampling_function' in CONF and not callable(CONF['sampling_function']):
-            raise Exception(
-                "if sampling_function is provided to flask-profiler via config, "
-                "it must be callable, refer to: "
-                "https://github.com/muatik/flask-profiler#sampling")
 
-        if 'sampling_function' in CONF and not CONF['sampling_function']():
-            return f(*args, **kwargs)
+def store(measurement):
+    """
+    sends the given measurement to the collector process, or hands it over
+    to the write-behind queue if either is enabled, otherwise writes it to
+    the storage directly.
+    """
+    if sender is not None:
+        sender.send(measurement)
+    elif writer is not None:
+        writer.put(measurement)
+    else:
+        collection.insert(measurement)
 
-        measurement = Measurement(name, args, kwargs, method, context)
-        measurement.start()
 
-        try:
-            returnVal = f(*args, **kwargs)
-        except:
-            raise
-        finally:
-            measurement.stop()
-            if CONF.get("verbose", False):
-                pp(measurement.__json__())
-            collection.insert(measurement.__json__())
+def storeNowait(measurement):
+    """
+    hands the given measurement over to a write-behind queue, so that an
+    event loop is never blocked on the storage. a queue is started for the
+    measurements of coroutines if write-behind is not enabled.
+    """
+    global asyncWriter
+    if sender is not None:
+        sender.send(measurement)
+        return
+    if writer is not None:
+        writer.put(measurement)
+        return
+    if asyncWriter is None:
+        with _asyncWriterLock:
+            if asyncWriter is None:
+                asyncWriter = WriteBehindQueue(collection)
+    asyncWriter.put(measurement)
 
-        return returnVal
 
-    return wrapper
+def _startMeasured(measurement):
+    """
+    starts the measurement and the captures enabled for it.
+    :return: the state to be passed to _stopMeasured
+    """
+    profiler = None
+    if profiling is not None:
+        profiler = profiling.start(measurement.name)
+    token = spans.begin()
+    queryToken = queryTracker.begin() if queryTracker is not None else None
+    allocations = None
+    if allocationTracker is not None:
+        allocations = allocationTracker.start()
+    measurement.start()
+    return profiler, token, queryToken, allocations
+
+
+def _stopMeasured(measurement, state, weight, captureContext, deferrable,
+                  nowait=False):
+    """
+    :param deferrable: the measurement of an endpoint is finished along with
+        its response if the middleware is enabled
+    :param nowait: the measurement is handed over without blocking
+    """
+    profiler, token, queryToken, allocations = state
+    measurement.stop()
+    if allocations is not None:
+        measurement.peakBytes, measurement.netBytes, \
+            measurement.allocations = allocationTracker.finish(allocations)
+    measurement.spans = spans.end(token)
+    if queryToken is not None:
+        measurement.queries, measurement.dbTime, measurement.statements = \
+            queryTracker.end(queryToken)
+    if profiler is not None:
+        measurement.profile = profiling.finish(profiler, measurement.elapsed)
+    if not deferrable or not _defer(measurement, weight, captureContext):
+        _finish(measurement, weight, captureContext, nowait)
+
+
+def _callMeasured(f, measurement, args, kwargs, weight=1,
+                  captureContext=None, deferrable=False):
+    state = _startMeasured(measurement)
+    try:
+        return f(*args, **kwargs)
+    finally:
+        _stopMeasured(measurement, state, weight, captureContext, deferrable)
 
 
-def wrapHttpEndpoint(f):
+async def _awaitMeasured(f, measurement, args, kwargs, weight=1,
+                         captureContext=None, deferrable=False):
+    state = _startMeasured(measurement)
+    try:
+        return await f(*args, **kwargs)
+    finally:
+        _stopMeasured(
+            measurement, state, weight, captureContext, deferrable,
+            nowait=True)
+
+
+def _defer(measurement, weight, captureContext):
+    """
+    hands the measurement over to the middleware, which finishes it when
+    the response is closed.
+    :return: False if the middleware does not measure the request
+    """
+    timer = request.environ.get(ENVIRON_KEY)
+    if timer is None:
+        return False
+    if measurement.context is None and captureContext is not None:
+        # the request is gone by the time the response is closed
+        measurement.context = captureContext(request)
+    return timer.defer(measurement, weight)
+
+
+def _finish(measurement, weight, captureContext=None, nowait=False):
+    """decides whether the measurement is kept and stores it"""
+    if sampler is not None:
+        measurement.weight = sampler.keep(
+            measurement.name, measurement.method, measurement.elapsed,
+            weight)
+    if measurement.weight:
+        if measurement.context is None and captureContext is not None:
+            # kept by tail sampling, the context was not captured before
+            measurement.context = captureContext(request)
+        if CONF.get("verbose", False):
+            pp(measurement.__json__())
+        # a nested measured call is stored while the enclosing one counts
+        # its queries
+        with queries.paused():
+            if nowait:
+                storeNowait(measurement.__json__())
+            else:
+                store(measurement.__json__())
+
+
+def _sample(name, method):
+    """
+    :return: the weight of the request if it is sampled, 0 if it is not, or
+        None if it must not be measured at all
+    """
+    if sampler is None:
+        return 1
+    weight = sampler.sample(name, method)
+    if not weight and not sampler.tail:
+        return None
+    return weight
+
+
+def _wrap(f, prepare, captureContext=None, deferrable=False):
+    """
+    wraps f so that its calls are measured. coroutine functions are detected
+    here once and wrapped by a coroutine function which awaits them within
+    the measurement.
+    :param prepare: called with the args and kwargs of a call, returns the
+        measurement of the call and its weight, or None if the call must
+        not be measured
+    """
+    if inspect.iscoroutinefunction(f):
+        @functools.wraps(f)
+        async def asyncWrapper(*args, **kwargs):
+            prepared = prepare(args, kwargs)
+            if prepared is None:
+                return await f(*args, **kwargs)
+            measurement, weight = prepared
+            return await _awaitMeasured(
+                f, measurement, args, kwargs, weight, captureContext,
+                deferrable)
+
+        return asyncWrapper
+
     @functools.wraps(f)
     def wrapper(*args, **kwargs):
-        context = {
-            "url": request.base_url,
-            "args": dict(request.args.items()),
-            "form": dict(request.form.items()),
-            "body": request.data.decode("utf-8", "strict"),
-            "headers": dict(request.headers.items()),
-            "func": request.endpoint,
-            "ip": request.remote_addr
-        }
-        endpoint_name = str(request.url_rule)
-        wrapped = measure(f, endpoint_name, request.method, context)
-        return wrapped(*args, **kwargs)
+        prepared = prepare(args, kwargs)
+        if prepared is None:
+            return f(*args, **kwargs)
+        measurement, weight = prepared
+        return _callMeasured(
+            f, measurement, args, kwargs, weight, captureContext, deferrable)
 
     return wrapper
 
 
+def measure(f, name, method, context=None):
+    logger.debug("{0} is being processed.".format(name))
+    if is_ignored(name, CONF):
+        logger.debug("{0} is ignored.".format(name))
+        return f
+
+    def prepare(args, kwargs):
+        if samplingFunction is not None and not samplingFunction():
+            return None
+        weight = _sample(name, method)
+        if weight is None:
+            return None
+        return Measurement(name, args, kwargs, method, context), weight
+
+    return _wrap(f, prepare)
+
+
+def wrapHttpEndpoint(f):
+    """
+    wraps the given view function. everything that does not depend on the
+    request itself is decided here once, so that a request only pays for
+    the sampling decision and the timer, plus the context if it is sampled.
+    """
+    ignorePattern = compileIgnorePatterns(CONF)
+    captureContext = ContextCapture(CONF.get("context"))
+    # route template -> whether it is ignored. an endpoint may be bound to
+    # more than one route, so this is filled in on the first request.
+    ignoredRules = {}
+
+    def prepare(args, kwargs):
+        endpoint_name = request.url_rule.rule
+        ignored = ignoredRules.get(endpoint_name)
+        if ignored is None:
+            ignored = ignorePattern is not None and \
+                ignorePattern.search(endpoint_name) is not None
+            ignoredRules[endpoint_name] = ignored
+        if ignored:
+            return None
+
+        if samplingFunction is not None and not samplingFunction():
+            return None
+        weight = _sample(endpoint_name, request.method)
+        if weight is None:
+            return None
+
+        measurement = Measurement(
+            endpoint_name, args, kwargs, request.method,
+            captureContext(request) if weight > 0 else None)
+        return measurement, weight
+
+    return _wrap(f, prepare, captureContext, deferrable=True)
+
+
 def wrapAppEndpoints(app):
     """
     wraps all endpoints defined in the given flask app to measure how long time
     each endpoints takes while being executed. This wrapping process is
-    supposed not to change endpoint behaviour.
+    supposed not to change endpoint behaviour. Endpoints whose routes are all
+    ignored are left unwrapped.
     :param app: Flask application instance
     :return:
     """
     for endpoint, func in app.view_functions.items():
+        try:
+            rules = [rule.rule for rule in app.url_map.iter_rules(endpoint)]
+        except KeyError:
+            rules = []
+        if rules and all(is_ignored(rule, CONF) for rule in rules):
+            logger.debug("{0} is ignored.".format(endpoint))
+            continue
         app.view_functions[endpoint] = wrapHttpEndpoint(func)
 
 
@@ -190,26 +473,64 @@ def registerInternalRouters(app):
     @auth.login_required
     def filterMeasurements():
         args = dict(request.args.items())
-        measurements = collection.filter(args)
-        return jsonify({"measurements": list(measurements)})
+        try:
+            measurements, cursor = collection.paginate(args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"measurements": measurements, "next": cursor})
 
     @fp.route("/api/measurements/grouped".format(urlPath))
     @auth.login_required
     def getMeasurementsSummary():
         args = dict(request.args.items())
-        measurements = collection.getSummary(args)
+        try:
+            measurements = collection.getSummary(args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         return jsonify({"measurements": list(measurements)})
 
+    def getMeasurement(measurementId):
+        """:return: the measurement, None if the id is unknown or malformed"""
+        try:
+            return collection.get(measurementId)
+        except ValueError:
+            return None
+
     @fp.route("/api/measurements/<measurementId>".format(urlPath))
     @auth.login_required
     def getContext(measurementId):
-        return jsonify(collection.get(measurementId))
+        measurement = getMeasurement(measurementId)
+        if measurement is None:
+            return jsonify({"error": "no such measurement"}), 404
+        return jsonify(measurement)
+
+    @fp.route("/api/measurements/<measurementId>/waterfall".format(urlPath))
+    @auth.login_required
+    def getWaterfall(measurementId):
+        measurement = getMeasurement(measurementId)
+        if measurement is None:
+            return jsonify({"error": "no such measurement"}), 404
+        return jsonify({
+            "elapsed": measurement["elapsed"],
+            "spans": spans.waterfallOf(measurement)})
+
+    @fp.route("/api/measurements/<measurementId>/profile".format(urlPath))
+    @auth.login_required
+    def getProfile(measurementId):
+        measurement = getMeasurement(measurementId)
+        if measurement is None or not measurement.get("profile"):
+            return jsonify({"error": "no profile was captured"}), 404
+        return jsonify({"profile": measurement["profile"]})
 
     @fp.route("/api/measurements/timeseries/".format(urlPath))
     @auth.login_required
     def getRequestsTimeseries():
         args = dict(request.args.items())
-        return jsonify({"series": collection.getTimeseries(args)})
+        try:
+            series = collection.getTimeseries(args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"series": series})
 
     @fp.route("/api/measurements/methodDistribution/".format(urlPath))
     @auth.login_required
@@ -218,6 +539,20 @@ def registerInternalRouters(app):
         return jsonify({
             "distribution": collection.getMethodDistribution(args)})
 
+    @fp.route("/api/writer/stats".format(urlPath))
+    @auth.login_required
+    def getWriterStats():
+        return jsonify({
+            "enabled": writer is not None,
+            "stats": writer.stats() if writer is not None else None})
+
+    @fp.route("/api/collector/stats".format(urlPath))
+    @auth.login_required
+    def getCollectorStats():
+        return jsonify({
+            "enabled": sender is not None,
+            "stats": sender.stats() if sender is not None else None})
+
     @fp.route("/db/dumpDatabase")
     @auth.login_required
     def dumpDatabase():
@@ -226,6 +561,22 @@ def registerInternalRouters(app):
         response.headers["Content-Disposition"] = "attachment; filename=dump.json"
         return response
 
+    @fp.route("/db/export")
+    @auth.login_required
+    def exportDatabase():
+        args = dict(request.args.items())
+        format = args.pop("format", "ndjson")
+        gzip = args.pop("gzip", "") in ("1", "true")
+        try:
+            chunks, mimetype, extension = exportMeasurements(
+                collection, args, format, gzip)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        response = Response(chunks, mimetype=mimetype)
+        response.headers["Content-Disposition"] = \
+            "attachment; filename=measurements.{0}".format(extension)
+        return response
+
     @fp.route("/db/deleteDatabase")
     @auth.login_required
     def deleteDatabase():
@@ -241,8 +592,65 @@ def registerInternalRouters(app):
     app.register_blueprint(fp)
 
 
+profilerCommands = AppGroup("profiler", help="flask-profiler commands")
+
+
+@profilerCommands.command("import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", type=click.Choice(["ndjson", "csv"]), default=None,
+              help="format of the export, guessed from the file name")
+@click.option("--batch-size", default=1000, show_default=True,
+              help="number of measurements inserted at once")
+def importCommand(path, format, batch_size):
+    """imports an export of /db/export into the configured storage"""
+    conf = current_app.config.get(
+        "flask_profiler", current_app.config.get("FLASK_PROFILER", {}))
+    target = collection if collection is not None else \
+        storage.getCollection(conf.get("storage", {}))
+    startedAt = time.time()
+    reportedAt = [startedAt]
+
+    def progress(count):
+        now = time.time()
+        if now - reportedAt[0] < 1:
+            return
+        reportedAt[0] = now
+        click.echo("{0} measurements imported, {1:.0f}/s".format(
+            count, count / (now - startedAt)), err=True)
+
+    with openExport(path) as lines:
+        count = importMeasurements(
+            target, lines, format or formatOf(path), batch_size, progress)
+    if target is not collection:
+        target.close()
+    click.echo("imported {0} measurements".format(count))
+
+
+@profilerCommands.command("collect")
+@click.option("--address", default=None,
+              help="unix socket path or udp://host:port, taken from the "
+                   "collector config by default")
+def collectCommand(address):
+    """writes the measurements sent by the workers to the storage"""
+    conf = current_app.config.get(
+        "flask_profiler", current_app.config.get("FLASK_PROFILER", {}))
+    collectorConf = conf.get("collector", {})
+    writeBehind = conf.get("writeBehind", {})
+    address = address or collectorConf.get("address", DEFAULT_ADDRESS)
+    target = storage.getCollection(conf.get("storage", {}))
+    collector = Collector(
+        target, address,
+        queueSize=writeBehind.get("queueSize", 10000),
+        flushInterval=writeBehind.get("flushInterval", 1.0),
+        maxBatch=writeBehind.get("maxBatch", 500))
+    click.echo("collecting measurements on {0}".format(address), err=True)
+    run(collector, lambda message: click.echo(message, err=True))
+    target.close()
+
+
 def init_app(app):
-    global collection, CONF
+    global collection, CONF, writer, asyncWriter, sender, sampler, \
+        samplingFunction, profiling, queryTracker, allocationTracker, pruner
 
     try:
         CONF = app.config["flask_profiler"]
@@ -258,10 +666,65 @@ def init_app(app):
     if not CONF.get("enabled", False):
         return
 
+    # fail at startup rather than on the first request; functions measured
+    # before init_app pick it up as well
+    samplingFunction = getSamplingFunction(CONF)
+    ContextCapture(CONF.get("context"))
+    sampler = Sampler(CONF["sampling"]) if "sampling" in CONF else None
+    profiling = None
+    if CONF.get("profiling", {}).get("enabled", False):
+        profiling = ProfileCapture(CONF["profiling"])
+    queryTracker = None
+    if CONF.get("queries", {}).get("enabled", False):
+        queryTracker = QueryTracker(CONF["queries"])
+    allocationTracker = None
+    if CONF.get("allocations", {}).get("enabled", False):
+        allocationTracker = AllocationTracker(CONF["allocations"])
+
+    if pruner is not None:
+        pruner.close()
+        pruner = None
+    if writer is not None:
+        writer.close()
+        writer = None
+    if sender is not None:
+        sender.close()
+        sender = None
+    if asyncWriter is not None:
+        asyncWriter.close()
+        asyncWriter = None
+    if collection is not None:
+        collection.close()
     collection = storage.getCollection(CONF.get("storage", {}))
 
+    collectorConf = CONF.get("collector", {})
+    writeBehind = CONF.get("writeBehind", {})
+    if collectorConf.get("enabled", False):
+        sender = CollectorClient(
+            collectorConf.get("address", DEFAULT_ADDRESS))
+    elif writeBehind.get("enabled", False):
+        writer = WriteBehindQueue(
+            collection,
+            queueSize=writeBehind.get("queueSize", 10000),
+            flushInterval=writeBehind.get("flushInterval", 1.0),
+            maxBatch=writeBehind.get("maxBatch", 500))
+
+    retention = CONF.get("retention", {})
+    if retention.get("enabled", False):
+        pruner = Pruner(
+            collection,
+            maxAge=retention.get("maxAge", None),
+            maxRowsPerEndpoint=retention.get("maxRowsPerEndpoint", None),
+            interval=retention.get("interval", 60.0),
+            batchSize=retention.get("batchSize", 1000))
+
+    if CONF.get("middleware", {}).get("enabled", False) and \
+            not isinstance(app.wsgi_app, ProfilerMiddleware):
+        app.wsgi_app = ProfilerMiddleware(app.wsgi_app, _finish)
+
     wrapAppEndpoints(app)
     registerInternalRouters(app)
+    app.cli.add_command(profilerCommands)
 
     basicAuth = CONF.get("basicAuth", None)
     if not basicAuth or not basicAuth["enabled"]:
@@ -277,5 +740,6 @@ class Profiler(object):
             self.init_app(app)
 
     def init_app(self, app):
+        app.cli.add_command(profilerCommands)
         init = functools.partial(self._init_app, app)
         app.before_first_request(init)
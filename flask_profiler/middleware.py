@@ -0,0 +1,112 @@
+# -*- coding: utf8 -*-
+import time
+
+# the key of the ResponseTimer of a request in its WSGI environ
+ENVIRON_KEY = "flask_profiler.timer"
+
+
+class ResponseTimer(object):
+    """
+    times the response of one request, from the moment the middleware is
+    called until the server closes the response body. the measurement of
+    the view is deferred to it and finished along with the response.
+    """
+
+    def __init__(self, finish):
+        super(ResponseTimer, self).__init__()
+        self.finish = finish
+        self.startedAt = time.time()
+        self._counter = time.perf_counter_ns()
+        self.headersAt = None
+        self.firstByteAt = None
+        self.size = 0
+        self.measurement = None
+        self.args = ()
+        self.closed = False
+
+    def defer(self, measurement, *args):
+        """
+        keeps the measurement of the view until the response is closed.
+        :return: False if a measurement was deferred already
+        """
+        if self.measurement is not None or self.closed:
+            return False
+        self.measurement = measurement
+        self.args = args
+        return True
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.measurement is None:
+            return
+        counter = time.perf_counter_ns()
+        m = self.measurement
+        m.viewTime = m.elapsed
+        m.ttlb = round((counter - self._counter) / 1e9, m.DECIMAL_PLACES)
+        firstByteAt = self.firstByteAt or self.headersAt or counter
+        m.ttfb = round((firstByteAt - self._counter) / 1e9, m.DECIMAL_PLACES)
+        m.responseSize = self.size
+        m.startedAt = self.startedAt
+        m.elapsed = m.ttlb
+        m.endedAt = m.startedAt + m.elapsed
+        self.finish(m, *self.args)
+
+
+class TimedBody(object):
+    """the response body, counts its bytes and closes the timer"""
+
+    def __init__(self, iterable, timer):
+        super(TimedBody, self).__init__()
+        self.iterable = iterable
+        self.timer = timer
+
+    def __iter__(self):
+        timer = self.timer
+        for chunk in self.iterable:
+            if chunk:
+                if timer.firstByteAt is None:
+                    timer.firstByteAt = time.perf_counter_ns()
+                timer.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            close = getattr(self.iterable, "close", None)
+            if close is not None:
+                close()
+        finally:
+            self.timer.close()
+
+
+class ProfilerMiddleware(object):
+    """
+    measures the whole lifecycle of the responses of a WSGI application:
+    the time to the first byte and to the last byte of the body, and its
+    size, besides the time spent in the view. streamed bodies, large files
+    and slow after_request hooks are included in the elapsed time, which
+    ends when the server closes the response.
+
+    :param finish: called with a deferred measurement and its arguments
+        once its response is closed
+    """
+
+    def __init__(self, app, finish):
+        super(ProfilerMiddleware, self).__init__()
+        self.app = app
+        self.finish = finish
+
+    def __call__(self, environ, start_response):
+        timer = environ[ENVIRON_KEY] = ResponseTimer(self.finish)
+
+        def startResponse(status, headers, exc_info=None):
+            timer.headersAt = time.perf_counter_ns()
+            return start_response(status, headers, exc_info)
+
+        try:
+            iterable = self.app(environ, startResponse)
+        except BaseException:
+            timer.close()
+            raise
+        return TimedBody(iterable, timer)
@@ -0,0 +1,94 @@
+# -*- coding: utf8 -*-
+import cProfile
+import random
+import re
+import threading
+
+SORT_KEYS = {
+    "cumulative": "cumulativeTime",
+    "tottime": "totalTime",
+    "calls": "calls"
+}
+
+
+class ProfileCapture(object):
+    """
+    runs cProfile on some of the measured calls and keeps the functions
+    which took the most time in the slow ones. it is configured through the
+    "profiling" key of flask-profiler's config:
+
+        "profiling": {
+            "enabled": True,
+            "fraction": 0.01,  # probability of profiling a request
+            "endpoints": ["^/api/orders/"],  # always profile these
+            "threshold": 0.5,  # keep profiles of requests slower than this
+            "top": 30,  # number of functions kept
+            "sort": "cumulative"  # or "tottime" or "calls"
+        }
+
+    only one call is profiled at a time, the others are measured as usual,
+    so the overhead stays bounded under concurrency.
+    """
+
+    def __init__(self, conf=None):
+        super(ProfileCapture, self).__init__()
+        conf = conf or {}
+        self.fraction = float(conf.get("fraction", 0.01))
+        self.endpoints = [
+            re.compile(pattern) for pattern in conf.get("endpoints", [])]
+        self.threshold = float(conf.get("threshold", 0.5))
+        self.top = int(conf.get("top", 30))
+        sort = conf.get("sort", "cumulative")
+        if sort not in SORT_KEYS:
+            raise ValueError(
+                "unknown profiling sort for flask-profiler: {0}".format(sort))
+        self.sortKey = SORT_KEYS[sort]
+        self._lock = threading.Lock()
+
+    def start(self, name):
+        """
+        :return: a running profiler if the call of the endpoint is going to
+            be profiled, otherwise None
+        """
+        if random.random() >= self.fraction and \
+                not any(p.search(name) for p in self.endpoints):
+            return None
+        if not self._lock.acquire(False):
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is already active
+            self._lock.release()
+            return None
+        return profiler
+
+    def finish(self, profiler, elapsed):
+        """
+        stops the profiler.
+        :return: the top functions if the call took at least threshold
+            seconds, otherwise None
+        """
+        profiler.disable()
+        self._lock.release()
+        if elapsed < self.threshold:
+            return None
+        return self.topFunctions(profiler)
+
+    def topFunctions(self, profiler):
+        profiler.create_stats()
+        functions = []
+        for (path, line, function), stats in profiler.stats.items():
+            primitiveCalls, calls, totalTime, cumulativeTime, callers = stats
+            functions.append({
+                "function": function,
+                "file": path,
+                "line": line,
+                "calls": calls,
+                "primitiveCalls": primitiveCalls,
+                "totalTime": round(totalTime, 6),
+                "cumulativeTime": round(cumulativeTime, 6)
+            })
+        functions.sort(key=lambda f: f[self.sortKey], reverse=True)
+        return functions[:self.top]
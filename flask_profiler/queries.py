@@ -0,0 +1,169 @@
+# -*- coding: utf8 -*-
+import contextvars
+import re
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+# the statistics of the measured call which is running in the current
+# context, if any
+_active = contextvars.ContextVar("flask_profiler_queries", default=None)
+
+STRINGS = re.compile(r"'(?:[^']|'')*'")
+# placeholders of the paramstyles of DB-API drivers
+PLACEHOLDERS = re.compile(r"(?<![:\w]):\w+|%\(\w+\)s|%s|\$\d+|\?")
+NUMBERS = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+SPACES = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=4096)
+def normalize(statement):
+    """
+    :return: the shape of the statement: literals and parameters are
+        replaced by ?, lists of them by (?...) and whitespace is collapsed,
+        so that the executions of a statement with different parameters
+        have the same shape.
+    """
+    shape = STRINGS.sub("?", statement)
+    shape = PLACEHOLDERS.sub("?", shape)
+    shape = NUMBERS.sub("?", shape)
+    shape = LISTS.sub("(?...)", shape)
+    return SPACES.sub(" ", shape).strip()
+
+
+class QueryStats(object):
+    """the queries executed during one measured call"""
+
+    def __init__(self):
+        super(QueryStats, self).__init__()
+        self.count = 0
+        self.time = 0.0
+        self.timed = False
+        # shape -> [count, time]
+        self.shapes = {}
+
+    def record(self, statement, elapsed=None):
+        shape = self.shapes.setdefault(normalize(statement), [0, 0.0])
+        shape[0] += 1
+        self.count += 1
+        if elapsed is not None:
+            shape[1] += elapsed
+            self.time += elapsed
+            self.timed = True
+
+
+def record(statement, elapsed=None):
+    """
+    adds an executed statement to the measured call running in the current
+    context. it does nothing outside a measured call.
+    """
+    stats = _active.get()
+    if stats is not None:
+        stats.record(statement, elapsed)
+
+
+@contextmanager
+def paused():
+    """
+    does not count the statements executed within the block, e.g. those of
+    flask-profiler's own storage.
+    """
+    token = _active.set(None)
+    try:
+        yield
+    finally:
+        _active.reset(token)
+
+
+def _beforeExecute(conn, cursor, statement, parameters, context, executemany):
+    if _active.get() is not None:
+        conn.info.setdefault("flask_profiler_started", []).append(
+            time.perf_counter())
+
+
+def _afterExecute(conn, cursor, statement, parameters, context, executemany):
+    if _active.get() is None:
+        return
+    started = conn.info.get("flask_profiler_started")
+    if started:
+        record(statement, time.perf_counter() - started.pop())
+
+
+def instrumentSqlalchemy(engine=None):
+    """
+    counts and times the statements executed by the given SQLAlchemy
+    engine, or by every engine if it is not given.
+    """
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    target = Engine if engine is None else engine
+    if not event.contains(target, "before_cursor_execute", _beforeExecute):
+        event.listen(target, "before_cursor_execute", _beforeExecute)
+        event.listen(target, "after_cursor_execute", _afterExecute)
+
+
+def traceSqlite(connection):
+    """
+    counts the statements executed on the given sqlite3 connection. its
+    trace callback does not tell how long a statement took, so they do not
+    add to the database time.
+    """
+    connection.set_trace_callback(record)
+
+
+class QueryTracker(object):
+    """
+    attributes the database queries executed during a measured call to its
+    measurement: their number, the time spent in them and the statements
+    which took the most time, with their parameters stripped. statements
+    executed repeatedly in one call are flagged as likely N+1 queries. it
+    is configured through the "queries" key of flask-profiler's config:
+
+        "queries": {
+            "enabled": True,
+            "sqlalchemy": True,  # instrument every SQLAlchemy engine
+            "top": 10,  # number of statements kept
+            "nPlusOneThreshold": 5  # executions of a statement to flag it
+        }
+
+    sqlite3 connections are instrumented with traceSqlite().
+    """
+
+    def __init__(self, conf=None):
+        super(QueryTracker, self).__init__()
+        conf = conf or {}
+        self.top = int(conf.get("top", 10))
+        self.nPlusOneThreshold = int(conf.get("nPlusOneThreshold", 5))
+        if conf.get("sqlalchemy", True):
+            try:
+                instrumentSqlalchemy()
+            except ImportError:
+                pass
+
+    def begin(self):
+        """
+        starts counting the queries of a measured call in the current context.
+        :return: token to be passed to end()
+        """
+        return _active.set(QueryStats())
+
+    def end(self, token):
+        """
+        stops counting the queries started by begin().
+        :return: (number of queries, database time, top statements), the
+            database time is None if no query was timed
+        """
+        stats = _active.get()
+        _active.reset(token)
+        if not stats.count:
+            return 0, 0.0, None
+        statements = [
+            {"statement": shape, "count": count, "time": round(elapsed, 9),
+             "nPlusOne": count >= self.nPlusOneThreshold}
+            for shape, (count, elapsed) in stats.shapes.items()]
+        statements.sort(key=lambda s: (s["time"], s["count"]), reverse=True)
+        return (
+            stats.count,
+            round(stats.time, 9) if stats.timed else None,
+            statements[:self.top])
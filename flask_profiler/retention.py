@@ -0,0 +1,73 @@
+# -*- coding: utf8 -*-
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger("flask-profiler")
+
+
+class Pruner(object):
+    """
+    enforces a retention policy: a background thread deletes the
+    measurements which ended more than maxAge seconds ago and those beyond
+    the newest maxRowsPerEndpoint of their endpoint. they are deleted in
+    batches of batchSize, each in its own short transaction, so that the
+    writes of profiled requests are not held up.
+    """
+
+    def __init__(self, collection, maxAge=None, maxRowsPerEndpoint=None,
+                 interval=60.0, batchSize=1000):
+        super(Pruner, self).__init__()
+        if maxAge is None and maxRowsPerEndpoint is None:
+            raise ValueError(
+                "retention needs maxAge or maxRowsPerEndpoint")
+        self.collection = collection
+        self.maxAge = maxAge
+        self.maxRowsPerEndpoint = maxRowsPerEndpoint
+        self.interval = interval
+        self.batchSize = batchSize
+        self.pruned = 0
+
+        self._pruneLock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="flask-profiler-pruner")
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def prune(self):
+        """
+        deletes everything the policy does not keep, batch by batch, and then
+        compacts the storage.
+        :return: the number of deleted measurements
+        """
+        pruned = 0
+        with self._pruneLock:
+            while not self._stopped.is_set():
+                count = self.collection.prune(
+                    maxAge=self.maxAge,
+                    maxRowsPerEndpoint=self.maxRowsPerEndpoint,
+                    batchSize=self.batchSize)
+                if not count:
+                    break
+                pruned += count
+            if pruned:
+                self.collection.compact()
+            self.pruned += pruned
+        return pruned
+
+    def close(self, timeout=5):
+        """stops the background thread"""
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.prune()
+            except Exception:
+                logger.exception("flask-profiler could not prune measurements")
+            self._stopped.wait(self.interval)
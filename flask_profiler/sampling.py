@@ -0,0 +1,161 @@
+# -*- coding: utf8 -*-
+import random
+import re
+import threading
+import time
+from collections import deque
+
+
+class EndpointState(object):
+    """sampling state kept for each endpoint"""
+    __slots__ = (
+        "tokens", "updatedAt", "debt", "recent", "observed", "threshold")
+
+    def __init__(self, tokens, recentSize):
+        self.tokens = tokens
+        self.updatedAt = time.monotonic()
+        # total weight of the requests which were sampled but rejected by
+        # the token bucket. it is added to the next stored measurement.
+        self.debt = 0.0
+        self.recent = deque(maxlen=recentSize) if recentSize else None
+        self.observed = 0
+        self.threshold = None
+
+
+class Sampler(object):
+    """
+    decides which measurements are stored. it is configured through the
+    "sampling" key of flask-profiler's config:
+
+        "sampling": {
+            "rate": 0.1,  # probability of storing a request
+            "routes": [  # per route rates, the first matching pattern wins
+                ["^/api/orders/", 0.5],
+                ["^/health$", 0]
+            ],
+            "maxPerSecond": 10,  # token bucket per endpoint
+            "slowerThan": 0.5,  # always store requests slower than this
+            "slowerThanPercentile": 99  # or slower than the endpoint's p99
+        }
+
+    every stored measurement carries a weight, the number of requests it
+    stands for, so that counts and averages can be estimated correctly.
+    rate sampling gives a weight of 1 / rate, requests rejected by the
+    token bucket are added to the weight of the next stored request of the
+    endpoint, and requests kept by tail sampling have a weight of 1 since
+    every slow request is stored.
+    """
+    RECENT_SIZE = 1000
+    PERCENTILE_UPDATE_INTERVAL = 100
+
+    def __init__(self, conf):
+        super(Sampler, self).__init__()
+        self.rate = float(conf.get("rate", 1))
+        routes = conf.get("routes", [])
+        if isinstance(routes, dict):
+            routes = routes.items()
+        self.routes = [
+            (re.compile(pattern), float(rate)) for pattern, rate in routes]
+        self.maxPerSecond = conf.get("maxPerSecond", None)
+        self.slowerThan = conf.get("slowerThan", None)
+        self.slowerThanPercentile = conf.get("slowerThanPercentile", None)
+        self.tail = self.slowerThan is not None or \
+            self.slowerThanPercentile is not None
+
+        for rate in [self.rate] + [rate for _, rate in self.routes]:
+            if not 0 <= rate <= 1:
+                raise Exception(
+                    "flask-profiler sampling rates must be between 0 and 1")
+
+        self._rates = {}
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def rateFor(self, name):
+        rate = self._rates.get(name)
+        if rate is None:
+            rate = self.rate
+            for pattern, routeRate in self.routes:
+                if pattern.search(name):
+                    rate = routeRate
+                    break
+            self._rates[name] = rate
+        return rate
+
+    def sample(self, name, method):
+        """
+        makes the decision before the request is served.
+        :return: the weight of the request if it is sampled, otherwise 0.
+            in tail sampling mode, a request which is sampled but rejected
+            by the token bucket is returned as its negative weight, as it
+            can still be kept if it turns out to be slow.
+        """
+        rate = self.rateFor(name)
+        if rate <= 0 or (rate < 1 and random.random() >= rate):
+            return 0
+        weight = 1.0 / rate
+
+        if self.maxPerSecond is None:
+            return weight
+
+        state = self._state(name, method)
+        with self._lock:
+            now = time.monotonic()
+            capacity = max(1.0, self.maxPerSecond)
+            state.tokens = min(
+                capacity,
+                state.tokens + (now - state.updatedAt) * self.maxPerSecond)
+            state.updatedAt = now
+            if state.tokens >= 1:
+                state.tokens -= 1
+                return weight
+            if self.tail:
+                return -weight
+            state.debt += weight
+            return 0
+
+    def keep(self, name, method, elapsed, weight):
+        """
+        makes the final decision after the request is served.
+        :param weight: the value returned by sample()
+        :return: the weight the measurement is stored with, 0 to drop it
+        """
+        if self.tail and self._isSlow(name, method, elapsed):
+            return 1.0
+
+        if weight < 0:
+            state = self._state(name, method)
+            with self._lock:
+                state.debt -= weight
+            return 0
+        if weight and self.maxPerSecond is not None:
+            state = self._state(name, method)
+            with self._lock:
+                weight += state.debt
+                state.debt = 0.0
+        return weight
+
+    def _isSlow(self, name, method, elapsed):
+        if self.slowerThan is not None and elapsed >= self.slowerThan:
+            return True
+        if self.slowerThanPercentile is None:
+            return False
+
+        state = self._state(name, method)
+        threshold = state.threshold
+        state.recent.append(elapsed)
+        state.observed += 1
+        if state.observed % self.PERCENTILE_UPDATE_INTERVAL == 0:
+            recent = sorted(state.recent)
+            index = int(len(recent) * self.slowerThanPercentile / 100.0)
+            state.threshold = recent[min(index, len(recent) - 1)]
+        return threshold is not None and elapsed >= threshold
+
+    def _state(self, name, method):
+        key = (method, name)
+        state = self._endpoints.get(key)
+        if state is None:
+            state = self._endpoints.setdefault(key, EndpointState(
+                max(1.0, self.maxPerSecond or 1),
+                self.RECENT_SIZE if self.slowerThanPercentile else 0))
+        return state
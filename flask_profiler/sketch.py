@@ -0,0 +1,115 @@
+# -*- coding: utf8 -*-
+import math
+
+DEFAULT_PERCENTILES = (50, 90, 95, 99, 99.9)
+
+
+def percentileKey(percentile):
+    """50 -> "p50", 99.9 -> "p999" """
+    return "p" + ("%g" % percentile).replace(".", "")
+
+
+def parsePercentiles(value):
+    """
+    parses a comma separated list of percentiles such as "50,99,99.9".
+    :return: list of percentiles, the default ones if value is empty
+    """
+    if not value:
+        return list(DEFAULT_PERCENTILES)
+    values = value
+    if not isinstance(value, (list, tuple)):
+        values = [p for p in value.split(",") if p.strip()]
+    try:
+        percentiles = [float(p) for p in values]
+    except (TypeError, ValueError):
+        raise ValueError("invalid percentiles: {0}".format(value))
+    for p in percentiles:
+        if not 0 <= p <= 100:
+            raise ValueError("percentiles must be between 0 and 100")
+    return percentiles
+
+
+class LatencySketch(object):
+    """
+    a mergeable histogram of latencies with logarithmic bins, as in
+    DDSketch. a value v falls into the bin ceil(log(v) / log(gamma)), so
+    any percentile is estimated within RELATIVE_ACCURACY of the real value,
+    whatever the number of values. sketches of different endpoints or time
+    buckets are merged by adding up their bins.
+    """
+    __slots__ = ("bins", "zero")
+
+    RELATIVE_ACCURACY = 0.01
+    GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+    LOG_GAMMA = math.log(GAMMA)
+    # values below this, including 0, are counted in the zero bin
+    MIN_VALUE = 1e-9
+
+    def __init__(self, bins=None, zero=0.0):
+        self.bins = bins if bins is not None else {}
+        self.zero = zero
+
+    @classmethod
+    def index(cls, value):
+        return int(math.ceil(math.log(value) / cls.LOG_GAMMA))
+
+    @classmethod
+    def value(cls, index):
+        """the value which represents the given bin"""
+        return 2 * cls.GAMMA ** index / (cls.GAMMA + 1)
+
+    @property
+    def count(self):
+        return self.zero + sum(self.bins.values())
+
+    def add(self, value, weight=1):
+        if value is None:
+            return
+        value = float(value)
+        if value < self.MIN_VALUE:
+            self.zero += weight
+        else:
+            index = self.index(value)
+            self.bins[index] = self.bins.get(index, 0) + weight
+
+    def merge(self, other):
+        self.zero += other.zero
+        for index, weight in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + weight
+        return self
+
+    def quantile(self, q):
+        """:param q: between 0 and 1"""
+        count = self.count
+        if count <= 0:
+            return None
+        rank = q * count
+        seen = self.zero
+        if seen > 0 and seen >= rank:
+            return 0.0
+        index = None
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen >= rank:
+                break
+        return self.value(index)
+
+    def percentiles(self, percentiles):
+        """:return: dict such as {"p50": 0.1, "p99": 0.3}"""
+        return dict(
+            (percentileKey(p), self.quantile(p / 100.0)) for p in percentiles)
+
+    def __json__(self):
+        # json object keys are strings
+        return {
+            "zero": self.zero,
+            "bins": dict((str(i), w) for i, w in self.bins.items())
+        }
+
+    @classmethod
+    def fromJson(cls, data):
+        if not data:
+            return cls()
+        return cls(
+            dict((int(i), w) for i, w in data.get("bins", {}).items()),
+            data.get("zero", 0.0))
@@ -0,0 +1,129 @@
+# -*- coding: utf8 -*-
+import contextvars
+import functools
+import inspect
+import time
+
+# at most this many spans are recorded for a measured call, the rest are
+# not timed
+MAX_SPANS = 1000
+
+# (trace, order of the enclosing span, depth of the enclosing span) of the
+# measured call which is running in the current context, if any
+_active = contextvars.ContextVar("flask_profiler_span", default=None)
+
+
+class Trace(object):
+    """the spans recorded during one measured call"""
+
+    def __init__(self):
+        super(Trace, self).__init__()
+        self.spans = []
+        self._counter = time.perf_counter_ns()
+
+    def offset(self, counter):
+        """:return: seconds since the measured call started"""
+        return (counter - self._counter) / 1e9
+
+
+def begin():
+    """
+    starts recording the spans of a measured call in the current context.
+    :return: token to be passed to end()
+    """
+    return _active.set((Trace(), None, 0))
+
+
+def end(token):
+    """
+    stops recording the spans started by begin().
+    :return: list of the recorded spans, in the order they were started
+    """
+    trace = _active.get()[0]
+    _active.reset(token)
+    return trace.spans
+
+
+class span(object):
+    """
+    times a part of the measured call it runs in, e.g. an internal call of
+    an endpoint, and stores it as a child of the call's measurement. it is
+    used either as a context manager:
+
+        with flask_profiler.span("load orders"):
+            orders = loadOrders()
+
+    or as a decorator, named after the function unless a name is given:
+
+        @flask_profiler.span()
+        def render(orders):
+            ...
+
+    spans can be nested. outside a measured call they do nothing.
+    """
+
+    def __init__(self, name=None):
+        super(span, self).__init__()
+        self.name = name
+        self._token = None
+
+    def __call__(self, f):
+        name = self.name or f.__qualname__
+        if inspect.iscoroutinefunction(f):
+            @functools.wraps(f)
+            async def asyncWrapper(*args, **kwargs):
+                with span(name):
+                    return await f(*args, **kwargs)
+
+            return asyncWrapper
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    def __enter__(self):
+        active = _active.get()
+        if active is None or len(active[0].spans) >= MAX_SPANS:
+            return self
+        trace, parent, depth = active
+        self._record = {
+            "order": len(trace.spans),
+            "parent": parent,
+            "depth": depth + 1,
+            "name": self.name,
+            "start": None,
+            "elapsed": None
+        }
+        trace.spans.append(self._record)
+        self._token = _active.set(
+            (trace, self._record["order"], self._record["depth"]))
+        self._counter = time.perf_counter_ns()
+        self._record["start"] = round(trace.offset(self._counter), 9)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._token is None:
+            return False
+        self._record["elapsed"] = round(
+            (time.perf_counter_ns() - self._counter) / 1e9, 9)
+        _active.reset(self._token)
+        self._token = None
+        return False
+
+
+def waterfallOf(measurement):
+    """
+    :return: the spans of the measurement in start order, with the share of
+        the measured call's elapsed time each of them took
+    """
+    elapsed = float(measurement.get("elapsed") or 0)
+    rows = []
+    for s in sorted(measurement.get("spans") or [],
+                    key=lambda s: s["order"]):
+        rows.append(dict(
+            s, share=round(float(s["elapsed"]) / elapsed, 4)
+            if elapsed and s["elapsed"] is not None else None))
+    return rows
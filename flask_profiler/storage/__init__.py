@@ -27,11 +27,17 @@ def getCollection(conf):
         from .mongo import Mongo
         return Mongo(conf)
     elif engine.lower() == "sqlite":
+        if conf.get("PARTITIONED", False):
+            from .partitioned import PartitionedSqlite
+            return PartitionedSqlite(conf)
         from .sqlite import Sqlite
         return Sqlite(conf)
     elif engine.lower() == "sqlalchemy":
         from .sql_alchemy import Sqlalchemy
         return Sqlalchemy(conf)
+    elif engine.lower() == "memory":
+        from .memory import Memory
+        return Memory(conf)
     else:
         try:
             parts = engine.split('.')
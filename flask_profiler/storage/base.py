@@ -8,14 +8,68 @@ class BaseStorage(object):
     def filter(self, criteria):
         raise Exception("Not implemented Error")
 
+    def paginate(self, criteria):
+        """
+        :return: (list of measurements, cursor of the next page). engines
+            which support the `cursor` criterion return a cursor, this
+            fallback returns None.
+        """
+        return list(self.filter(criteria)), None
+
+    def iterate(self, criteria=None, chunkSize=1000):
+        """
+        yields every measurement which matches the criteria of filter(),
+        reading them page by page so that only one page is held in memory.
+        `limit` and `skip` of the criteria are ignored. engines which do not
+        return a cursor are paged with skip until a page comes back short.
+        """
+        criteria = dict(criteria or {})
+        criteria["skip"] = 0
+        criteria["limit"] = chunkSize
+        while True:
+            rows, cursor = self.paginate(criteria)
+            for row in rows:
+                yield row
+            if cursor is not None:
+                criteria["cursor"] = cursor
+            elif len(rows) == chunkSize:
+                criteria["skip"] += chunkSize
+            else:
+                return
+
     def getSummary(self, criteria):
         raise Exception("Not implemented Error")
 
     def insert(self, measurement):
         raise Exception("Not implemented Error")
 
+    def insert_many(self, measurements):
+        """
+        stores the given measurements. engines should override this with a
+        native bulk insert; this fallback inserts them one by one.
+        """
+        for measurement in measurements:
+            self.insert(measurement)
+
     def delete(self, measurementId):
         raise Exception("Not implemented Error")
 
     def truncate(self):
         raise Exception("Not implemented Error")
+
+    def prune(self, maxAge=None, maxRowsPerEndpoint=None, batchSize=1000):
+        """
+        deletes at most batchSize of the measurements which ended more than
+        maxAge seconds ago or which are beyond the newest maxRowsPerEndpoint
+        of their endpoint, along with their share of the rollups.
+        :return: the number of deleted measurements, 0 when nothing is left
+        """
+        raise Exception("Not implemented Error")
+
+    def compact(self):
+        """gives the space freed by prune back to the file system"""
+        pass
+
+    def close(self):
+        """releases the connections and threads of the engine"""
+        pass
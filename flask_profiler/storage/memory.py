@@ -0,0 +1,361 @@
+import math
+import threading
+import time
+from array import array
+
+from .base import BaseStorage
+from .pagination import applyCursor, nextCursor, parseSort
+from .rollup import AVERAGED, DEFAULT_WEIGHT, averageKeyOf, sortSummary
+from .timeseries import SeriesQuery, fillSeries
+from ..sketch import LatencySketch, parsePercentiles
+
+NUMERIC_FIELDS = ("startedAt", "endedAt", "weight") + AVERAGED
+# fields which are only returned by get(), as they may be large
+DETAIL_FIELDS = ("profile", "spans", "statements", "allocations")
+
+
+def toFloat(value):
+    return float("nan") if value is None else float(value)
+
+
+def fromFloat(value):
+    return None if math.isnan(value) else value
+
+
+class Memory(BaseStorage):
+    """
+    keeps the last MAX_RECORDS measurements, optionally only those ended in
+    the last MAX_AGE seconds, in a fixed-size ring buffer in memory. numeric
+    fields are stored in columnar arrays, names and methods are interned as
+    integers, and args, kwargs, context and the details are kept in a separate list.
+    nothing is written to disk, so measurements are lost on restart.
+    """
+
+    def __init__(self, config=None):
+        super(Memory, self).__init__()
+        self.config = config or {}
+        self.capacity = int(self.config.get("MAX_RECORDS", 10000))
+        self.maxAge = self.config.get("MAX_AGE", None)
+        if self.capacity < 1:
+            raise ValueError("MAX_RECORDS must be a positive number")
+
+        self.lock = threading.Lock()
+        self._reset()
+
+    def __enter__(self):
+        return self
+
+    def _reset(self):
+        self.nextId = 1
+        # id of the measurement in each slot, 0 for empty or deleted slots
+        self.ids = array('q', [0]) * self.capacity
+        self.columns = dict(
+            (field, array('d', [0.0]) * self.capacity)
+            for field in NUMERIC_FIELDS)
+        self.nameIds = array('l', [0]) * self.capacity
+        self.methodIds = array('l', [0]) * self.capacity
+        self.details = [None] * self.capacity
+        self.names = []
+        self.nameIndex = {}
+        self.methods = []
+        self.methodIndex = {}
+
+    @staticmethod
+    def getFilters(kwargs):
+        filters = {}
+        filters["sort"] = parseSort(kwargs.get('sort', "endedAt,desc"))
+
+        # because inserting and filtering may take place at the same moment,
+        # a very little increment(0.5) is needed to find inserted
+        # record.
+        filters["endedAt"] = float(
+            kwargs.get('endedAt', time.time() + 0.5))
+        filters["startedAt"] = float(
+            kwargs.get('startedAt', time.time() - 3600 * 24 * 7))
+
+        filters["elapsed"] = kwargs.get('elapsed', None)
+        filters["method"] = kwargs.get('method', None)
+        filters["name"] = kwargs.get('name', None)
+        filters["skip"] = int(kwargs.get('skip', 0))
+        filters["limit"] = int(kwargs.get('limit', 100))
+        return applyCursor(filters, kwargs)
+
+    @staticmethod
+    def _intern(value, values, index):
+        key = index.get(value)
+        if key is None:
+            key = index[value] = len(values)
+            values.append(value)
+        return key
+
+    def _insert(self, kwds):
+        slot = self.nextId % self.capacity
+        self.ids[slot] = self.nextId
+        self.nextId += 1
+        for field in NUMERIC_FIELDS:
+            self.columns[field][slot] = toFloat(kwds.get(field, None))
+        if kwds.get("weight", None) is None:
+            self.columns["weight"][slot] = DEFAULT_WEIGHT
+        self.nameIds[slot] = Memory._intern(
+            kwds.get("name", None), self.names, self.nameIndex)
+        self.methodIds[slot] = Memory._intern(
+            kwds.get("method", None), self.methods, self.methodIndex)
+        self.details[slot] = (
+            tuple(kwds.get("args", ())),
+            kwds.get("kwargs", {}),
+            kwds.get("context", {}),
+            dict((field, kwds.get(field, None)) for field in DETAIL_FIELDS))
+
+    def insert(self, kwds):
+        with self.lock:
+            self._insert(kwds)
+
+    def insert_many(self, measurements):
+        with self.lock:
+            for kwds in measurements:
+                self._insert(kwds)
+
+    def _slots(self, filters):
+        """
+        returns the slots of the live measurements which match the given
+        filters, from the oldest to the newest.
+        """
+        startedAt = self.columns["startedAt"]
+        endedAt = self.columns["endedAt"]
+        elapsed = self.columns["elapsed"]
+        ids = self.ids
+
+        minEndedAt = filters["startedAt"]
+        if self.maxAge is not None:
+            minEndedAt = max(minEndedAt, time.time() - self.maxAge)
+        minElapsed = float(filters["elapsed"]) \
+            if filters.get("elapsed", None) else None
+        nameId = methodId = None
+        if filters.get("name", None):
+            nameId = self.nameIndex.get(filters["name"], -1)
+        if filters.get("method", None):
+            methodId = self.methodIndex.get(filters["method"], -1)
+
+        first = max(1, self.nextId - self.capacity)
+        slots = []
+        for measurementId in range(first, self.nextId):
+            slot = measurementId % self.capacity
+            if ids[slot] != measurementId:
+                continue
+            if endedAt[slot] > filters["endedAt"] or \
+                    startedAt[slot] < filters["startedAt"] or \
+                    endedAt[slot] < minEndedAt:
+                continue
+            if minElapsed is not None and elapsed[slot] < minElapsed:
+                continue
+            if nameId is not None and self.nameIds[slot] != nameId:
+                continue
+            if methodId is not None and self.methodIds[slot] != methodId:
+                continue
+            slots.append(slot)
+        return slots
+
+    def _toDict(self, slot):
+        args, kwargs, context = self.details[slot][:3]
+        data = {
+            "id": self.ids[slot],
+            "name": self.names[self.nameIds[slot]],
+            "method": self.methods[self.methodIds[slot]],
+            "args": args,
+            "kwargs": kwargs,
+            "context": context
+        }
+        for field in NUMERIC_FIELDS:
+            data[field] = fromFloat(self.columns[field][slot])
+        return data
+
+    def filter(self, kwds={}):
+        f = Memory.getFilters(kwds)
+        key = self._sortKey(f["sort"][0])
+        if key is None:
+            raise ValueError("invalid sort: {0}".format(",".join(f["sort"])))
+        descending = f["sort"][1] == "desc"
+        with self.lock:
+            slots = self._slots(f)
+            if f["cursor"] is not None:
+                value, lastId = f["cursor"]
+                last = (value, lastId)
+                slots = [
+                    slot for slot in slots
+                    if (key(slot) < last if descending
+                        else key(slot) > last)]
+            slots.sort(key=key, reverse=descending)
+            slots = slots[f["skip"]:f["skip"] + f["limit"]]
+            rows = [self._toDict(slot) for slot in slots]
+        return (row for row in rows)
+
+    def _sortKey(self, field):
+        """:return: function which gives the (value, id) of a slot"""
+        ids = self.ids
+        if field in self.columns:
+            column = self.columns[field]
+            return lambda slot: (column[slot], ids[slot])
+        if field == "id":
+            return lambda slot: (ids[slot], ids[slot])
+        if field == "name":
+            return lambda slot: (self.names[self.nameIds[slot]], ids[slot])
+        if field == "method":
+            return lambda slot: (
+                self.methods[self.methodIds[slot]], ids[slot])
+        return None
+
+    def paginate(self, kwds={}):
+        rows = list(self.filter(kwds))
+        return rows, nextCursor(Memory.getFilters(kwds), rows)
+
+    def get(self, measurementId):
+        measurementId = int(measurementId)
+        with self.lock:
+            slot = measurementId % self.capacity
+            if measurementId < 1 or self.ids[slot] != measurementId:
+                return None
+            data = self._toDict(slot)
+            data.update(self.details[slot][3])
+            data["spans"] = data["spans"] or []
+            return data
+
+    def delete(self, measurementId):
+        measurementId = int(measurementId)
+        with self.lock:
+            slot = measurementId % self.capacity
+            if measurementId < 1 or self.ids[slot] != measurementId:
+                return False
+            self.ids[slot] = 0
+            self.details[slot] = None
+            return True
+
+    def prune(self, maxAge=None, maxRowsPerEndpoint=None, batchSize=1000):
+        with self.lock:
+            first = max(1, self.nextId - self.capacity)
+            live = [
+                measurementId % self.capacity
+                for measurementId in range(first, self.nextId)
+                if self.ids[measurementId % self.capacity] == measurementId]
+            expired = []
+            if maxAge is not None:
+                cutoff = time.time() - float(maxAge)
+                endedAt = self.columns["endedAt"]
+                expired = [slot for slot in live if endedAt[slot] < cutoff]
+            if not expired and maxRowsPerEndpoint is not None:
+                # the oldest slots of every endpoint, beyond its newest ones
+                counts = {}
+                for slot in live:
+                    key = (self.methodIds[slot], self.nameIds[slot])
+                    counts[key] = counts.get(key, 0) + 1
+                for slot in live:
+                    key = (self.methodIds[slot], self.nameIds[slot])
+                    if counts[key] > int(maxRowsPerEndpoint):
+                        counts[key] -= 1
+                        expired.append(slot)
+            expired = expired[:batchSize]
+            for slot in expired:
+                self.ids[slot] = 0
+                self.details[slot] = None
+            return len(expired)
+
+    def truncate(self):
+        with self.lock:
+            self._reset()
+        return True
+
+    def getSummary(self, kwds={}):
+        filters = Memory.getFilters(kwds)
+        filters["name"] = filters["method"] = None
+        groups = {}
+        with self.lock:
+            weight = self.columns["weight"]
+            elapsed = self.columns["elapsed"]
+            averaged = [
+                (field, self.columns[field])
+                for field in AVERAGED]
+            for slot in self._slots(filters):
+                key = (self.methodIds[slot], self.nameIds[slot])
+                group = groups.get(key)
+                if group is None:
+                    group = groups[key] = {
+                        "count": 0.0,
+                        "minElapsed": elapsed[slot],
+                        "maxElapsed": elapsed[slot],
+                        "sums": dict((f, [0.0, 0.0]) for f, _ in averaged),
+                        "sketch": LatencySketch()
+                    }
+                w = weight[slot]
+                group["count"] += w
+                group["sketch"].add(elapsed[slot], w)
+                group["minElapsed"] = min(group["minElapsed"], elapsed[slot])
+                group["maxElapsed"] = max(group["maxElapsed"], elapsed[slot])
+                for field, column in averaged:
+                    value = column[slot]
+                    if not math.isnan(value):
+                        sums = group["sums"][field]
+                        sums[0] += value * w
+                        sums[1] += w
+            methods, names = list(self.methods), list(self.names)
+
+        percentiles = parsePercentiles(kwds.get("percentiles", None))
+        result = []
+        for (methodId, nameId), group in groups.items():
+            row = {
+                "method": methods[methodId],
+                "name": names[nameId],
+                "count": int(round(group["count"])),
+                "minElapsed": group["minElapsed"],
+                "maxElapsed": group["maxElapsed"]
+            }
+            for field, (total, weights) in group["sums"].items():
+                row[averageKeyOf(field)] = total / weights if weights else None
+            row.update(group["sketch"].percentiles(percentiles))
+            result.append(row)
+
+        return sortSummary(
+            result, kwds.get("sort", "count,desc").split(","))
+
+    def getTimeseries(self, kwds={}):
+        filters = Memory.getFilters(kwds)
+        filters["name"] = filters["method"] = filters["elapsed"] = None
+        query = SeriesQuery(kwds, filters["startedAt"], filters["endedAt"])
+        percentiles = kwds.get('percentiles', None)
+        percentiles = parsePercentiles(percentiles) if percentiles else None
+
+        buckets = {}
+        with self.lock:
+            weight = self.columns["weight"]
+            started = self.columns["startedAt"]
+            elapsed = self.columns["elapsed"]
+            for slot in self._slots(filters):
+                bucket = query.bucketOf(started[slot])
+                row = buckets.get(bucket)
+                if row is None:
+                    row = buckets[bucket] = [
+                        bucket, 0.0, LatencySketch() if percentiles else None]
+                row[1] += weight[slot]
+                if percentiles:
+                    row[2].add(elapsed[slot], weight[slot])
+
+        return fillSeries(query, sorted(buckets.values()), percentiles)
+
+    def getMethodDistribution(self, kwds=None):
+        if not kwds:
+            kwds = {}
+        filters = Memory.getFilters(kwds)
+        filters["name"] = filters["method"] = filters["elapsed"] = None
+
+        counts = {}
+        with self.lock:
+            weight = self.columns["weight"]
+            for slot in self._slots(filters):
+                methodId = self.methodIds[slot]
+                counts[methodId] = counts.get(methodId, 0.0) + weight[slot]
+            methods = list(self.methods)
+
+        return dict(
+            (methods[methodId], int(round(count)))
+            for methodId, count in counts.items())
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return None
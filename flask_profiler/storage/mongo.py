@@ -1,10 +1,52 @@
 import time
 import datetime
+from functools import partial
 import pymongo
+from pymongo.errors import DuplicateKeyError, OperationFailure
 from .base import BaseStorage
+from .pagination import decodeCursor, encodeCursor, parseSort
+from .rollup import (
+    AVERAGED, DEFAULT_WEIGHT, HOUR, MINUTE, RAW_FIELDS, Rollup, RollupRebuild,
+    addPercentiles, averageKeyOf, bucketOf, collectRollups, isRolledUp,
+    methodDistributionOf, readsRollups, rollupsOf, sketchesByEndpoint,
+    summaryOf)
+from .timeseries import SeriesQuery, collectSeries
+from ..sketch import LatencySketch, parsePercentiles
 import datetime
 from bson.objectid import ObjectId
 
+EPOCH = datetime.datetime(1970, 1, 1)
+# smaller than every id
+FIRST_ID = ObjectId("0" * 24)
+
+WEIGHT = {"$ifNull": ["$weight", DEFAULT_WEIGHT]}
+
+
+def weightedSum(field):
+    return {"$sum": {"$multiply": [field, WEIGHT]}}
+
+
+def weightOf(field):
+    # documents missing the field must not add to its total weight
+    isMissing = {"$in": [{"$type": field}, ["missing", "null"]]}
+    return {"$sum": {"$cond": [isMissing, 0, WEIGHT]}}
+
+
+def bucketExpression(seconds, query):
+    """the start of the series bucket of an expression in seconds"""
+    shifted = {"$add": [seconds, query.offset]}
+    return {"$subtract": [
+        {"$subtract": [shifted, {"$mod": [shifted, query.interval]}]},
+        query.offset]}
+
+
+def weightedAvg(field):
+    weight = "$" + field + "Weight"
+    return {"$cond": [
+        {"$gt": [weight, 0]},
+        {"$divide": ["$" + field, weight]},
+        None]}
+
 
 class Mongo(BaseStorage):
     """
@@ -28,17 +70,77 @@ class Mongo(BaseStorage):
                     ('name', 1),
                     ('method', 1)]
                 )
+            # for paging through the measurements by time
+            self.collection.create_index([('endedAt', -1), ('_id', -1)])
+            self.collection.create_index([('startedAt', -1), ('_id', -1)])
 
         self.client = pymongo.MongoClient(self.mongo_url)
         self.db = self.client[self.database_name]
         self.collection = self.db[self.collection_name]
+        # of the ttl index created by prune
+        self.expireAfterSeconds = None
+        # aggregates per endpoint and minute or hour
+        self.rollups = {
+            MINUTE: self.db[self.collection_name + "_rollup_minute"],
+            HOUR: self.db[self.collection_name + "_rollup_hour"]}
+        # how far the rollups were rebuilt, see RollupRebuild
+        self.rebuildProgress = self.db[
+            self.collection_name + "_rollup_rebuild"]
         createIndex()
+        for rollups in self.rollups.values():
+            rollups.create_index(
+                [('bucket', 1), ('method', 1), ('name', 1)], unique=True)
+        try:
+            self.rebuildProgress.insert_one(
+                {"_id": 0, "lastId": FIRST_ID, "maxId": None})
+            self._planRebuild()
+        except DuplicateKeyError:
+            # another process planned the rebuild
+            pass
+        self.rollupRebuild = RollupRebuild(
+            self._rebuildStep, self._isRebuilt).start()
 
     def filter(self, filtering={}):
+        cursor, sort, limit = self._find(filtering)
+        return (self.clearify(record) for record in cursor)
+
+    def paginate(self, filtering={}):
+        cursor, sort, limit = self._find(filtering)
+        documents = list(cursor)
+        nextCursor = None
+        if documents and len(documents) >= limit:
+            last = documents[-1]
+            field = "_id" if sort[0] == "id" else sort[0]
+            value = last.get(field)
+            if isinstance(value, datetime.datetime):
+                value = int(round(
+                    (value - EPOCH).total_seconds() * 1000))
+            elif isinstance(value, ObjectId):
+                value = str(value)
+            nextCursor = encodeCursor(
+                sort[0], sort[1], value, str(last["_id"]))
+        return [self.clearify(d) for d in documents], nextCursor
+
+    def _find(self, filtering):
         query = {}
         limit = int(filtering.get('limit', 100000))
         skip = int(filtering.get('skip', 0))
-        sort = filtering.get('sort', "endedAt,desc").split(",")
+        sort = parseSort(filtering.get('sort', "endedAt,desc"))
+        seek = None
+        if filtering.get('cursor', None):
+            field, direction, value, lastId = decodeCursor(
+                filtering['cursor'])
+            sort, skip = [field, direction], 0
+            field = "_id" if field == "id" else field
+            if field in ("startedAt", "endedAt"):
+                value = EPOCH + datetime.timedelta(milliseconds=value)
+            elif field == "_id":
+                value = ObjectId(value)
+            operator = "$lt" if direction == "desc" else "$gt"
+            # seek past the last document of the previous page on the index
+            seek = {"$or": [
+                {field: {operator: value}},
+                {field: value, "_id": {operator: ObjectId(lastId)}}]}
 
         startedAt = datetime.datetime.fromtimestamp(float(
             filtering.get('startedAt', time.time() - 3600 * 24 * 7)))
@@ -69,18 +171,140 @@ class Mongo(BaseStorage):
             query['args'] = args
         if kwargs:
             query['kwargs'] = kwargs
-
+        if seek:
+            query = {"$and": [query, seek]}
+
+        sortField = "_id" if sort[0] == "id" else sort[0]
+        # details are only returned by get(), as they may be large
+        cursor = self.collection.find(
+            query,
+            {"profile": 0, "spans": 0, "statements": 0, "allocations": 0}
+            ).sort([(sortField, sort_dir), ("_id", sort_dir)]).skip(skip)
         if limit:
-            cursor = self.collection.find(
-                query
-                ).sort(sort[0], sort_dir).skip(skip)
-        else:
-            cursor = self.collection.find(
-                query
-                ).sort(sort[0], sort_dir).skip(skip).limit(limit)
-        return (self.clearify(record) for record in cursor)
+            cursor = cursor.limit(limit)
+        return cursor, sort, limit
+
+    def _planRebuild(self):
+        """empties the rollups, which are rebuilt up to the last id"""
+        self.rebuildProgress.update_one(
+            {"_id": 0}, {"$set": {"lastId": FIRST_ID, "maxId": None}})
+        for rollups in self.rollups.values():
+            rollups.delete_many({})
+        last = self.collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        self.rebuildProgress.update_one(
+            {"_id": 0},
+            {"$set": {"maxId": FIRST_ID if last is None else last["_id"]}})
+
+    def _rebuildStep(self, batchSize=10000):
+        """
+        adds the next batch of measurements to the rollups being rebuilt.
+        :return: True if the rollups are complete
+        """
+        progress = self.rebuildProgress.find_one({"_id": 0})
+        lastId, maxId = progress["lastId"], progress["maxId"]
+        if maxId is None:
+            # another process is planning the rebuild
+            time.sleep(1)
+            return False
+        if lastId >= maxId:
+            return True
+        documents = list(self.collection.find(
+            {"_id": {"$gt": lastId, "$lte": maxId}}, Mongo.RAW_FIELDS
+        ).sort("_id", 1).limit(batchSize))
+        last = documents[-1]["_id"] if len(documents) == batchSize else maxId
+        # only the process which moves the progress on adds the batch
+        claimed = self.rebuildProgress.update_one(
+            {"_id": 0, "lastId": lastId, "maxId": maxId},
+            {"$set": {"lastId": last}})
+        if claimed.modified_count:
+            self._updateRollups([Mongo._rawRow(d) for d in documents])
+        return last >= maxId
+
+    def _isRebuilt(self):
+        progress = self.rebuildProgress.find_one({"_id": 0})
+        return progress["maxId"] is not None and \
+            progress["lastId"] >= progress["maxId"]
+
+    def rebuild_rollups(self, batchSize=10000):
+        """builds the rollup collections again from the stored measurements"""
+        self._planRebuild()
+        while not self._rebuildStep(batchSize):
+            pass
+
+    def _updateRollups(self, measurements, sign=1):
+        # rollups are merged with $inc, $min and $max, so concurrent writers
+        # do not need to read them first
+        for granularity, rollups in self.rollups.items():
+            updates = []
+            for (bucket, method, name), rollup in rollupsOf(
+                    measurements, granularity, sign).items():
+                increments = {
+                    "count": rollup.count,
+                    "sketch.zero": rollup.sketch.zero}
+                for field, (total, weight) in rollup.sums.items():
+                    increments["sums." + field + ".total"] = total
+                    increments["sums." + field + ".weight"] = weight
+                for index, weight in rollup.sketch.bins.items():
+                    increments["sketch.bins." + str(index)] = weight
+                update = {"$inc": increments}
+                if rollup.minElapsed is not None:
+                    update["$min"] = {"minElapsed": rollup.minElapsed}
+                    update["$max"] = {"maxElapsed": rollup.maxElapsed}
+                updates.append(pymongo.UpdateOne(
+                    {"bucket": bucket, "method": method, "name": name},
+                    update,
+                    upsert=True))
+            if updates:
+                rollups.bulk_write(updates, ordered=False)
+
+    def _readRollups(self, granularity, startedAt, endedAt):
+        """:return: list of (bucket, method, name, Rollup)"""
+        cursor = self.rollups[granularity].find({
+            "bucket": {"$gte": startedAt, "$lt": endedAt}})
+        return [
+            (r["bucket"], r["method"], r["name"], Rollup(
+                r.get("count", 0.0),
+                r.get("minElapsed"),
+                r.get("maxElapsed"),
+                dict(
+                    (field, [sums.get("total", 0.0), sums.get("weight", 0.0)])
+                    for field, sums in r.get("sums", {}).items()),
+                LatencySketch.fromJson(r.get("sketch"))))
+            for r in cursor]
+
+    RAW_FIELDS = dict((field, 1) for field in RAW_FIELDS)
+
+    @staticmethod
+    def _rawRow(document):
+        row = dict((field, document.get(field)) for field in Mongo.RAW_FIELDS)
+        if isinstance(row["startedAt"], datetime.datetime):
+            row["startedAt"] = time.mktime(row["startedAt"].timetuple()) + \
+                row["startedAt"].microsecond / 1e6
+        return row
+
+    def _readRaw(self, startedAt, endedAt):
+        """:return: the measurements started in [startedAt, endedAt)"""
+        cursor = self.collection.find({
+            "startedAt": {
+                "$gte": datetime.datetime.fromtimestamp(startedAt),
+                "$lt": datetime.datetime.fromtimestamp(endedAt)}},
+            Mongo.RAW_FIELDS)
+        return [Mongo._rawRow(document) for document in cursor]
+
+    def _collectRollups(self, filtering):
+        rows = collectRollups(
+            float(filtering.get('startedAt', time.time() - 3600 * 24 * 7)),
+            float(filtering.get('endedAt', time.time())),
+            self._readRollups, self._readRaw,
+            self.rollupRebuild.granularities())
+        name = filtering.get('name', None)
+        method = filtering.get('method', None)
+        return [
+            r for r in rows
+            if (not method or r[1] == method) and (not name or r[2] == name)]
 
     def insert(self, measurement):
+        self._updateRollups([measurement])
         measurement["startedAt"] = datetime.datetime.fromtimestamp(
             measurement["startedAt"])
         measurement["endedAt"] = datetime.datetime.fromtimestamp(
@@ -91,19 +315,123 @@ class Mongo(BaseStorage):
             return True
         return False
 
+    def insert_many(self, measurements):
+        documents = []
+        for measurement in measurements:
+            document = dict(measurement)
+            document["startedAt"] = datetime.datetime.fromtimestamp(
+                measurement["startedAt"])
+            document["endedAt"] = datetime.datetime.fromtimestamp(
+                measurement["endedAt"])
+            documents.append(document)
+        if not documents:
+            return True
+
+        self._updateRollups(measurements)
+        result = self.collection.insert_many(documents, ordered=False)
+        if result:
+            return True
+        return False
+
     def truncate(self):
+        for rollups in self.rollups.values():
+            rollups.delete_many({})
+        self.rebuildProgress.update_one(
+            {"_id": 0}, {"$set": {"lastId": FIRST_ID, "maxId": FIRST_ID}})
         result = self.collection.remove()
         if result:
             return True
         return False
 
     def delete(self, measurementId):
+        document = self.collection.find_one(
+            {"_id": ObjectId(measurementId)}, Mongo.RAW_FIELDS)
+        progress = self.rebuildProgress.find_one({"_id": 0})
+        if document and isRolledUp(
+                document["_id"], progress["lastId"], progress["maxId"]):
+            self._updateRollups([Mongo._rawRow(document)], sign=-1)
         result = self.collection.remove({"_id": ObjectId(measurementId)})
         if result:
             return True
         return False
 
+    def _ensureTtlIndex(self, maxAge):
+        """
+        lets mongodb expire the measurements itself. dates are stored in the
+        local time of the server, which the ttl monitor reads as utc.
+        """
+        expireAfterSeconds = max(
+            0, int(maxAge) - time.localtime().tm_gmtoff)
+        if self.expireAfterSeconds == expireAfterSeconds:
+            return
+        try:
+            self.collection.create_index(
+                'endedAt', name='endedAt_ttl',
+                expireAfterSeconds=expireAfterSeconds)
+        except OperationFailure:
+            # the index exists with another expiry
+            self.db.command(
+                "collMod", self.collection_name,
+                index={
+                    "name": "endedAt_ttl",
+                    "expireAfterSeconds": expireAfterSeconds})
+        self.expireAfterSeconds = expireAfterSeconds
+
+    def prune(self, maxAge=None, maxRowsPerEndpoint=None, batchSize=1000):
+        if maxAge is not None:
+            self._ensureTtlIndex(maxAge)
+            # the ttl index deletes the measurements, the rollups of the
+            # buckets which ended before them are dropped here
+            cutoff = time.time() - float(maxAge)
+            for granularity, rollups in self.rollups.items():
+                rollups.delete_many(
+                    {"bucket": {"$lt": bucketOf(cutoff, granularity)}})
+        if maxRowsPerEndpoint is None:
+            return 0
+
+        documents = []
+        endpoints = self.collection.aggregate([
+            {"$group": {
+                "_id": {"method": "$method", "name": "$name"},
+                "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": int(maxRowsPerEndpoint)}}}])
+        for endpoint in endpoints:
+            documents.extend(self.collection.find(
+                {"method": endpoint["_id"].get("method"),
+                 "name": endpoint["_id"].get("name")},
+                Mongo.RAW_FIELDS
+            ).sort("_id", 1).limit(min(
+                endpoint["count"] - int(maxRowsPerEndpoint),
+                batchSize - len(documents))))
+            if len(documents) >= batchSize:
+                break
+        if not documents:
+            return 0
+
+        rows = [Mongo._rawRow(document) for document in documents]
+        progress = self.rebuildProgress.find_one({"_id": 0})
+        self._updateRollups([
+            row for row, document in zip(rows, documents)
+            if isRolledUp(
+                document["_id"], progress["lastId"], progress["maxId"])],
+            sign=-1)
+        self.collection.delete_many(
+            {"_id": {"$in": [document["_id"] for document in documents]}})
+        startedAt = [row["startedAt"] for row in rows]
+        for granularity, rollups in self.rollups.items():
+            rollups.delete_many({
+                "bucket": {
+                    "$gte": bucketOf(min(startedAt), granularity),
+                    "$lte": bucketOf(max(startedAt), granularity)},
+                "count": {"$lt": 0.5}})
+        return len(documents)
+
     def getSummary(self,  filtering={}):
+        percentiles = parsePercentiles(filtering.get("percentiles", None))
+        sort = filtering.get('sort', "count,desc").split(",")
+        if readsRollups(filtering):
+            return summaryOf(self._collectRollups(filtering), percentiles, sort)
+
         match_condition = {}
         endedAt = datetime.datetime.fromtimestamp(
             float(filtering.get('endedAt', time.time())))
@@ -112,7 +440,6 @@ class Mongo(BaseStorage):
         elapsed = filtering.get('elapsed', None)
         name = filtering.get('name', None)
         method = filtering.get('method', None)
-        sort = filtering.get('sort', "count,desc").split(",")
 
         if name:
             match_condition['name'] = name
@@ -130,119 +457,113 @@ class Mongo(BaseStorage):
         else:
             sort_dir = 1
 
-        return self.aggregate([
+        group = {
+            "_id": {
+                "method": "$method",
+                "name": "$name"
+               },
+            "count": {"$sum": WEIGHT},
+            "minElapsed": {"$min": "$elapsed"},
+            "maxElapsed": {"$max": "$elapsed"}
+        }
+        project = {
+            "_id": 0,
+            "method": "$_id.method",
+            "name": "$_id.name",
+            "count": {"$round": ["$count", 0]},
+            "minElapsed": 1,
+            "maxElapsed": 1
+        }
+        for field in AVERAGED:
+            group[field] = weightedSum("$" + field)
+            group[field + "Weight"] = weightOf("$" + field)
+            project[averageKeyOf(field)] = weightedAvg(field)
+
+        result = list(self.aggregate([
             {"$match": match_condition},
-            {
-                "$group": {
-                    "_id": {
-                        "method": "$method",
-                        "name": "$name"
-                       },
-                    "count": {"$sum": 1},
-                    "minElapsed": {"$min": "$elapsed"},
-                    "maxElapsed": {"$max": "$elapsed"},
-                    "avgElapsed": {"$avg": "$elapsed"}
-                }
-            },
-            {
-                "$project": {
-                    "_id": 0,
-                    "method": "$_id.method",
-                    "name": "$_id.name",
-                    "count": 1,
-                    "minElapsed": 1,
-                    "maxElapsed": 1,
-                    "avgElapsed": 1
-                }
-            },
+            {"$group": group},
+            {"$project": project},
             {
                 "$sort": {sort[0]: sort_dir}
             }
-        ])
+        ]))
+
+        cursor = self.collection.find(
+            match_condition,
+            {"method": 1, "name": 1, "elapsed": 1, "weight": 1})
+        sketches = sketchesByEndpoint(
+            (r.get("method"), r.get("name"), r.get("elapsed"), r.get("weight"))
+            for r in cursor)
+        return addPercentiles(result, sketches, percentiles)
 
     def getMethodDistribution(self, filtering=None):
         if not filtering:
             filtering = {}
-
-        startedAt = datetime.datetime.fromtimestamp(float(
-            filtering.get('startedAt', time.time() - 3600 * 24 * 7)))
-        endedAt = datetime.datetime.fromtimestamp(
-            float(filtering.get('endedAt', time.time())))
-
-        match_condition = {
-            "startedAt": {"$gte": startedAt},
-            "endedAt": {"$lte": endedAt}
-        }
-
-        result = self.aggregate([
-            {"$match": match_condition},
-            {
-                "$group": {
-                    "_id": {
-                        "method": "$method"
-                       },
-                    "count": {"$sum": 1}
-                }
-            },
-            {
-                "$project": {
-                    "_id": 0,
-                    "method": "$_id.method",
-                    "count": 1
-                }
-            }
-        ])
-
-        distribution = dict((i["method"], i["count"]) for i in result)
-        return distribution
+        filtering = dict(filtering, name=None, method=None)
+        return methodDistributionOf(self._collectRollups(filtering))
+
+    def _readSeriesRollups(self, query, percentiles, granularity,
+                           startedAt, endedAt):
+        match = {"$match": {"bucket": {"$gte": startedAt, "$lt": endedAt}}}
+        bucket = bucketExpression("$bucket", query)
+        rollups = self.rollups[granularity]
+        if percentiles:
+            cursor = rollups.aggregate([
+                match,
+                {"$project": {"b": bucket, "count": 1, "sketch": 1}},
+                {"$sort": {"b": 1}}])
+            return [
+                (r["b"], r.get("count", 0.0),
+                 LatencySketch.fromJson(r.get("sketch")))
+                for r in cursor]
+        cursor = rollups.aggregate([
+            match,
+            {"$group": {"_id": bucket, "count": {"$sum": "$count"}}},
+            {"$sort": {"_id": 1}}])
+        return [(r["_id"], r["count"], None) for r in cursor]
+
+    def _readSeriesRaw(self, query, percentiles, startedAt, endedAt):
+        # startedAt is stored as a naive local datetime, which the database
+        # takes for UTC
+        seconds = {"$subtract": [
+            {"$divide": [
+                {"$subtract": ["$startedAt", EPOCH]},
+                1000]},
+            time.localtime().tm_gmtoff]}
+        match = {"$match": {"startedAt": {
+            "$gte": datetime.datetime.fromtimestamp(startedAt),
+            "$lt": datetime.datetime.fromtimestamp(endedAt)}}}
+        bucket = bucketExpression(seconds, query)
+        if percentiles:
+            cursor = self.aggregate([
+                match,
+                {"$project": {"b": bucket, "weight": WEIGHT, "elapsed": 1}},
+                {"$sort": {"b": 1}}])
+            return [(r["b"], r["weight"], r.get("elapsed")) for r in cursor]
+        cursor = self.aggregate([
+            match,
+            {"$group": {"_id": bucket, "count": {"$sum": WEIGHT}}},
+            {"$sort": {"_id": 1}}])
+        return [(r["_id"], r["count"], None) for r in cursor]
 
     def getTimeseries(self, filtering=None):
         if not filtering:
             filtering = {}
-        if filtering.get('interval', None) == "daily":
-            dateFormat = '%Y-%m-%d'
-            interval = 3600 * 24   # daily
-            groupId = {
-                "month": {"$month": "$startedAt"},
-                "day": {"$dayOfMonth": "$startedAt"},
-                "year": {"$year": "$startedAt"}}
-
-        else:
-            dateFormat = '%Y-%m-%d %H'
-            interval = 3600  # hourly
-            groupId = {
-                "hour": {"$hour": "$startedAt"},
-                "day": {"$dayOfMonth": "$startedAt"},
-                "month": {"$month": "$startedAt"},
-                "year": {"$year": "$startedAt"}}
-
-        startedAt = float(
-            filtering.get('startedAt', time.time() - 3600 * 24 * 7))
-        startedAtF = datetime.datetime.fromtimestamp(startedAt)
-        endedAt = float(filtering.get('endedAt', time.time()))
-        endedAtF = datetime.datetime.fromtimestamp(endedAt)
-
-        match_condition = {
-            "startedAt": {"$gte": startedAtF},
-            "endedAt": {"$lte": endedAtF}
-        }
-        result = self.aggregate([
-            {"$match": match_condition},
-            {
-                "$group": {
-                    "_id": groupId,
-                    "startedAt": {"$first": "$startedAt"},
-                    "count": {"$sum": 1},
-                }
-            }
-        ])
-        series = {}
-        for i in range(int(startedAt), int(endedAt) + 1, interval):
-            series[datetime.datetime.fromtimestamp(i).strftime(dateFormat)] = 0
-
-        for i in result:
-            series[i["startedAt"].strftime(dateFormat)] = i["count"]
-        return series
+        query = SeriesQuery(
+            filtering,
+            float(filtering.get('startedAt', time.time() - 3600 * 24 * 7)),
+            float(filtering.get('endedAt', time.time())))
+        percentiles = filtering.get('percentiles', None)
+        percentiles = parsePercentiles(percentiles) if percentiles else None
+        return collectSeries(
+            query,
+            partial(self._readSeriesRollups, query, percentiles),
+            partial(self._readSeriesRaw, query, percentiles),
+            percentiles, self.rollupRebuild.granularities())
+
+    def close(self):
+        self.rollupRebuild.stop()
+        self.client.close()
 
     def clearify(self, obj):
         available_types = [int, dict, str, list]
@@ -258,7 +579,11 @@ class Mongo(BaseStorage):
         return obj
 
     def get(self, measurementId):
+        if not ObjectId.is_valid(measurementId):
+            return None
         record = self.collection.find_one({'_id': ObjectId(measurementId)})
+        if record is None:
+            return None
         return self.clearify(record)
 
     def aggregate(self, pipeline, **kwargs):
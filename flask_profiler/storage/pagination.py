@@ -0,0 +1,63 @@
+import base64
+import binascii
+import json
+from decimal import Decimal
+
+# the fields measurements can be paged by, ties are broken by the id
+CURSOR_FIELDS = ("id", "startedAt", "endedAt", "elapsed", "name", "method")
+
+
+def parseSort(value):
+    """:return: [field, direction] of a sort argument such as elapsed,desc"""
+    sort = value.split(",")
+    return [sort[0], sort[1].lower() if len(sort) > 1 else "desc"]
+
+
+def encodeCursor(field, direction, value, measurementId):
+    """:return: an opaque cursor which points after the given row"""
+    if isinstance(value, Decimal):
+        value = float(value)
+    data = json.dumps(
+        [field, direction, value, measurementId], separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii")
+
+
+def decodeCursor(cursor):
+    """:return: (field, direction, value, id)"""
+    try:
+        field, direction, value, measurementId = json.loads(
+            base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError("invalid cursor")
+    if field not in CURSOR_FIELDS or direction not in ("asc", "desc"):
+        raise ValueError("invalid cursor")
+    return field, direction, value, measurementId
+
+
+def applyCursor(filters, kwargs):
+    """
+    sets the sort and the position of the `cursor` argument, if any, on the
+    filters of an engine. a cursor replaces `sort` and `skip`.
+    """
+    filters["cursor"] = None
+    if kwargs.get('cursor', None):
+        field, direction, value, measurementId = decodeCursor(
+            kwargs['cursor'])
+        filters["sort"] = [field, direction]
+        filters["cursor"] = (value, measurementId)
+        filters["skip"] = 0
+    return filters
+
+
+def nextCursor(filters, rows):
+    """
+    :param rows: the page returned for the filters, as dicts
+    :return: the cursor of the next page, None after the last page
+    """
+    field = filters["sort"][0]
+    direction = filters["sort"][1] if len(filters["sort"]) > 1 else "desc"
+    if len(rows) < filters["limit"] or not rows or \
+            field not in CURSOR_FIELDS:
+        return None
+    last = rows[-1]
+    return encodeCursor(field, direction, last[field], last["id"])
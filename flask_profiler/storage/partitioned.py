@@ -0,0 +1,337 @@
+import heapq
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from .base import BaseStorage
+from .pagination import decodeCursor, encodeCursor, nextCursor
+from .rollup import (
+    GRANULARITIES, methodDistributionOf, readsRollups, summaryOf)
+from .sqlite import Sqlite
+from .timeseries import SeriesQuery, collectSeries
+from ..sketch import parsePercentiles
+
+DAY = 3600 * 24
+# the ids of a day are day * ID_STRIDE + the id within its file
+ID_STRIDE = 10 ** 9
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def dayOf(timestamp):
+    """:return: the number of the utc day since the epoch"""
+    return int(float(timestamp) // DAY)
+
+
+class PartitionedSqlite(BaseStorage):
+    """
+    keeps the measurements of every utc day in a SQLite file of its own,
+    e.g. flask_profiler-2024-01-31.sql next to FILE. queries read only the
+    files of the days they cover and merge their results, and expiring a
+    day deletes its file. only the MAX_OPEN_PARTITIONS most recently used
+    files are kept open.
+    """
+
+    def __init__(self, config=None):
+        super(PartitionedSqlite, self).__init__()
+        self.config = config
+        path = self.config.get("FILE", "flask_profiler.sql")
+        if path == ":memory:" or path.startswith("file:"):
+            raise ValueError("a partitioned sqlite storage needs a FILE path")
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.prefix, self.extension = os.path.splitext(os.path.basename(path))
+        self.pattern = re.compile(
+            re.escape(self.prefix) + r"-(\d{4}-\d{2}-\d{2})" +
+            re.escape(self.extension) + "$")
+        self.maxOpen = int(self.config.get("MAX_OPEN_PARTITIONS", 8))
+        # the open storages by day, the least recently used first
+        self.partitions = OrderedDict()
+        # the number of callers using each open storage
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def fileOf(self, day):
+        return os.path.join(self.directory, "{0}-{1}{2}".format(
+            self.prefix,
+            (EPOCH + timedelta(days=day)).strftime("%Y-%m-%d"),
+            self.extension))
+
+    def days(self, startedAt=None, endedAt=None):
+        """
+        :return: the days which have a file, from the oldest, optionally only
+            those which overlap [startedAt, endedAt]
+        """
+        days = []
+        for name in os.listdir(self.directory):
+            match = self.pattern.match(name)
+            if match:
+                days.append((datetime.strptime(
+                    match.group(1), "%Y-%m-%d") - EPOCH).days)
+        return sorted(
+            day for day in days
+            if (startedAt is None or day >= dayOf(startedAt)) and
+            (endedAt is None or day <= dayOf(endedAt)))
+
+    @contextmanager
+    def using(self, days, create=False):
+        """
+        keeps the storages of the given days open within the block.
+        :return: list of (day, storage) of the days which have a file
+        """
+        partitions = []
+        try:
+            for day in days:
+                partition = self._acquire(day, create)
+                if partition is not None:
+                    partitions.append((day, partition))
+            yield partitions
+        finally:
+            self._release([partition for day, partition in partitions])
+
+    def usingFiltered(self, filters):
+        """:return: using() the days overlapping the filters"""
+        return self.using(self.days(filters["startedAt"], filters["endedAt"]))
+
+    def _acquire(self, day, create):
+        """:return: the storage of the day, None if it has no file"""
+        with self.lock:
+            partition = self.partitions.get(day)
+            if partition is None:
+                path = self.fileOf(day)
+                if not create and not os.path.exists(path):
+                    return None
+                config = dict(self.config, FILE=path)
+                config.pop("PARTITIONED", None)
+                partition = self.partitions[day] = Sqlite(config)
+            self.partitions.move_to_end(day)
+            self.users[partition] = self.users.get(partition, 0) + 1
+            return partition
+
+    def _release(self, partitions):
+        """closes the least recently used storages nobody is using"""
+        idle = []
+        with self.lock:
+            for partition in partitions:
+                self.users[partition] -= 1
+                if not self.users[partition]:
+                    del self.users[partition]
+            excess = len(self.partitions) - self.maxOpen
+            for day, partition in list(self.partitions.items()):
+                if excess <= 0:
+                    break
+                if partition not in self.users:
+                    del self.partitions[day]
+                    idle.append(partition)
+                    excess -= 1
+        for partition in idle:
+            partition.close()
+
+    def insert(self, measurement):
+        self.insert_many([measurement])
+
+    def insert_many(self, measurements):
+        byDay = {}
+        for measurement in measurements:
+            byDay.setdefault(
+                dayOf(measurement["startedAt"]), []).append(measurement)
+        with self.using(sorted(byDay), create=True) as partitions:
+            for day, partition in partitions:
+                partition.insert_many(byDay[day])
+
+    @staticmethod
+    def _globalRow(day, row):
+        row["id"] = day * ID_STRIDE + row["id"]
+        return row
+
+    def filter(self, kwds={}):
+        filters = Sqlite.getFilters(kwds)
+        field, direction = filters["sort"][0], filters["sort"][1]
+        # every file is asked for the rows up to the end of the page, its
+        # cursor is moved into the ids of the file
+        kwds = dict(kwds, skip=0, limit=filters["skip"] + filters["limit"])
+        if kwds.get("cursor", None):
+            cursor = decodeCursor(kwds["cursor"])
+        else:
+            cursor = None
+
+        def rowsOf(day, partition):
+            dayKwds = kwds
+            if cursor is not None:
+                dayKwds = dict(kwds, cursor=encodeCursor(
+                    cursor[0], cursor[1], cursor[2],
+                    cursor[3] - day * ID_STRIDE))
+            return [
+                PartitionedSqlite._globalRow(day, row)
+                for row in partition.filter(dayKwds)]
+
+        def key(row):
+            value = row[field]
+            return (value is not None, value), row["id"]
+
+        with self.usingFiltered(filters) as partitions:
+            rows = list(heapq.merge(
+                *[rowsOf(day, partition) for day, partition in partitions],
+                key=key, reverse=direction == "desc"))
+        return iter(rows[filters["skip"]:filters["skip"] + filters["limit"]])
+
+    def paginate(self, kwds={}):
+        rows = list(self.filter(kwds))
+        return rows, nextCursor(Sqlite.getFilters(kwds), rows)
+
+    def get(self, measurementId):
+        day, localId = divmod(int(measurementId), ID_STRIDE)
+        with self.using([day]) as partitions:
+            row = partitions[0][1].get(localId) if partitions else None
+        if row is None:
+            return None
+        return PartitionedSqlite._globalRow(day, row)
+
+    def delete(self, measurementId):
+        day, localId = divmod(int(measurementId), ID_STRIDE)
+        with self.using([day]) as partitions:
+            if not partitions:
+                return False
+            return partitions[0][1].delete(localId)
+
+    def getSummary(self, kwds={}):
+        filters = Sqlite.getFilters(kwds)
+        percentiles = parsePercentiles(kwds.get("percentiles", None))
+        rows = []
+        sort = kwds.get('sort', "count,desc").split(",")
+        with self.usingFiltered(filters) as partitions:
+            for day, partition in partitions:
+                if readsRollups(filters):
+                    rows.extend(partition._collectRollups(filters))
+                else:
+                    rows.extend(partition._rawRollups(filters))
+        return summaryOf(rows, percentiles, sort)
+
+    def getTimeseries(self, kwds={}):
+        filters = Sqlite.getFilters(kwds)
+        query = SeriesQuery(kwds, filters["startedAt"], filters["endedAt"])
+        percentiles = kwds.get('percentiles', None)
+        percentiles = parsePercentiles(percentiles) if percentiles else None
+        with self.usingFiltered(filters) as partitions:
+            # the rows of the files are concatenated from the oldest day, so
+            # they stay sorted by bucket
+            def readRollups(granularity, startedAt, endedAt):
+                rows = []
+                for day, partition in partitions:
+                    rows.extend(partition._readSeriesRollups(
+                        query, percentiles, granularity, startedAt, endedAt))
+                return rows
+
+            def readRaw(startedAt, endedAt):
+                rows = []
+                for day, partition in partitions:
+                    rows.extend(partition._readSeriesRaw(
+                        query, percentiles, startedAt, endedAt))
+                return rows
+
+            ready = all(
+                partition.rollupRebuild.ready()
+                for day, partition in partitions)
+            return collectSeries(
+                query, readRollups, readRaw, percentiles,
+                GRANULARITIES if ready else ())
+
+    def getMethodDistribution(self, kwds=None):
+        filters = Sqlite.getFilters(kwds or {})
+        rows = []
+        with self.usingFiltered(filters) as partitions:
+            for day, partition in partitions:
+                rows.extend(partition._collectRollups(filters))
+        return methodDistributionOf(rows)
+
+    def _drop(self, day):
+        """closes the file of the day and deletes it"""
+        with self.lock:
+            partition = self.partitions.pop(day, None)
+        if partition is not None:
+            partition.close()
+        path = self.fileOf(day)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    def truncate(self):
+        days = self.days()
+        for day in days:
+            self._drop(day)
+        return True if days else False
+
+    def prune(self, maxAge=None, maxRowsPerEndpoint=None, batchSize=1000):
+        if maxAge is not None:
+            cutoff = time.time() - float(maxAge)
+            # the days which ended before the cutoff are dropped as a whole
+            expired = [day for day in self.days() if (day + 1) * DAY <= cutoff]
+            for day in expired:
+                self._drop(day)
+            if expired:
+                # their rows are not counted, any number tells the pruner
+                # to go on
+                return len(expired)
+            # the measurements of the day the cutoff falls into
+            with self.using([dayOf(cutoff)]) as partitions:
+                for day, partition in partitions:
+                    count = partition.prune(maxAge=maxAge, batchSize=batchSize)
+                    if count:
+                        return count
+        if maxRowsPerEndpoint is None:
+            return 0
+        return self._pruneRows(int(maxRowsPerEndpoint), batchSize)
+
+    def _pruneRows(self, maxRowsPerEndpoint, batchSize):
+        """deletes the oldest measurements of the endpoints with too many"""
+        with self.using(self.days()) as partitions:
+            return self._pruneRowsOf(
+                partitions, maxRowsPerEndpoint, batchSize)
+
+    def _pruneRowsOf(self, partitions, maxRowsPerEndpoint, batchSize):
+        excess = {}
+        for day, partition in partitions:
+            for method, name, count in partition._read(
+                    '''SELECT method, name, count(*) FROM "{0}"
+                    GROUP BY method, name'''.format(partition.table_name)):
+                excess[(method, name)] = excess.get((method, name), 0) + count
+        excess = dict(
+            (key, count - maxRowsPerEndpoint)
+            for key, count in excess.items() if count > maxRowsPerEndpoint)
+
+        deleted = 0
+        for day, partition in partitions:
+            ids = []
+            for (method, name), count in excess.items():
+                limit = min(count, batchSize - deleted - len(ids))
+                if limit <= 0:
+                    continue
+                rows = partition._read(
+                    '''SELECT ID FROM "{0}" WHERE method IS ? AND name IS ?
+                    ORDER BY ID LIMIT ?'''.format(partition.table_name),
+                    (method, name, limit))
+                excess[(method, name)] -= len(rows)
+                ids.extend(row[0] for row in rows)
+            if ids:
+                partition._submit(partition._deleteMany, ids)
+                deleted += len(ids)
+            if deleted >= batchSize:
+                break
+        return deleted
+
+    def compact(self):
+        for day in self.days():
+            with self.using([day]) as partitions:
+                for day, partition in partitions:
+                    partition.compact()
+
+    def close(self):
+        with self.lock:
+            partitions = list(self.partitions.values())
+            self.partitions = OrderedDict()
+            self.users = {}
+        for partition in partitions:
+            partition.close()
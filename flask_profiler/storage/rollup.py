@@ -0,0 +1,351 @@
+import json
+import logging
+import math
+import threading
+
+from ..sketch import LatencySketch
+
+logger = logging.getLogger("flask-profiler")
+
+MINUTE = 60
+HOUR = 3600
+# granularities of the rollup tables, from the coarsest to the finest
+GRANULARITIES = (HOUR, MINUTE)
+# fields whose weighted averages are reported by getSummary
+AVERAGED = (
+    "elapsed", "cpuTime", "userTime", "sysTime", "queries", "dbTime",
+    "peakBytes", "netBytes", "ttfb", "ttlb", "responseSize", "viewTime")
+# the fields of a measurement its rollups are built from
+RAW_FIELDS = ("method", "name", "startedAt") + AVERAGED + ("weight", )
+# a sampled measurement stands for `weight` requests, those stored before
+# sampling existed for one
+DEFAULT_WEIGHT = 1.0
+
+
+def averageKeyOf(field):
+    """:return: the getSummary key of the average of the field"""
+    return "avg" + field[0].upper() + field[1:]
+
+
+def readsRollups(filters):
+    """
+    :return: False for the drill-down queries filtered by elapsed time, which
+        the rollups can not answer, they read the measurements
+    """
+    return not filters.get("elapsed", None)
+
+
+def bucketOf(timestamp, interval=HOUR):
+    """:return: the start of the time bucket the timestamp falls into"""
+    return int(float(timestamp) // interval) * interval
+
+
+class Rollup(object):
+    """
+    the aggregates of the measurements of one endpoint in one time bucket:
+    the weighted count, the minimum and maximum elapsed times, the weighted
+    sums of the averaged fields and a latency sketch. rollups of different
+    buckets are merged by adding them up.
+    """
+    __slots__ = ("count", "minElapsed", "maxElapsed", "sums", "sketch")
+
+    def __init__(self, count=0.0, minElapsed=None, maxElapsed=None,
+                 sums=None, sketch=None):
+        self.count = count
+        self.minElapsed = minElapsed
+        self.maxElapsed = maxElapsed
+        # field -> [sum of value * weight, sum of weight]
+        self.sums = sums if sums is not None else {}
+        self.sketch = sketch if sketch is not None else LatencySketch()
+
+    def add(self, measurement, sign=1):
+        """
+        :param sign: -1 takes a deleted measurement out of the rollup, its
+            minimum and maximum elapsed times are kept as they are.
+        """
+        weight = measurement.get("weight", None)
+        weight = sign * (
+            DEFAULT_WEIGHT if weight is None else float(weight))
+        elapsed = measurement.get("elapsed", None)
+        self.count += weight
+        if elapsed is not None:
+            elapsed = float(elapsed)
+            if sign > 0:
+                self.minElapsed = elapsed if self.minElapsed is None \
+                    else min(self.minElapsed, elapsed)
+                self.maxElapsed = elapsed if self.maxElapsed is None \
+                    else max(self.maxElapsed, elapsed)
+            self.sketch.add(elapsed, weight)
+        for field in AVERAGED:
+            value = measurement.get(field, None)
+            if value is not None:
+                sums = self.sums.setdefault(field, [0.0, 0.0])
+                sums[0] += float(value) * weight
+                sums[1] += weight
+        return self
+
+    def merge(self, other):
+        self.count += other.count
+        if other.minElapsed is not None:
+            self.minElapsed = other.minElapsed if self.minElapsed is None \
+                else min(self.minElapsed, other.minElapsed)
+        if other.maxElapsed is not None:
+            self.maxElapsed = other.maxElapsed if self.maxElapsed is None \
+                else max(self.maxElapsed, other.maxElapsed)
+        for field, (total, weight) in other.sums.items():
+            sums = self.sums.setdefault(field, [0.0, 0.0])
+            sums[0] += total
+            sums[1] += weight
+        self.sketch.merge(other.sketch)
+        return self
+
+    def summary(self, percentiles):
+        """:return: the aggregate columns of a getSummary row"""
+        row = {
+            "count": int(round(self.count)),
+            "minElapsed": self.minElapsed,
+            "maxElapsed": self.maxElapsed
+        }
+        for field in AVERAGED:
+            total, weight = self.sums.get(field, (0.0, 0.0))
+            # weights below half a request are rounding leftovers of deletes
+            row[averageKeyOf(field)] = total / weight if weight > 0.5 else None
+        row.update(self.sketch.percentiles(percentiles))
+        return row
+
+    def toRow(self):
+        """:return: (count, minElapsed, maxElapsed, sums, sketch) for tables"""
+        return (
+            self.count, self.minElapsed, self.maxElapsed,
+            json.dumps(self.sums), json.dumps(self.sketch.__json__()))
+
+    @classmethod
+    def fromRow(cls, count, minElapsed, maxElapsed, sums, sketch):
+        return cls(
+            float(count or 0), minElapsed, maxElapsed,
+            json.loads(sums) if sums else {},
+            LatencySketch.fromJson(json.loads(sketch) if sketch else None))
+
+
+def rollupsOf(measurements, interval=HOUR, sign=1):
+    """
+    groups the given measurements by time bucket and endpoint.
+    :return: {(bucket, method, name): Rollup}
+    """
+    rollups = {}
+    for m in measurements:
+        key = (bucketOf(m["startedAt"], interval), m.get("method"), m.get("name"))
+        rollup = rollups.get(key)
+        if rollup is None:
+            rollup = rollups[key] = Rollup()
+        rollup.add(m, sign)
+    return rollups
+
+
+def planRanges(startedAt, endedAt, granularities=GRANULARITIES):
+    """
+    splits [startedAt, endedAt) into the ranges which are read from the
+    coarsest rollups that fit. the edges which are not whole minutes are
+    left to the raw measurements.
+    :return: list of (granularity, start, end), granularity is None for the
+        ranges of raw measurements
+    """
+    plan = []
+
+    def split(start, end, granularities):
+        if start >= end:
+            return
+        if not granularities:
+            plan.append((None, start, end))
+            return
+        granularity, finer = granularities[0], granularities[1:]
+        first = int(math.ceil(start / float(granularity))) * granularity
+        last = bucketOf(end, granularity)
+        if first >= last:
+            split(start, end, finer)
+            return
+        split(start, first, finer)
+        plan.append((granularity, first, last))
+        split(last, end, finer)
+
+    split(float(startedAt), float(endedAt), tuple(granularities))
+    return plan
+
+
+def collectRollups(startedAt, endedAt, readRollups, readRaw,
+                   granularities=GRANULARITIES):
+    """
+    reads the rollups which cover [startedAt, endedAt).
+    :param readRollups: function(granularity, start, end) which returns the
+        (bucket, method, name, Rollup) of the buckets in [start, end)
+    :param readRaw: function(start, end) which returns the measurements
+        started in [start, end), as dicts
+    :param granularities: of the rollups which may be read, none while they
+        are rebuilt
+    :return: list of (bucket, method, name, Rollup)
+    """
+    rows = []
+    for granularity, start, end in planRanges(
+            startedAt, endedAt, granularities):
+        if granularity is None:
+            rows.extend(
+                key + (rollup, ) for key, rollup in rollupsOf(
+                    readRaw(start, end), MINUTE).items())
+        else:
+            rows.extend(readRollups(granularity, start, end))
+    return rows
+
+
+def summaryOf(rows, percentiles, sort=("count", "desc")):
+    """
+    :param rows: iterable of (bucket, method, name, Rollup)
+    :return: the rows of a getSummary result
+    """
+    merged = {}
+    for bucket, method, name, rollup in rows:
+        key = (method, name)
+        if key in merged:
+            merged[key].merge(rollup)
+        else:
+            merged[key] = Rollup().merge(rollup)
+
+    result = []
+    for (method, name), rollup in merged.items():
+        if rollup.count < 0.5:
+            # every measurement of the endpoint was deleted
+            continue
+        row = {"method": method, "name": name}
+        row.update(rollup.summary(percentiles))
+        result.append(row)
+
+    return sortSummary(result, sort)
+
+
+def sortSummary(result, sort=("count", "desc")):
+    """sorts the rows of a getSummary result, rows without a value last"""
+    field = sort[0]
+    direction = sort[1].lower() if len(sort) > 1 else "desc"
+    if result and field in result[0]:
+        result.sort(
+            key=lambda row: (row[field] is not None, row[field]),
+            reverse=direction == "desc")
+    return result
+
+
+def methodDistributionOf(rows):
+    """:param rows: iterable of (bucket, method, name, Rollup)"""
+    counts = {}
+    for bucket, method, name, rollup in rows:
+        counts[method] = counts.get(method, 0.0) + rollup.count
+    return dict(
+        (method, int(round(count))) for method, count in counts.items()
+        if count >= 0.5)
+
+
+def sketchesByEndpoint(rows):
+    """
+    builds latency sketches from raw rows, for queries the rollups can not
+    answer.
+    :param rows: iterable of (method, name, elapsed, weight)
+    :return: {(method, name): LatencySketch}
+    """
+    sketches = {}
+    for method, name, elapsed, weight in rows:
+        key = (method, name)
+        sketch = sketches.get(key)
+        if sketch is None:
+            sketch = sketches[key] = LatencySketch()
+        sketch.add(elapsed, DEFAULT_WEIGHT if weight is None else weight)
+    return sketches
+
+
+def addPercentiles(summary, sketches, percentiles):
+    """
+    adds the percentile columns to the rows of a getSummary result.
+    :param sketches: {(method, name): LatencySketch}
+    """
+    empty = LatencySketch()
+    for row in summary:
+        sketch = sketches.get((row["method"], row["name"]), empty)
+        row.update(sketch.percentiles(percentiles))
+    return summary
+
+
+def isRolledUp(measurementId, lastId, maxId):
+    """
+    :param lastId, maxId: the progress of a rebuild, which adds the
+        measurements up to maxId to the rollups, lastId being the last one
+        added. maxId is None before the rebuild has started.
+    :return: False for the measurements the rebuild has not added yet
+    """
+    if maxId is None:
+        return False
+    return not lastId < measurementId <= maxId
+
+
+class RollupRebuild(object):
+    """
+    rebuilds the rollups of a storage from its measurements in a background
+    thread, as that takes a while on big storages. every step adds a batch
+    of measurements in a transaction of its own and records how far the
+    rebuild got, so that the processes sharing a storage take turns and an
+    interrupted rebuild is resumed. until the rollups are complete, the
+    queries read the measurements.
+    """
+
+    def __init__(self, step, isComplete):
+        """
+        :param step: function() which adds the next batch to the rollups, it
+            returns True when they are complete
+        :param isComplete: function() which returns True if the rollups are
+            complete, also when another process rebuilt them
+        """
+        super(RollupRebuild, self).__init__()
+        self.step = step
+        self.isComplete = isComplete
+        self.complete = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def ready(self):
+        """:return: True if the queries can read the rollups"""
+        if not self.complete:
+            self.complete = self.isComplete()
+        return self.complete
+
+    def granularities(self):
+        """:return: the granularities of the rollups the queries may read"""
+        return GRANULARITIES if self.ready() else ()
+
+    def start(self):
+        """rebuilds the rollups in the background, if they are incomplete"""
+        if self.ready():
+            return self
+        self._thread = threading.Thread(
+            target=self._run, name="flask-profiler-rollups")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def run(self):
+        """rebuilds the rollups in the calling thread"""
+        while not self._stopped.is_set():
+            if self.step():
+                self.complete = True
+                return
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stop(self, timeout=5):
+        self._stopped.set()
+        self.join(timeout)
+
+    def _run(self):
+        try:
+            self.run()
+        except Exception:
+            if not self._stopped.is_set():
+                logger.exception(
+                    "flask-profiler could not rebuild the rollups")
@@ -1,33 +1,100 @@
 import json
-from decimal import Decimal, ROUND_UP
+from contextlib import contextmanager
+from functools import partial
 from .base import BaseStorage
-from datetime import datetime
+from .pagination import applyCursor, nextCursor, parseSort
+from .rollup import (
+    AVERAGED, DEFAULT_WEIGHT, HOUR, MINUTE, RAW_FIELDS, Rollup, RollupRebuild,
+    addPercentiles, averageKeyOf, bucketOf, collectRollups, isRolledUp,
+    methodDistributionOf, readsRollups, rollupsOf, sketchesByEndpoint,
+    summaryOf)
+from .timeseries import SeriesQuery, collectSeries
+from ..sketch import LatencySketch, parsePercentiles
 import time
 from sqlalchemy import create_engine, Text
-from sqlalchemy import Column, Integer, Numeric
+from sqlalchemy import BigInteger, Column, Float, Index, Integer, String
+from sqlalchemy import and_, inspect, null, select, text, tuple_
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import func
+from sqlalchemy.orm import defer, scoped_session, sessionmaker
+from sqlalchemy import case, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.functions import FunctionElement
 
 base = declarative_base()
 
 
-def formatDate(timestamp, dateFormat):
-    return datetime.fromtimestamp(timestamp).strftime(dateFormat)
+class wholeSeconds(FunctionElement):
+    """the whole seconds of a time, as an integer"""
+    type = BigInteger()
+    inherit_cache = True
+
+
+@compiles(wholeSeconds)
+def _wholeSeconds(element, compiler, **kwargs):
+    return "CAST(FLOOR({0}) AS BIGINT)".format(
+        compiler.process(element.clauses, **kwargs))
+
+
+@compiles(wholeSeconds, "mysql")
+@compiles(wholeSeconds, "mariadb")
+def _wholeSecondsMysql(element, compiler, **kwargs):
+    return "FLOOR({0})".format(compiler.process(element.clauses, **kwargs))
+
+
+@compiles(wholeSeconds, "sqlite")
+def _wholeSecondsSqlite(element, compiler, **kwargs):
+    # floor() is missing in sqlite builds without the math functions. times
+    # are positive, so truncating is the same.
+    return "CAST({0} AS INTEGER)".format(
+        compiler.process(element.clauses, **kwargs))
+
+
+def bucketExpression(column, query):
+    """
+    the start of the series bucket of the column, which must be in whole
+    seconds, so that the modulo is exact in every database.
+    """
+    shifted = column + query.offset
+    return (shifted - shifted % query.interval - query.offset).label("b")
 
 
 class Measurements(base):
     __tablename__ = 'flask_profiler_measurements'
+    # for paging through the measurements by time
+    __table_args__ = (
+        Index('flask_profiler_measurements_endedAt_id', 'endedAt', 'id'),
+        Index('flask_profiler_measurements_startedAt_id', 'startedAt', 'id'),
+        # ids are not used again, as a rebuild of the rollups adds the
+        # measurements up to an id
+        {"sqlite_autoincrement": True},
+    )
 
     id = Column(Integer, primary_key=True)
-    startedAt = Column(Numeric)
-    endedAt = Column(Numeric)
-    elapsed = Column(Numeric(10, 4))
+    startedAt = Column(Float)
+    endedAt = Column(Float)
+    elapsed = Column(Float)
     method = Column(Text)
     args = Column(Text)
     kwargs = Column(Text)
     name = Column(Text)
     context = Column(Text)
+    cpuTime = Column(Float)
+    userTime = Column(Float)
+    sysTime = Column(Float)
+    weight = Column(Float)
+    queries = Column(Float)
+    dbTime = Column(Float)
+    peakBytes = Column(Float)
+    netBytes = Column(Float)
+    ttfb = Column(Float)
+    ttlb = Column(Float)
+    responseSize = Column(Float)
+    viewTime = Column(Float)
+    # see DETAIL_FIELDS
+    profile = Column(Text)
+    statements = Column(Text)
+    allocations = Column(Text)
 
     def __repr__(self):
         return "<Measurements {}, {}, {}, {}, {}, {}, {}, {}, {}>".format(
@@ -43,6 +110,78 @@ class Measurements(base):
         )
 
 
+# json columns which are only returned by get(), as they may be large
+DETAIL_FIELDS = ("profile", "statements", "allocations")
+# the columns which were stored as decimals by older versions, which cut
+# short measurements down to a tenth of a millisecond
+FLOAT_COLUMNS = ("startedAt", "endedAt", "elapsed")
+# how the type of a column is changed, by dialect
+ALTER_COLUMN = {
+    "mysql": "ALTER TABLE {0} MODIFY {1} {2}",
+    "mariadb": "ALTER TABLE {0} MODIFY {1} {2}",
+    "mssql": "ALTER TABLE {0} ALTER COLUMN {1} {2}",
+}
+
+
+class RollupMixin(object):
+    bucket = Column(Integer, primary_key=True, autoincrement=False)
+    method = Column(String(255), primary_key=True)
+    name = Column(String(255), primary_key=True)
+    count = Column(Float)
+    minElapsed = Column(Float)
+    maxElapsed = Column(Float)
+    sums = Column(Text)
+    sketch = Column(Text)
+
+
+class MinutelyRollups(RollupMixin, base):
+    """aggregates per endpoint and minute"""
+    __tablename__ = 'flask_profiler_rollup_minute'
+
+
+class HourlyRollups(RollupMixin, base):
+    """aggregates per endpoint and hour"""
+    __tablename__ = 'flask_profiler_rollup_hour'
+
+
+ROLLUPS = {MINUTE: MinutelyRollups, HOUR: HourlyRollups}
+
+
+class RebuildProgress(base):
+    """how far the rollups were rebuilt, see RollupRebuild"""
+    __tablename__ = 'flask_profiler_rollup_rebuild'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    lastId = Column(Integer)
+    maxId = Column(Integer)
+
+
+class Spans(base):
+    """the spans of the measurements, see flask_profiler.spans"""
+    __tablename__ = 'flask_profiler_spans'
+
+    measurementId = Column(Integer, primary_key=True, autoincrement=False)
+    order = Column("ord", Integer, primary_key=True, autoincrement=False)
+    parent = Column(Integer)
+    depth = Column(Integer)
+    name = Column(Text)
+    start = Column(Float)
+    elapsed = Column(Float)
+
+
+WEIGHT = func.coalesce(Measurements.weight, DEFAULT_WEIGHT)
+
+
+def weightedAvg(column):
+    # rows where the column is null must not add to the total weight
+    return func.sum(column * WEIGHT) / func.sum(
+        case((column.isnot(None), WEIGHT)))
+
+
+# connection pool options which are passed to create_engine when given
+POOL_OPTIONS = ("pool_size", "max_overflow", "pool_recycle", "pool_timeout")
+
+
 class Sqlalchemy(BaseStorage):
 
     def __init__(self, config=None):
@@ -50,30 +189,157 @@ class Sqlalchemy(BaseStorage):
         self.config = config
         self.db = create_engine(
             self.config.get("db_url", "sqlite:///flask_profiler.sql"),
-            pool_pre_ping=True
+            pool_pre_ping=True,
+            **dict(
+                (key, self.config[key]) for key in POOL_OPTIONS
+                if key in self.config)
         )
+        # sessions are thread-local and closed after each call, which gives
+        # their connection back to the pool
+        self.Session = scoped_session(sessionmaker(bind=self.db))
         self.create_database()
+        self.rollupRebuild = RollupRebuild(
+            self._rebuildStep, self._isRebuilt).start()
 
     def __enter__(self):
         return self
 
+    @contextmanager
+    def _session(self):
+        session = self.Session()
+        try:
+            yield session
+        finally:
+            self.Session.remove()
+
+    def close(self):
+        self.rollupRebuild.stop()
+        self.Session.remove()
+        self.db.dispose()
+
     def create_database(self):
         base.metadata.create_all(self.db)
+        self.migrate_database()
+        try:
+            with self.db.begin() as connection:
+                # the first process to open a storage of an older version
+                # plans the rebuild, the others wait for its progress row
+                connection.execute(RebuildProgress.__table__.insert().values(
+                    id=0, lastId=0, maxId=0))
+                self._planRebuild(connection)
+        except IntegrityError:
+            pass
+
+    def _planRebuild(self, connection):
+        """empties the rollup tables, which are rebuilt up to the last id"""
+        inspector = inspect(connection)
+        for model in ROLLUPS.values():
+            table = model.__table__
+            if "count" in set(
+                    c["name"] for c in inspector.get_columns(table.name)):
+                connection.execute(table.delete())
+            else:
+                # of an older version
+                table.drop(connection)
+                table.create(connection)
+        maxId = connection.execute(
+            select(func.max(Measurements.__table__.c.id))).scalar()
+        connection.execute(RebuildProgress.__table__.update().values(
+            lastId=0, maxId=maxId or 0))
+
+    def _rebuildStep(self, batchSize=10000):
+        """
+        adds the next batch of measurements to the rollups being rebuilt.
+        :return: True if the rollups are complete
+        """
+        table = Measurements.__table__
+        with self.db.begin() as connection:
+            lastId, maxId = self._lockProgress(connection)
+            if lastId >= maxId:
+                return True
+            rows = connection.execute(
+                select(table.c.id, *Sqlalchemy._rawColumns()).where(
+                    table.c.id > lastId, table.c.id <= maxId
+                ).order_by(table.c.id).limit(batchSize)).fetchall()
+            self._updateRollups(
+                connection, [Sqlalchemy._rawRow(r[1:]) for r in rows])
+            lastId = rows[-1][0] if len(rows) == batchSize else maxId
+            connection.execute(
+                RebuildProgress.__table__.update().values(lastId=lastId))
+            return lastId >= maxId
 
-    def insert(self, kwds):
-        endedAt = int(kwds.get('endedAt', None))
-        startedAt = int(kwds.get('startedAt', None))
-        elapsed = Decimal(kwds.get('elapsed', None))
-        if elapsed:
-            elapsed = elapsed.quantize(Decimal('.0001'), rounding=ROUND_UP)
+    @staticmethod
+    def _lockProgress(connection):
+        """
+        :return: (lastId, maxId) of the rebuild of the rollups, locked until
+            the transaction ends
+        """
+        progress = RebuildProgress.__table__
+        # sqlite ignores FOR UPDATE, the update takes its write lock
+        connection.execute(progress.update().values(lastId=progress.c.lastId))
+        return tuple(connection.execute(
+            select(progress.c.lastId, progress.c.maxId).with_for_update()
+        ).first())
+
+    def _isRebuilt(self):
+        progress = RebuildProgress.__table__
+        with self.db.connect() as connection:
+            lastId, maxId = connection.execute(
+                select(progress.c.lastId, progress.c.maxId)).first()
+        return lastId >= maxId
+
+    def rebuild_rollups(self, batchSize=10000):
+        """builds the rollup tables again from the stored measurements"""
+        with self.db.begin() as connection:
+            self._planRebuild(connection)
+        while not self._rebuildStep(batchSize):
+            pass
+
+    def migrate_database(self):
+        """
+        adds the columns which are missing in tables of older versions and
+        turns their decimal times into floats
+        """
+        table = Measurements.__table__
+        columns = dict(
+            (c["name"], c["type"])
+            for c in inspect(self.db).get_columns(table.name))
+        missing = [c for c in table.columns if c.name not in columns]
+        # sqlite stores whatever it is given in any column
+        changed = [] if self.db.dialect.name == "sqlite" else [
+            table.c[name] for name in FLOAT_COLUMNS
+            if not isinstance(columns[name], Float)]
+        for index in table.indexes:
+            index.create(self.db, checkfirst=True)
+        if not missing and not changed:
+            return
+        preparer = self.db.dialect.identifier_preparer
+        alter = ALTER_COLUMN.get(
+            self.db.dialect.name, "ALTER TABLE {0} ALTER COLUMN {1} TYPE {2}")
+        with self.db.begin() as connection:
+            for column in missing:
+                connection.execute(text(
+                    "ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+                        preparer.format_table(table),
+                        preparer.format_column(column),
+                        column.type.compile(dialect=self.db.dialect))))
+            for column in changed:
+                connection.execute(text(alter.format(
+                    preparer.format_table(table),
+                    preparer.format_column(column),
+                    column.type.compile(dialect=self.db.dialect))))
+
+    @staticmethod
+    def _toRow(kwds):
+        endedAt = float(kwds.get('endedAt', None))
+        startedAt = float(kwds.get('startedAt', None))
+        elapsed = float(kwds.get('elapsed', None))
         args = json.dumps(list(kwds.get('args', ())))  # tuple -> list -> json
         kwargs = json.dumps(kwds.get('kwargs', ()))
         context = json.dumps(kwds.get('context', {}))
         method = kwds.get('method', None)
         name = kwds.get('name', None)
-
-        session = sessionmaker(self.db)()
-        session.add(Measurements(
+        row = dict(
             endedAt=endedAt,
             startedAt=startedAt,
             elapsed=elapsed,
@@ -82,13 +348,147 @@ class Sqlalchemy(BaseStorage):
             context=context,
             method=method,
             name=name,
-        ))
-        session.commit()
+            cpuTime=kwds.get('cpuTime', None),
+            userTime=kwds.get('userTime', None),
+            sysTime=kwds.get('sysTime', None),
+            weight=kwds.get('weight', 1),
+            queries=kwds.get('queries', None),
+            dbTime=kwds.get('dbTime', None),
+            peakBytes=kwds.get('peakBytes', None),
+            netBytes=kwds.get('netBytes', None),
+            ttfb=kwds.get('ttfb', None),
+            ttlb=kwds.get('ttlb', None),
+            responseSize=kwds.get('responseSize', None),
+            viewTime=kwds.get('viewTime', None),
+        )
+        for field in DETAIL_FIELDS:
+            value = kwds.get(field, None)
+            row[field] = None if value is None else json.dumps(value)
+        return row
+
+    def insert(self, kwds):
+        self.insert_many([kwds])
+
+    def insert_many(self, measurements):
+        rows = [Sqlalchemy._toRow(kwds) for kwds in measurements]
+        if not rows:
+            return
+        # a Core INSERT in one transaction instead of a unit-of-work flush
+        # and a commit per measurement
+        table = Measurements.__table__
+        with self.db.begin() as connection:
+            # the rows are inserted in batches, except those with spans
+            # which need the id of their measurement
+            batch = []
+            for row, measurement in zip(rows, measurements):
+                spans = measurement.get("spans", None)
+                if not spans:
+                    batch.append(row)
+                    continue
+                if batch:
+                    connection.execute(table.insert(), batch)
+                    batch = []
+                measurementId = connection.execute(
+                    table.insert(), row).inserted_primary_key[0]
+                connection.execute(Spans.__table__.insert(), [
+                    {"measurementId": measurementId, "ord": s["order"],
+                     "parent": s["parent"], "depth": s["depth"],
+                     "name": s["name"], "start": s["start"],
+                     "elapsed": s["elapsed"]}
+                    for s in spans])
+            if batch:
+                connection.execute(table.insert(), batch)
+            self._updateRollups(connection, measurements)
+
+    def _updateRollups(self, connection, measurements, sign=1):
+        """merges the given measurements into the rollup rows"""
+        for granularity, model in ROLLUPS.items():
+            table = model.__table__
+            for (bucket, method, name), rollup in rollupsOf(
+                    measurements, granularity, sign).items():
+                condition = and_(
+                    table.c.bucket == bucket,
+                    table.c.method == method,
+                    table.c.name == name)
+                row = self._lockRollup(connection, table, condition)
+                if row is None:
+                    try:
+                        # in a savepoint, so that a conflict does not roll
+                        # back the measurements
+                        with connection.begin_nested():
+                            connection.execute(table.insert(), dict(
+                                bucket=bucket, method=method, name=name,
+                                **Sqlalchemy._rollupValues(rollup)))
+                        continue
+                    except IntegrityError:
+                        # another writer inserted the row meanwhile; FOR
+                        # UPDATE can not lock a row which does not exist
+                        row = self._lockRollup(connection, table, condition)
+                rollup.merge(Rollup.fromRow(*row))
+                connection.execute(table.update().where(condition).values(
+                    **Sqlalchemy._rollupValues(rollup)))
+
+    @staticmethod
+    def _lockRollup(connection, table, condition):
+        """:return: the rollup row locked until the transaction ends, or None"""
+        return connection.execute(
+            select(
+                table.c.count, table.c.minElapsed, table.c.maxElapsed,
+                table.c.sums, table.c.sketch
+            ).where(condition).with_for_update()
+        ).first()
+
+    @staticmethod
+    def _rollupValues(rollup):
+        return dict(zip(
+            ("count", "minElapsed", "maxElapsed", "sums", "sketch"),
+            rollup.toRow()))
+
+    def _readRollups(self, granularity, startedAt, endedAt):
+        """:return: list of (bucket, method, name, Rollup)"""
+        table = ROLLUPS[granularity].__table__
+        with self.db.connect() as connection:
+            rows = connection.execute(
+                select(
+                    table.c.bucket, table.c.method, table.c.name,
+                    table.c.count, table.c.minElapsed, table.c.maxElapsed,
+                    table.c.sums, table.c.sketch
+                ).where(
+                    table.c.bucket >= startedAt,
+                    table.c.bucket < endedAt)
+            ).fetchall()
+        return [tuple(r[:3]) + (Rollup.fromRow(*r[3:]), ) for r in rows]
+
+    @staticmethod
+    def _rawColumns():
+        table = Measurements.__table__
+        return tuple(table.c[field] for field in RAW_FIELDS)
+
+    @staticmethod
+    def _rawRow(row):
+        return dict(zip(RAW_FIELDS, row))
+
+    def _readRaw(self, startedAt, endedAt):
+        """:return: the measurements started in [startedAt, endedAt)"""
+        table = Measurements.__table__
+        with self.db.connect() as connection:
+            rows = connection.execute(
+                select(*Sqlalchemy._rawColumns()).where(
+                    table.c.startedAt >= startedAt,
+                    table.c.startedAt < endedAt)
+            ).fetchall()
+        return [Sqlalchemy._rawRow(row) for row in rows]
+
+    def _collectRollups(self, filters):
+        return collectRollups(
+            filters["startedAt"], filters["endedAt"],
+            self._readRollups, self._readRaw,
+            self.rollupRebuild.granularities())
 
     @staticmethod
     def getFilters(kwargs):
         filters = {}
-        filters["sort"] = kwargs.get('sort', "endedAt,desc").split(",")
+        filters["sort"] = parseSort(kwargs.get('sort', "endedAt,desc"))
 
         # because inserting and filtering may take place at the same moment,
         # a very little increment(0.5) is needed to find inserted
@@ -104,16 +504,22 @@ class Sqlalchemy(BaseStorage):
         filters["args"] = json.dumps(
             list(kwargs.get('args', ())))  # tuple -> list -> json
         filters["kwargs"] = json.dumps(kwargs.get('kwargs', ()))
-        filters["sort"] = kwargs.get('sort', "endedAt,desc").split(",")
+        filters["sort"] = parseSort(kwargs.get('sort', "endedAt,desc"))
         filters["skip"] = int(kwargs.get('skip', 0))
         filters["limit"] = int(kwargs.get('limit', 100))
-        return filters
+        return applyCursor(filters, kwargs)
 
     def filter(self, kwds={}):
         # Find Operation
         f = Sqlalchemy.getFilters(kwds)
-        session = sessionmaker(self.db)()
-        query = session.query(Measurements)
+        with self._session() as session:
+            rows = self._filter(session, f)
+            rows = [Sqlalchemy.jsonify_row(row) for row in rows]
+        return (row for row in rows)
+
+    def _filter(self, session, f):
+        query = session.query(Measurements).options(*[
+            defer(getattr(Measurements, field)) for field in DETAIL_FIELDS])
 
         if f["endedAt"]:
             query = query.filter(Measurements.endedAt <= f["endedAt"])
@@ -126,12 +532,27 @@ class Sqlalchemy(BaseStorage):
         if f["name"]:
             query = query.filter(Measurements.name == f["name"])
 
+        if f["sort"][0] not in Measurements.__table__.c:
+            raise ValueError("invalid sort: {0}".format(",".join(f["sort"])))
+        column = getattr(Measurements, f["sort"][0])
+        if f["cursor"] is not None:
+            # seek past the last row of the previous page on the index
+            value, lastId = f["cursor"]
+            key, last = tuple_(column, Measurements.id), tuple_(value, lastId)
+            if f["sort"][1] == 'desc':
+                query = query.filter(key < last)
+            else:
+                query = query.filter(key > last)
+
         if f["sort"][1] == 'desc':
-            query = query.order_by(getattr(Measurements, f["sort"][0]).desc())
+            query = query.order_by(column.desc(), Measurements.id.desc())
         else:
-            query = query.order_by(getattr(Measurements, f["sort"][0]).asc())
-        rows = query.limit(f['limit']).offset(f['skip'])
-        return (Sqlalchemy.jsonify_row(row) for row in rows)
+            query = query.order_by(column.asc(), Measurements.id.asc())
+        return query.limit(f['limit']).offset(f['skip']).all()
+
+    def paginate(self, kwds={}):
+        rows = list(self.filter(kwds))
+        return rows, nextCursor(Sqlalchemy.getFilters(kwds), rows)
 
     @staticmethod
     def jsonify_row(row):
@@ -145,43 +566,165 @@ class Sqlalchemy(BaseStorage):
             "kwargs": json.loads(row.kwargs),
             "name": row.name,
             "context": json.loads(row.context),
+            "cpuTime": row.cpuTime,
+            "userTime": row.userTime,
+            "sysTime": row.sysTime,
+            "weight": row.weight,
+            "queries": row.queries,
+            "dbTime": row.dbTime,
+            "peakBytes": row.peakBytes,
+            "netBytes": row.netBytes,
+            "ttfb": row.ttfb,
+            "ttlb": row.ttlb,
+            "responseSize": row.responseSize,
+            "viewTime": row.viewTime,
         }
         return data
 
+    def get(self, measurementId):
+        with self._session() as session:
+            row = session.query(Measurements).filter_by(
+                id=int(measurementId)).first()
+            if row is None:
+                return None
+            data = Sqlalchemy.jsonify_row(row)
+            for field in DETAIL_FIELDS:
+                value = getattr(row, field)
+                data[field] = None if value is None else json.loads(value)
+            data["spans"] = [
+                {"order": s.order, "parent": s.parent, "depth": s.depth,
+                 "name": s.name, "start": s.start, "elapsed": s.elapsed}
+                for s in session.query(Spans).filter_by(
+                    measurementId=row.id).order_by(Spans.order)]
+        return data
+
     def truncate(self):
-        session = sessionmaker(self.db)()
-        try:
-            session.query(Measurements).delete()
-            session.commit()
-            return True
-        except:
-            session.rollback()
-            return False
+        with self._session() as session:
+            try:
+                for model in ROLLUPS.values():
+                    session.query(model).delete()
+                session.query(RebuildProgress).update(
+                    {"lastId": 0, "maxId": 0})
+                session.query(Spans).delete()
+                session.query(Measurements).delete()
+                session.commit()
+                return True
+            except:
+                session.rollback()
+                return False
+
+    def _deleteMany(self, session, measurementIds):
+        """deletes the measurements and takes them out of the rollups"""
+        table = Measurements.__table__
+        connection = session.connection()
+        lastId, maxId = self._lockProgress(connection)
+        rows = connection.execute(
+            select(table.c.id, *Sqlalchemy._rawColumns()).where(
+                table.c.id.in_(measurementIds))
+        ).fetchall()
+        if not rows:
+            return
+        self._updateRollups(
+            connection, [
+                Sqlalchemy._rawRow(row[1:]) for row in rows
+                if isRolledUp(row[0], lastId, maxId)],
+            sign=-1)
+        connection.execute(
+            table.delete().where(table.c.id.in_(measurementIds)))
+        spans = Spans.__table__
+        connection.execute(
+            spans.delete().where(spans.c.measurementId.in_(measurementIds)))
+        # the rollups of the buckets which are left empty
+        startedAt = [row[3] for row in rows]
+        for granularity, model in ROLLUPS.items():
+            rollups = model.__table__
+            connection.execute(rollups.delete().where(
+                rollups.c.bucket >= bucketOf(min(startedAt), granularity),
+                rollups.c.bucket <= bucketOf(max(startedAt), granularity),
+                rollups.c.count < 0.5))
 
     def delete(self, measurementId):
-        session = sessionmaker(self.db)()
-        try:
-            session.query(Measurements).filter_by(id=measurementId).delete()
-            session.commit()
-            return True
-        except:
-            session.rollback()
-            return False
+        with self._session() as session:
+            try:
+                self._deleteMany(session, [measurementId])
+                session.commit()
+                return True
+            except:
+                session.rollback()
+                return False
+
+    def _expiredIds(self, connection, maxAge, maxRowsPerEndpoint, batchSize):
+        """:return: the ids of at most batchSize measurements to prune"""
+        table = Measurements.__table__
+        if maxAge is not None:
+            ids = connection.execute(
+                select(table.c.id).where(
+                    table.c.endedAt < time.time() - float(maxAge)
+                ).order_by(table.c.endedAt).limit(batchSize)
+            ).scalars().all()
+            if ids:
+                return ids
+        ids = []
+        if maxRowsPerEndpoint is None:
+            return ids
+        count = func.count(table.c.id)
+        endpoints = connection.execute(
+            select(table.c.method, table.c.name, count).group_by(
+                table.c.method, table.c.name
+            ).having(count > int(maxRowsPerEndpoint))
+        ).fetchall()
+        for method, name, total in endpoints:
+            ids.extend(connection.execute(
+                select(table.c.id).where(
+                    table.c.method == method, table.c.name == name
+                ).order_by(table.c.id).limit(
+                    min(total - int(maxRowsPerEndpoint),
+                        batchSize - len(ids)))
+            ).scalars().all())
+            if len(ids) >= batchSize:
+                break
+        return ids
+
+    def prune(self, maxAge=None, maxRowsPerEndpoint=None, batchSize=1000):
+        with self._session() as session:
+            try:
+                ids = self._expiredIds(
+                    session.connection(), maxAge, maxRowsPerEndpoint,
+                    batchSize)
+                if ids:
+                    self._deleteMany(session, ids)
+                session.commit()
+                return len(ids)
+            except:
+                session.rollback()
+                raise
 
     def getSummary(self, kwds={}):
         filters = Sqlalchemy.getFilters(kwds)
-        session = sessionmaker(self.db)()
-        count = func.count(Measurements.id).label('count')
+        filters["sort"] = kwds.get('sort', "count,desc").split(",")
+        percentiles = parsePercentiles(kwds.get("percentiles", None))
+        if readsRollups(filters):
+            return summaryOf(
+                self._collectRollups(filters), percentiles, filters["sort"])
+        with self._session() as session:
+            return self._rawSummary(session, filters, percentiles)
+
+    def _rawSummary(self, session, filters, percentiles):
+        count = func.sum(WEIGHT).label('count')
         min_elapsed = func.min(Measurements.elapsed).label('minElapsed')
         max_elapsed = func.max(Measurements.elapsed).label('maxElapsed')
-        avg_elapsed = func.avg(Measurements.elapsed).label('avgElapsed')
+        averages = [
+            weightedAvg(getattr(Measurements, field)).label(
+                averageKeyOf(field))
+            for field in AVERAGED]
+        avg_elapsed = averages[0]
         query = session.query(
             Measurements.method,
             Measurements.name,
             count,
             min_elapsed,
             max_elapsed,
-            avg_elapsed
+            *averages
         )
 
         if filters["startedAt"]:
@@ -220,76 +763,80 @@ class Sqlalchemy(BaseStorage):
 
         result = []
         for r in rows:
-            result.append({
+            row = {
                 "method": r[0],
                 "name": r[1],
-                "count": r[2],
+                "count": int(round(r[2])),
                 "minElapsed": r[3],
-                "maxElapsed": r[4],
-                "avgElapsed": r[5]
-            })
-        return result
+                "maxElapsed": r[4]
+            }
+            for field, value in zip(AVERAGED, r[5:]):
+                row[averageKeyOf(field)] = value
+            result.append(row)
+
+        rows = query.with_entities(
+            Measurements.method,
+            Measurements.name,
+            Measurements.elapsed,
+            WEIGHT
+        ).group_by(None).order_by(None).all()
+        return addPercentiles(result, sketchesByEndpoint(rows), percentiles)
+
+    def _readSeriesRollups(self, query, percentiles, granularity,
+                           startedAt, endedAt):
+        table = ROLLUPS[granularity].__table__
+        bucket = bucketExpression(table.c.bucket, query)
+        if percentiles:
+            statement = select(bucket, table.c.count, table.c.sketch)
+        else:
+            statement = select(
+                bucket, func.sum(table.c.count), null()
+            ).group_by(bucket)
+        statement = statement.where(
+            table.c.bucket >= startedAt,
+            table.c.bucket < endedAt
+        ).order_by(bucket)
+        with self.db.connect() as connection:
+            rows = connection.execute(statement).fetchall()
+        if percentiles:
+            return [
+                (r[0], r[1], LatencySketch.fromJson(json.loads(r[2])))
+                for r in rows]
+        return rows
+
+    def _readSeriesRaw(self, query, percentiles, startedAt, endedAt):
+        table = Measurements.__table__
+        bucket = bucketExpression(wholeSeconds(table.c.startedAt), query)
+        weight = func.coalesce(table.c.weight, DEFAULT_WEIGHT)
+        if percentiles:
+            statement = select(bucket, weight, table.c.elapsed)
+        else:
+            statement = select(
+                bucket, func.sum(weight), null()
+            ).group_by(bucket)
+        statement = statement.where(
+            table.c.startedAt >= startedAt,
+            table.c.startedAt < endedAt
+        ).order_by(bucket)
+        with self.db.connect() as connection:
+            return connection.execute(statement).fetchall()
 
     def getTimeseries(self, kwds={}):
         filters = Sqlalchemy.getFilters(kwds)
-        session = sessionmaker(self.db)()
-        if kwds.get('interval', None) == "daily":
-            interval = 3600 * 24   # daily
-            dateFormat = "%Y-%m-%d"
-            format = "day"
-        else:
-            interval = 3600  # hourly
-            dateFormat = "%Y-%m-%d %H"
-            format = "hour"
-        endedAt, startedAt = filters["endedAt"], filters["startedAt"]
-
-        rows = session.query(
-            Measurements.startedAt,
-        ).filter(
-            Measurements.endedAt <= endedAt,
-            Measurements.startedAt >= startedAt
-        ).order_by(
-            Measurements.startedAt.asc()
-        ).all()
-
-        rows = [datetime.utcfromtimestamp(row[0]).strftime(dateFormat) for row in rows]
-        temp = set(rows)
-        rows = [(time, rows.count(time)) for time in temp]
-        series = {}
-
-        for i in range(int(startedAt), int(endedAt) + 1, interval):
-            series[formatDate(i, dateFormat)] = 0
-
-        for row in rows:
-            series[
-                formatDate(
-                    datetime.strptime(row[0], dateFormat).timestamp(),
-                    dateFormat
-                )
-            ] = row[1]
-        return series
+        query = SeriesQuery(kwds, filters["startedAt"], filters["endedAt"])
+        percentiles = kwds.get('percentiles', None)
+        percentiles = parsePercentiles(percentiles) if percentiles else None
+        return collectSeries(
+            query,
+            partial(self._readSeriesRollups, query, percentiles),
+            partial(self._readSeriesRaw, query, percentiles),
+            percentiles, self.rollupRebuild.granularities())
 
     def getMethodDistribution(self, kwds=None):
         if not kwds:
             kwds = {}
         f = Sqlalchemy.getFilters(kwds)
-        session = sessionmaker(self.db)()
-        endedAt, startedAt = f["endedAt"], f["startedAt"]
-
-        rows = session.query(
-            Measurements.method,
-            func.count(Measurements.id)
-        ).filter(
-            Measurements.endedAt <= endedAt,
-            Measurements.startedAt >= startedAt
-        ).group_by(
-            Measurements.method
-        ).all()
-
-        results = {}
-        for row in rows:
-            results[row[0]] = row[1]
-        return results
+        return methodDistributionOf(self._collectRollups(f))
 
     def __exit__(self, exc_type, exc_value, traceback):
         return self.db
@@ -1,24 +1,169 @@
+import os
 import sqlite3
 import json
+from functools import lru_cache, partial
 from .base import BaseStorage
-from datetime import datetime
+from .pagination import applyCursor, nextCursor, parseSort
+from .rollup import (
+    AVERAGED, DEFAULT_WEIGHT, HOUR, MINUTE, RAW_FIELDS, Rollup, RollupRebuild,
+    bucketOf, collectRollups, isRolledUp, methodDistributionOf, readsRollups,
+    rollupsOf, summaryOf)
+from .timeseries import SeriesQuery, collectSeries
+from ..sketch import LatencySketch, parsePercentiles
 from timeit import default_timer
 import time
 # from time import perf_counter
 import threading
+from queue import Empty, Queue
+from urllib.request import pathname2url
+
+
+WEIGHT = "coalesce(weight, {0!r})".format(DEFAULT_WEIGHT)
+# the columns which were added to the measurements table after its first
+# version, they are added to older tables when they are opened
+ADDED_COLUMNS = (
+    ("cpuTime", "REAL"), ("userTime", "REAL"), ("sysTime", "REAL"),
+    ("weight", "REAL"), ("profile", "TEXT"), ("queries", "REAL"),
+    ("dbTime", "REAL"), ("statements", "TEXT"), ("peakBytes", "REAL"),
+    ("netBytes", "REAL"), ("allocations", "TEXT"), ("ttfb", "REAL"),
+    ("ttlb", "REAL"), ("responseSize", "REAL"), ("viewTime", "REAL"))
+# the columns of the measurements table after ID, in the order of _toRow
+COLUMNS = (
+    "startedAt", "endedAt", "elapsed", "args", "kwargs", "method", "context",
+    "name") + tuple(column for column, type in ADDED_COLUMNS)
+# columns which are only returned by get(), as they may be large
+DETAIL_COLUMNS = ("profile", "statements", "allocations")
+# columns which are stored as json
+JSON_COLUMNS = ("args", "kwargs", "context") + DETAIL_COLUMNS
+LIST_COLUMNS = "ID, " + ", ".join(
+    column for column in COLUMNS if column not in DETAIL_COLUMNS)
+ALL_COLUMNS = "ID, " + ", ".join(COLUMNS)
+# the columns the rollups are built from, see Sqlite._rawRow
+RAW_COLUMNS = ", ".join(RAW_FIELDS)
+
+# guards restarting the writers in a forked process. a lock which another
+# thread of the parent held while forking stays held in the child, so the
+# child gets a new one.
+_forkLock = threading.Lock()
+
+
+def _newForkLock():
+    global _forkLock
+    _forkLock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_newForkLock)
+
+
+def bucketExpression(column):
+    """
+    the start of the series bucket of the column, in integer arithmetic.
+    the offset and the interval are bound as :offset and :interval.
+    """
+    return "((CAST({0} AS INTEGER) + :offset) / :interval) * :interval" \
+        " - :offset".format(column)
+
+
+# the columns measurements can be sorted by, and their names in the table
+SORT_COLUMNS = dict(
+    [("id", "ID")] +
+    [(column, column)
+     for column in ("startedAt", "endedAt", "method", "name") + AVERAGED])
+
+
+def sortOf(sort):
+    """:return: (column, direction) of a sort filter such as [elapsed, desc]"""
+    field = sort[0]
+    direction = sort[1].lower() if len(sort) > 1 else "desc"
+    if field not in SORT_COLUMNS or direction not in ("asc", "desc"):
+        raise ValueError("invalid sort: {0}".format(",".join(sort)))
+    return SORT_COLUMNS[field], direction
+
+
+def conditionsOf(filters, endpoint=True, seek=True):
+    """
+    builds the WHERE clause of the filters. only the presence of a filter
+    changes the text of the clause, the values are bound as parameters, so
+    that the statement is prepared once and then found in the cache of the
+    connection.
+    :return: (tuple of conditions, list of parameters)
+    """
+    conditions = ["startedAt>=?", "endedAt<=?"]
+    params = [float(filters["startedAt"]), float(filters["endedAt"])]
+    if filters.get("elapsed", None):
+        conditions.append("elapsed>=?")
+        params.append(float(filters["elapsed"]))
+    if endpoint and filters.get("method", None):
+        conditions.append("method=?")
+        params.append(filters["method"])
+    if endpoint and filters.get("name", None):
+        conditions.append("name=?")
+        params.append(filters["name"])
+    if seek and filters.get("cursor", None) is not None:
+        # seek past the last row of the previous page on the index
+        column, direction = sortOf(filters["sort"])
+        operator = "<" if direction == "desc" else ">"
+        value, lastId = filters["cursor"]
+        if column == "ID":
+            conditions.append("ID{0}?".format(operator))
+            params.append(lastId)
+        else:
+            conditions.append("({0}, ID){1}(?, ?)".format(column, operator))
+            params.extend((value, lastId))
+    return tuple(conditions), params
+
+
+@lru_cache(maxsize=256)
+def selectSql(table_name, columns, conditions, orderBy=None, paged=False):
+    """:return: the text of a SELECT, built once for every shape"""
+    sql = 'SELECT {0} FROM "{1}" WHERE {2}'.format(
+        columns, table_name, " AND ".join(conditions))
+    if orderBy:
+        sql += " ORDER BY " + orderBy
+    if paged:
+        sql += " LIMIT ? OFFSET ?"
+    return sql
 
 
-def formatDate(timestamp, dateFormat):
-    return datetime.fromtimestamp(timestamp).strftime(dateFormat)
+class _Job(object):
+    """a function which the writer thread runs for a caller"""
+    __slots__ = ("function", "args", "result", "error", "done")
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
 
 
 class Sqlite(BaseStorage):
-    """docstring for Sqlite"""
+    """
+    every write is run by a single writer thread, which commits the writes
+    queued at the same moment in one transaction. reads use a read-only
+    connection per thread, so in WAL mode they do not wait for the writer.
+    """
+    # the most writes committed in one transaction
+    MAX_GROUP = 256
+    # the most ids bound to one statement
+    MAX_PARAMS = 500
+    # the most pages compact() gives back to the file system in one job
+    VACUUM_PAGES = 1000
+
     def __init__(self, config=None):
         super(Sqlite, self).__init__()
         self.config = config
         self.sqlite_file = self.config.get("FILE", "flask_profiler.sql")
         self.table_name = self.config.get("TABLE", "measurements")
+        # aggregates per endpoint and minute or hour
+        self.rollup_table_names = {
+            MINUTE: self.table_name + "_rollup_minute",
+            HOUR: self.table_name + "_rollup_hour"}
+        # how far the rollups were rebuilt, see RollupRebuild
+        self.rebuild_table_name = self.table_name + "_rollup_rebuild"
+        # the spans of the measurements, see flask_profiler.spans
+        self.span_table_name = self.table_name + "_spans"
 
         self.startedAt_head = 'startedAt'  # name of the column
         self.endedAt_head = 'endedAt'  # name of the column
@@ -28,25 +173,193 @@ class Sqlite(BaseStorage):
         self.kwargs_head = 'kwargs'
         self.name_head = 'name'
         self.context_head = 'context'
-
-        self.connection = sqlite3.connect(
-            self.sqlite_file, check_same_thread=False)
+        self.cpuTime_head = 'cpuTime'
+        self.userTime_head = 'userTime'
+        self.sysTime_head = 'sysTime'
+        self.weight_head = 'weight'
+
+        # an in-memory database can not be shared between connections
+        self.inMemory = self.sqlite_file == ":memory:" or \
+            "mode=memory" in self.sqlite_file
+        self.connection = self._connect()
         self.cursor = self.connection.cursor()
 
         self.lock = threading.Lock()
+        self.autoVacuum = self.set_auto_vacuum()
         try:
             self.create_database()
         except sqlite3.OperationalError as e:
             if "already exists" not in str(e):
                 raise e
+        self.migrate_database()
+        self.create_indexes()
+        self.create_rollup_tables()
+        self.create_span_table()
+
+        self.closed = False
+        # connections inherited from the parent of a forked process, which
+        # must neither be used nor closed there
+        self.inherited = []
+        self._startWriter()
+        self.rollupRebuild = RollupRebuild(
+            lambda: self._submit(self._rebuildStep),
+            self._isRebuilt).start()
+
+    def _startWriter(self):
+        self.pid = os.getpid()
+        self.jobs = Queue()
+        self.local = threading.local()
+        self.readers = {}
+        self.readersLock = threading.Lock()
+        self.writer = threading.Thread(
+            target=self._writeLoop, name="flask-profiler-sqlite-writer")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def _checkFork(self):
+        """
+        a process forked after the storage was created, e.g. a worker of a
+        pre-fork server, has neither the writer thread nor usable
+        connections; they are started again in it.
+        """
+        if self.pid == os.getpid() or self.closed:
+            return
+        with _forkLock:
+            if self.pid == os.getpid():
+                return
+            self.lock = threading.Lock()
+            if not self.inMemory:
+                self.inherited.append(self.connection)
+                self.inherited.extend(self.readers.values())
+                self.connection = self._connect()
+                self.cursor = self.connection.cursor()
+            self._startWriter()
 
     def __enter__(self):
         return self
 
+    def _connect(self, readOnly=False):
+        if readOnly:
+            connection = sqlite3.connect(
+                "file:{0}?mode=ro".format(
+                    pathname2url(os.path.abspath(self.sqlite_file))),
+                uri=True, check_same_thread=False)
+        else:
+            connection = sqlite3.connect(
+                self.sqlite_file, check_same_thread=False,
+                uri=self.sqlite_file.startswith("file:"))
+            if not self.inMemory:
+                connection.execute("PRAGMA journal_mode={0}".format(
+                    self.config.get("JOURNAL_MODE", "WAL")))
+            connection.execute("PRAGMA synchronous={0}".format(
+                self.config.get("SYNCHRONOUS", "NORMAL")))
+        # negative sizes are in KiB
+        connection.execute("PRAGMA cache_size={0:d}".format(
+            int(self.config.get("CACHE_SIZE", -16000))))
+        connection.execute("PRAGMA mmap_size={0:d}".format(
+            int(self.config.get("MMAP_SIZE", 0))))
+        return connection
+
+    def _reader(self):
+        """:return: the read-only connection of the calling thread"""
+        self._checkFork()
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self._connect(readOnly=True)
+            with self.readersLock:
+                # sqlite connections can not be weakly referenced, so those of
+                # finished threads are closed here
+                for thread, reader in list(self.readers.items()):
+                    if not thread.is_alive():
+                        reader.close()
+                        del self.readers[thread]
+                self.readers[threading.current_thread()] = connection
+        return connection
+
+    def _read(self, sql, params=()):
+        """:return: all rows of the query"""
+        if self.inMemory:
+            return self._submit(
+                lambda cursor: cursor.execute(sql, params).fetchall())
+        return self._reader().execute(sql, params).fetchall()
+
+    def _submit(self, function, *args):
+        """runs function(cursor, *args) on the writer thread and waits for it"""
+        if self.closed:
+            raise Exception("the sqlite storage is closed")
+        self._checkFork()
+        job = _Job(function, args)
+        self.jobs.put(job)
+        while not job.done.wait(1):
+            if not self.writer.is_alive():
+                raise Exception("the sqlite writer thread is not running")
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _writeLoop(self):
+        while True:
+            jobs = [self.jobs.get()]
+            while len(jobs) < Sqlite.MAX_GROUP:
+                try:
+                    jobs.append(self.jobs.get_nowait())
+                except Empty:
+                    break
+            stop = None in jobs
+            jobs = [job for job in jobs if job is not None]
+            if jobs:
+                self._runJobs(jobs)
+            if stop:
+                self.connection.close()
+                return
+
+    def _runJobs(self, jobs):
+        """runs the given jobs in one transaction, each in a savepoint"""
+        cursor = self.cursor
+        try:
+            cursor.execute("BEGIN")
+            for job in jobs:
+                cursor.execute("SAVEPOINT job")
+                try:
+                    job.result = job.function(cursor, *job.args)
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO job")
+                    job.error = e
+                cursor.execute("RELEASE job")
+            self.connection.commit()
+        except Exception as e:
+            # e.g. the disk is full, none of the jobs is stored
+            try:
+                self.connection.rollback()
+            except sqlite3.Error:
+                pass
+            for job in jobs:
+                if job.error is None:
+                    job.error = e
+        finally:
+            for job in jobs:
+                job.done.set()
+
+    def close(self):
+        """stops the writer after the queued writes and closes the readers"""
+        if self.closed:
+            return
+        self.rollupRebuild.stop()
+        self.closed = True
+        if self.pid != os.getpid():
+            # the writer and the readers belong to the parent
+            return
+        self.jobs.put(None)
+        self.writer.join()
+        with self.readersLock:
+            for reader in self.readers.values():
+                reader.close()
+            self.readers = {}
+
     @staticmethod
     def getFilters(kwargs):
         filters = {}
-        filters["sort"] = kwargs.get('sort', "endedAt,desc").split(",")
+        filters["sort"] = parseSort(kwargs.get('sort', "endedAt,desc"))
 
         # because inserting and filtering may take place at the same moment,
         # a very little increment(0.5) is needed to find inserted
@@ -62,10 +375,33 @@ class Sqlite(BaseStorage):
         filters["args"] = json.dumps(
             list(kwargs.get('args', ())))  # tuple -> list -> json
         filters["kwargs"] = json.dumps(kwargs.get('kwargs', ()))
-        filters["sort"] = kwargs.get('sort', "endedAt,desc").split(",")
+        filters["sort"] = parseSort(kwargs.get('sort', "endedAt,desc"))
         filters["skip"] = int(kwargs.get('skip', 0))
         filters["limit"] = int(kwargs.get('limit', 100))
-        return filters
+        return applyCursor(filters, kwargs)
+
+    def set_auto_vacuum(self):
+        """
+        new files are created with incremental vacuum, so that compact() can
+        shrink them. existing files are converted by a full VACUUM only if
+        AUTO_VACUUM is given.
+        :return: the auto_vacuum mode of the file, 2 is incremental
+        """
+        modes = {"NONE": 0, "FULL": 1, "INCREMENTAL": 2}
+        mode = modes[self.config.get("AUTO_VACUUM", "INCREMENTAL").upper()]
+        with self.lock:
+            current = self.cursor.execute("PRAGMA auto_vacuum").fetchone()[0]
+            if current == mode:
+                return current
+            isEmpty = self.cursor.execute(
+                "SELECT count(*) FROM sqlite_master").fetchone()[0] == 0
+            if not isEmpty and "AUTO_VACUUM" not in self.config:
+                return current
+            self.cursor.execute("PRAGMA auto_vacuum={0:d}".format(mode))
+            # a file in wal mode already has a header, which only a vacuum
+            # rewrites
+            self.cursor.execute("VACUUM")
+            return self.cursor.execute("PRAGMA auto_vacuum").fetchone()[0]
 
     def create_database(self):
         with self.lock:
@@ -108,7 +444,184 @@ class Sqlite(BaseStorage):
 
             self.connection.commit()
 
-    def insert(self, kwds):
+    def migrate_database(self):
+        """adds the columns which are missing in new or older tables"""
+        with self.lock:
+            self.cursor.execute(
+                'PRAGMA table_info("{0}")'.format(self.table_name))
+            columns = set(row[1] for row in self.cursor.fetchall())
+            for column, type in ADDED_COLUMNS:
+                if column not in columns:
+                    self.cursor.execute(
+                        'ALTER TABLE "{0}" ADD COLUMN {1} {2}'.format(
+                            self.table_name, column, type))
+            self.connection.commit()
+
+    def create_indexes(self):
+        """indexes for paging through the measurements by time"""
+        with self.lock:
+            for column in (self.endedAt_head, self.startedAt_head):
+                self.cursor.execute(
+                    '''CREATE INDEX IF NOT EXISTS "{0}_{1}_id"
+                    ON "{0}" ({1}, ID)'''.format(self.table_name, column))
+            self.connection.commit()
+
+    def create_rollup_tables(self):
+        """
+        creates the rollup tables. a storage of an older version gets them
+        rebuilt from its measurements, in the background.
+        """
+        with self.lock:
+            # processes which open the storage at the same moment take turns
+            self.cursor.execute("BEGIN IMMEDIATE")
+            try:
+                self.cursor.execute('''CREATE TABLE IF NOT EXISTS "{0}"
+                    (
+                    id INTEGER PRIMARY KEY,
+                    lastId INTEGER,
+                    maxId INTEGER
+                    );
+                '''.format(self.rebuild_table_name))
+                self.cursor.execute(
+                    'SELECT count(*) FROM "{0}"'.format(
+                        self.rebuild_table_name))
+                if self.cursor.fetchone()[0] == 0:
+                    self.cursor.execute(
+                        'INSERT INTO "{0}" VALUES (0, 0, 0)'.format(
+                            self.rebuild_table_name))
+                    self._planRebuild(self.cursor)
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+
+    def create_span_table(self):
+        with self.lock:
+            self.cursor.execute('''CREATE TABLE IF NOT EXISTS "{0}"
+                (
+                measurementId INTEGER,
+                ord INTEGER,
+                parent INTEGER,
+                depth INTEGER,
+                name TEXT,
+                start REAL,
+                elapsed REAL,
+                PRIMARY KEY (measurementId, ord)
+                ) WITHOUT ROWID;
+            '''.format(self.span_table_name))
+            self.connection.commit()
+
+    def _planRebuild(self, cursor):
+        """empties the rollup tables, which are rebuilt up to the last id"""
+        for table_name in self.rollup_table_names.values():
+            # those of older versions have other columns
+            cursor.execute('DROP TABLE IF EXISTS "{0}"'.format(table_name))
+            cursor.execute('''CREATE TABLE "{0}"
+                (
+                bucket INTEGER,
+                method TEXT,
+                name TEXT,
+                count REAL,
+                minElapsed REAL,
+                maxElapsed REAL,
+                sums TEXT,
+                sketch TEXT,
+                PRIMARY KEY (bucket, method, name)
+                );
+            '''.format(table_name))
+        cursor.execute(
+            '''UPDATE "{0}" SET lastId=0,
+            maxId=(SELECT coalesce(max(ID), 0) FROM "{1}")'''.format(
+                self.rebuild_table_name, self.table_name))
+
+    def _rebuildStep(self, cursor, batchSize=10000):
+        """
+        adds the next batch of measurements to the rollups being rebuilt.
+        :return: True if the rollups are complete
+        """
+        # takes the write lock before reading the progress, which another
+        # process rebuilding as well may change
+        cursor.execute(
+            'UPDATE "{0}" SET lastId=lastId'.format(self.rebuild_table_name))
+        lastId, maxId = self._rebuildProgress(cursor)
+        if lastId >= maxId:
+            return True
+        rows = cursor.execute(
+            '''SELECT ID, {0} FROM "{1}" WHERE ID>? AND ID<=?
+            ORDER BY ID LIMIT ?'''.format(RAW_COLUMNS, self.table_name),
+            (lastId, maxId, batchSize)).fetchall()
+        self._updateRollups(cursor, [Sqlite._rawRow(r[1:]) for r in rows])
+        lastId = rows[-1][0] if len(rows) == batchSize else maxId
+        cursor.execute(
+            'UPDATE "{0}" SET lastId=?'.format(self.rebuild_table_name),
+            (lastId, ))
+        return lastId >= maxId
+
+    def _rebuildProgress(self, cursor):
+        """:return: (lastId, maxId) of the rebuild of the rollups"""
+        return cursor.execute(
+            'SELECT lastId, maxId FROM "{0}"'.format(
+                self.rebuild_table_name)).fetchone()
+
+    def _isRebuilt(self):
+        lastId, maxId = self._read(
+            'SELECT lastId, maxId FROM "{0}"'.format(
+                self.rebuild_table_name))[0]
+        return lastId >= maxId
+
+    def rebuild_rollups(self, batchSize=10000):
+        """builds the rollup tables again from the stored measurements"""
+        self._submit(self._planRebuild)
+        while not self._submit(self._rebuildStep, batchSize):
+            pass
+
+    def _updateRollups(self, cursor, measurements, sign=1):
+        """merges the given measurements into the rollup rows"""
+        for granularity, table_name in self.rollup_table_names.items():
+            select = '''SELECT count, minElapsed, maxElapsed, sums, sketch
+                FROM "{0}" WHERE bucket=? AND method IS ? AND name IS ?
+                '''.format(table_name)
+            replace = '''INSERT OR REPLACE INTO "{0}"
+                (bucket, method, name, count, minElapsed, maxElapsed, sums,
+                sketch) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'''.format(table_name)
+            for key, rollup in rollupsOf(
+                    measurements, granularity, sign).items():
+                row = cursor.execute(select, key).fetchone()
+                if row:
+                    rollup.merge(Rollup.fromRow(*row))
+                cursor.execute(replace, key + rollup.toRow())
+
+    def _readRollups(self, granularity, startedAt, endedAt):
+        """:return: list of (bucket, method, name, Rollup)"""
+        rows = self._read(
+            '''SELECT bucket, method, name, count, minElapsed, maxElapsed,
+                sums, sketch
+            FROM "{0}" WHERE bucket>=? AND bucket<?'''.format(
+                self.rollup_table_names[granularity]),
+            (startedAt, endedAt))
+        return [r[:3] + (Rollup.fromRow(*r[3:]), ) for r in rows]
+
+    @staticmethod
+    def _rawRow(row):
+        return dict(zip(RAW_FIELDS, row))
+
+    def _readRaw(self, startedAt, endedAt):
+        """:return: the measurements started in [startedAt, endedAt)"""
+        rows = self._read(
+            selectSql(
+                self.table_name, RAW_COLUMNS,
+                ("startedAt>=?", "startedAt<?")),
+            (startedAt, endedAt))
+        return [Sqlite._rawRow(row) for row in rows]
+
+    def _collectRollups(self, filters):
+        return collectRollups(
+            filters["startedAt"], filters["endedAt"],
+            self._readRollups, self._readRaw,
+            self.rollupRebuild.granularities())
+
+    @staticmethod
+    def _toRow(kwds):
         endedAt = float(kwds.get('endedAt', None))
         startedAt = float(kwds.get('startedAt', None))
         elapsed = kwds.get('elapsed', None)
@@ -117,214 +630,296 @@ class Sqlite(BaseStorage):
         context = json.dumps(kwds.get('context', {}))
         method = kwds.get('method', None)
         name = kwds.get('name', None)
+        details = dict(
+            (column, None if kwds.get(column, None) is None
+             else json.dumps(kwds[column]))
+            for column in DETAIL_COLUMNS)
+        return (
+            startedAt,
+            endedAt,
+            elapsed,
+            args,
+            kwargs,
+            method,
+            context,
+            name,
+            kwds.get('cpuTime', None),
+            kwds.get('userTime', None),
+            kwds.get('sysTime', None),
+            kwds.get('weight', 1),
+            details['profile'],
+            kwds.get('queries', None),
+            kwds.get('dbTime', None),
+            details['statements'],
+            kwds.get('peakBytes', None),
+            kwds.get('netBytes', None),
+            details['allocations'],
+            kwds.get('ttfb', None),
+            kwds.get('ttlb', None),
+            kwds.get('responseSize', None),
+            kwds.get('viewTime', None))
+
+    def _insert(self, cursor, rows, measurements):
+        sql = 'INSERT INTO "{0}" ({1}) VALUES ({2})'.format(
+            self.table_name, ", ".join(COLUMNS), ", ".join("?" * len(COLUMNS)))
+        # the rows are inserted in batches, except those with spans which
+        # need the id of their measurement
+        batch = []
+        for row, measurement in zip(rows, measurements):
+            spans = measurement.get("spans", None)
+            if not spans:
+                batch.append(row)
+                continue
+            if batch:
+                cursor.executemany(sql, batch)
+                batch = []
+            cursor.execute(sql, row)
+            measurementId = cursor.lastrowid
+            cursor.executemany(
+                'INSERT INTO "{0}" VALUES (?, ?, ?, ?, ?, ?, ?)'.format(
+                    self.span_table_name),
+                [(measurementId, s["order"], s["parent"], s["depth"],
+                  s["name"], s["start"], s["elapsed"]) for s in spans])
+        if batch:
+            cursor.executemany(sql, batch)
+        self._updateRollups(cursor, measurements)
 
-        sql = """INSERT INTO {0} VALUES (
-            null, ?, ?, ?, ?,?, ?, ?, ?)""".format(self.table_name)
-
-        with self.lock:
-            self.cursor.execute(sql, (
-                    startedAt,
-                    endedAt,
-                    elapsed,
-                    args,
-                    kwargs,
-                    method,
-                    context,
-                    name))
+    def insert(self, kwds):
+        self._submit(self._insert, [Sqlite._toRow(kwds)], [kwds])
+
+    def insert_many(self, measurements):
+        rows = [Sqlite._toRow(kwds) for kwds in measurements]
+        if rows:
+            self._submit(self._insert, rows, measurements)
+
+    def _readSeriesRollups(self, query, percentiles, granularity,
+                           startedAt, endedAt):
+        table_name = self.rollup_table_names[granularity]
+        params = Sqlite._seriesParams(query, startedAt, endedAt)
+        if percentiles:
+            rows = self._read(
+                '''SELECT {0} AS b, count, sketch FROM "{1}"
+                WHERE bucket>=:startedAt AND bucket<:endedAt
+                ORDER BY b'''.format(bucketExpression("bucket"), table_name),
+                params)
+            return [
+                (r[0], r[1], LatencySketch.fromJson(json.loads(r[2])))
+                for r in rows]
+        return self._read(
+            '''SELECT {0} AS b, sum(count), NULL FROM "{1}"
+            WHERE bucket>=:startedAt AND bucket<:endedAt
+            GROUP BY b ORDER BY b'''.format(
+                bucketExpression("bucket"), table_name),
+            params)
 
-            self.connection.commit()
+    @staticmethod
+    def _seriesParams(query, startedAt, endedAt):
+        return {
+            "offset": query.offset, "interval": query.interval,
+            "startedAt": startedAt, "endedAt": endedAt}
+
+    def _readSeriesRaw(self, query, percentiles, startedAt, endedAt):
+        if percentiles:
+            sql = '''SELECT {0} AS b, {1}, elapsed FROM "{2}"
+                WHERE startedAt>=:startedAt AND startedAt<:endedAt
+                ORDER BY b'''
+        else:
+            sql = '''SELECT {0} AS b, sum({1}), NULL FROM "{2}"
+                WHERE startedAt>=:startedAt AND startedAt<:endedAt
+                GROUP BY b ORDER BY b'''
+        return self._read(
+            sql.format(bucketExpression("startedAt"), WEIGHT, self.table_name),
+            Sqlite._seriesParams(query, startedAt, endedAt))
 
     def getTimeseries(self, kwds={}):
         filters = Sqlite.getFilters(kwds)
-
-        if kwds.get('interval', None) == "daily":
-            interval = 3600 * 24   # daily
-            dateFormat = '%Y-%m-%d'
-        else:
-            interval = 3600  # hourly
-            dateFormat = '%Y-%m-%d %H'
-
-        endedAt, startedAt = filters["endedAt"], filters["startedAt"]
-
-        conditions = "where endedAt<={0} AND startedAt>={1} ".format(
-            endedAt, startedAt)
-        with self.lock:
-            sql = '''SELECT
-                    startedAt, count(id) as count
-                FROM "{table_name}" {conditions}
-                group by strftime("{dateFormat}", datetime(startedAt, 'unixepoch'))
-                order by startedAt asc
-                '''.format(
-                    table_name=self.table_name,
-                    dateFormat=dateFormat,
-                    conditions=conditions
-                    )
-
-            self.cursor.execute(sql)
-            rows = self.cursor.fetchall()
-
-        series = {}
-        for i in range(int(startedAt), int(endedAt) + 1, interval):
-            series[formatDate(i, dateFormat)] = 0
-
-        for row in rows:
-            series[formatDate(row[0], dateFormat)] = row[1]
-        return series
+        query = SeriesQuery(kwds, filters["startedAt"], filters["endedAt"])
+        percentiles = kwds.get('percentiles', None)
+        percentiles = parsePercentiles(percentiles) if percentiles else None
+        return collectSeries(
+            query,
+            partial(self._readSeriesRollups, query, percentiles),
+            partial(self._readSeriesRaw, query, percentiles),
+            percentiles, self.rollupRebuild.granularities())
 
     def getMethodDistribution(self, kwds=None):
         if not kwds:
             kwds = {}
         f = Sqlite.getFilters(kwds)
-        endedAt, startedAt = f["endedAt"], f["startedAt"]
-        conditions = "where endedAt<={0} AND startedAt>={1} ".format(
-            endedAt, startedAt)
-
-        with self.lock:
-            sql = '''SELECT
-                    method, count(id) as count
-                FROM "{table_name}" {conditions}
-                group by method
-                '''.format(
-                    table_name=self.table_name,
-                    conditions=conditions
-                    )
-
-            self.cursor.execute(sql)
-            rows = self.cursor.fetchall()
-
-        results = {}
-        for row in rows:
-            results[row[0]] = row[1]
-        return results
+        return methodDistributionOf(self._collectRollups(f))
 
     def filter(self, kwds={}):
-        # Find Operation
         f = Sqlite.getFilters(kwds)
-
-        conditions = "WHERE 1=1 AND "
-
-        if f["endedAt"]:
-            conditions = conditions + 'endedAt<={0} AND '.format(f["endedAt"])
-        if f["startedAt"]:
-            conditions = conditions + 'startedAt>={0} AND '.format(
-                f["startedAt"])
-        if f["elapsed"]:
-            conditions = conditions + 'elapsed>={0} AND '.format(f["elapsed"])
-        if f["method"]:
-            conditions = conditions + 'method="{0}" AND '.format(f["method"])
-        if f["name"]:
-            conditions = conditions + 'name="{0}" AND '.format(f["name"])
-
-        conditions = conditions.rstrip(" AND")
-
-        with self.lock:
-            sql = '''SELECT * FROM "{table_name}" {conditions}
-            order by {sort_field} {sort_direction}
-            limit {limit} OFFSET {skip} '''.format(
-                table_name=self.table_name,
-                conditions=conditions,
-                sort_field=f["sort"][0],
-                sort_direction=f["sort"][1],
-                limit=f['limit'],
-                skip=f['skip']
-            )
-
-            self.cursor.execute(sql)
-            rows = self.cursor.fetchall()
-        return (self.jsonify_row(row) for row in rows)
+        column, direction = sortOf(f["sort"])
+        conditions, params = conditionsOf(f)
+        orderBy = "{0} {1}".format(column, direction)
+        if column != "ID":
+            orderBy += ", ID " + direction
+        sql = selectSql(
+            self.table_name, LIST_COLUMNS, conditions, orderBy=orderBy,
+            paged=True)
+        rows = self._read(sql, params + [f["limit"], f["skip"]])
+        return (self.jsonify_row(row, LIST_COLUMNS) for row in rows)
+
+    def paginate(self, kwds={}):
+        rows = list(self.filter(kwds))
+        return rows, nextCursor(Sqlite.getFilters(kwds), rows)
 
     def get(self, measurementId):
-        with self.lock:
-            self.cursor.execute(
-                'SELECT * FROM "{table_name}" WHERE ID={measurementId}'.format(
-                    table_name=self.table_name,
-                    measurementId=measurementId
-                    )
-            )
-            rows = self.cursor.fetchall()
-        record = rows[0]
-        return self.jsonify_row(record)
+        rows = self._read(
+            selectSql(self.table_name, ALL_COLUMNS, ("ID=?", )),
+            (int(measurementId), ))
+        if not rows:
+            return None
+        data = self.jsonify_row(rows[0])
+        data["spans"] = [
+            {"order": r[0], "parent": r[1], "depth": r[2], "name": r[3],
+             "start": r[4], "elapsed": r[5]}
+            for r in self._read(
+                '''SELECT ord, parent, depth, name, start, elapsed FROM "{0}"
+                WHERE measurementId=? ORDER BY ord'''.format(
+                    self.span_table_name),
+                (int(measurementId), ))]
+        return data
+
+    def _truncate(self, cursor):
+        for table_name in self.rollup_table_names.values():
+            cursor.execute('DELETE FROM "{0}"'.format(table_name))
+        cursor.execute(
+            'UPDATE "{0}" SET lastId=0, maxId=0'.format(
+                self.rebuild_table_name))
+        cursor.execute('DELETE FROM "{0}"'.format(self.span_table_name))
+        cursor.execute("DELETE FROM {0}".format(self.table_name))
+        return cursor.rowcount
 
     def truncate(self):
-        with self.lock:
-            self.cursor.execute("DELETE FROM {0}".format(self.table_name))
-            self.connection.commit()
+        rowcount = self._submit(self._truncate)
         # Making the api match with mongo collection, this function must return
         # True or False based on success of this delete operation
-        return True if self.cursor.rowcount else False
+        return True if rowcount else False
+
+    def _deleteMany(self, cursor, measurementIds):
+        """deletes the measurements and takes them out of the rollups"""
+        for i in range(0, len(measurementIds), Sqlite.MAX_PARAMS):
+            ids = measurementIds[i:i + Sqlite.MAX_PARAMS]
+            placeholders = ",".join("?" * len(ids))
+            rows = cursor.execute(
+                selectSql(
+                    self.table_name, "ID, " + RAW_COLUMNS,
+                    ("ID IN ({0})".format(placeholders), )),
+                ids).fetchall()
+            if not rows:
+                continue
+            lastId, maxId = self._rebuildProgress(cursor)
+            self._updateRollups(
+                cursor, [
+                    Sqlite._rawRow(row[1:]) for row in rows
+                    if isRolledUp(row[0], lastId, maxId)],
+                sign=-1)
+            cursor.execute(
+                'DELETE FROM "{0}" WHERE ID IN ({1})'.format(
+                    self.table_name, placeholders),
+                ids)
+            cursor.execute(
+                'DELETE FROM "{0}" WHERE measurementId IN ({1})'.format(
+                    self.span_table_name, placeholders),
+                ids)
+            # the rollups of the buckets which are left empty
+            startedAt = [row[3] for row in rows]
+            for granularity, table_name in self.rollup_table_names.items():
+                cursor.execute(
+                    '''DELETE FROM "{0}"
+                    WHERE bucket>=? AND bucket<=? AND count<0.5'''.format(
+                        table_name),
+                    (bucketOf(min(startedAt), granularity),
+                     bucketOf(max(startedAt), granularity)))
 
     def delete(self, measurementId):
-        with self.lock:
-            self.cursor.execute(
-                'DELETE FROM "{table_name}" WHERE ID={measurementId}'.format(
-                    table_name=self.table_name,
-                    measurementId=measurementId
-                    )
-            )
-            return self.connection.commit()
-
-    def jsonify_row(self, row):
-        data = {
-            "id": row[0],
-            "startedAt": row[1],
-            "endedAt": row[2],
-            "elapsed": row[3],
-            "args": tuple(json.loads(row[4])),  # json -> list -> tuple
-            "kwargs": json.loads(row[5]),
-            "method": row[6],
-            "context": json.loads(row[7]),
-            "name": row[8]
-        }
-
+        return self._submit(self._deleteMany, [measurementId])
+
+    def _expiredIds(self, maxAge, maxRowsPerEndpoint, batchSize):
+        """:return: the ids of at most batchSize measurements to prune"""
+        if maxAge is not None:
+            ids = self._read(
+                '''SELECT ID FROM "{0}" WHERE endedAt<?
+                ORDER BY endedAt LIMIT ?'''.format(self.table_name),
+                (time.time() - float(maxAge), batchSize))
+            if ids:
+                return [row[0] for row in ids]
+        ids = []
+        if maxRowsPerEndpoint is None:
+            return ids
+        endpoints = self._read(
+            '''SELECT method, name, count(*) FROM "{0}"
+            GROUP BY method, name HAVING count(*)>?'''.format(
+                self.table_name),
+            (int(maxRowsPerEndpoint), ))
+        for method, name, count in endpoints:
+            rows = self._read(
+                '''SELECT ID FROM "{0}" WHERE method IS ? AND name IS ?
+                ORDER BY ID LIMIT ?'''.format(self.table_name),
+                (method, name,
+                 min(count - int(maxRowsPerEndpoint), batchSize - len(ids))))
+            ids.extend(row[0] for row in rows)
+            if len(ids) >= batchSize:
+                break
+        return ids
+
+    def prune(self, maxAge=None, maxRowsPerEndpoint=None, batchSize=1000):
+        ids = self._expiredIds(maxAge, maxRowsPerEndpoint, batchSize)
+        if ids:
+            self._submit(self._deleteMany, ids)
+        return len(ids)
+
+    def _incrementalVacuum(self, cursor):
+        """:return: the number of free pages left"""
+        # every step of the pragma frees one page
+        cursor.execute("PRAGMA incremental_vacuum({0:d})".format(
+            Sqlite.VACUUM_PAGES)).fetchall()
+        return cursor.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def compact(self):
+        """frees the unused pages of the file a few at a time"""
+        if self.inMemory or self.autoVacuum != 2:
+            return
+        while self._submit(self._incrementalVacuum):
+            pass
+
+    def jsonify_row(self, row, columns=ALL_COLUMNS):
+        """:param columns: the columns of the row, ID first"""
+        data = {}
+        for column, value in zip(columns.split(", "), row):
+            if column == "ID":
+                data["id"] = value
+            elif column == "args":
+                data["args"] = tuple(json.loads(value))  # json -> list -> tuple
+            elif column in JSON_COLUMNS:
+                data[column] = None if value is None else json.loads(value)
+            else:
+                data[column] = value
         return data
 
     def getSummary(self, kwds={}):
         filters = Sqlite.getFilters(kwds)
-
-        conditions = "WHERE 1=1 and "
-
-        if filters["startedAt"]:
-            conditions = conditions + "startedAt>={0} AND ".format(
-                filters["startedAt"])
-        if filters["endedAt"]:
-            conditions = conditions + "endedAt<={0} AND ".format(
-                filters["endedAt"])
-        if filters["elapsed"]:
-            conditions = conditions + "elapsed>={0} AND".format(
-                filters["elapsed"])
-
-        conditions = conditions.rstrip(" AND")
-        with self.lock:
-            sql = '''SELECT
-                    method, name,
-                    count(id) as count,
-                    min(elapsed) as minElapsed,
-                    max(elapsed) as maxElapsed,
-                    avg(elapsed) as avgElapsed
-                FROM "{table_name}" {conditions}
-                group by method, name
-                order by {sort_field} {sort_direction}
-                '''.format(
-                    table_name=self.table_name,
-                    conditions=conditions,
-                    sort_field=filters["sort"][0],
-                    sort_direction=filters["sort"][1]
-                    )
-
-            self.cursor.execute(sql)
-            rows = self.cursor.fetchall()
-
-        result = []
-        for r in rows:
-            result.append({
-                "method": r[0],
-                "name": r[1],
-                "count": r[2],
-                "minElapsed": r[3],
-                "maxElapsed": r[4],
-                "avgElapsed": r[5]
-            })
-        return result
+        percentiles = parsePercentiles(kwds.get("percentiles", None))
+        sort = kwds.get('sort', "count,desc").split(",")
+        if readsRollups(filters):
+            return summaryOf(
+                self._collectRollups(filters), percentiles, sort)
+        return summaryOf(self._rawRollups(filters), percentiles, sort)
+
+    def _rawRollups(self, filters):
+        """
+        :return: list of (bucket, method, name, Rollup) of the measurements
+            which match the filters, for the queries the rollups can not
+            answer
+        """
+        conditions, params = conditionsOf(filters, endpoint=False, seek=False)
+        rows = self._read(
+            selectSql(self.table_name, RAW_COLUMNS, conditions), params)
+        return [
+            key + (rollup, ) for key, rollup in rollupsOf(
+                [Sqlite._rawRow(row) for row in rows], HOUR).items()]
 
     def __exit__(self, exc_type, exc_value, traceback):
-        return self.connection.close()
+        return self.close()
@@ -0,0 +1,156 @@
+import re
+import time
+from datetime import datetime, timedelta
+
+from .rollup import GRANULARITIES, planRanges
+from ..sketch import LatencySketch
+
+UNITS = {"m": 60, "h": 3600, "d": 3600 * 24}
+# names which the dashboard sends
+LEGACY_INTERVALS = {"hourly": 3600, "daily": 3600 * 24}
+# the most buckets a series may have
+MAX_BUCKETS = 100000
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def parseInterval(value):
+    """
+    parses an interval such as "1m", "5m", "15m", "1h" or "1d".
+    :return: the interval in seconds, one hour if value is empty
+    """
+    if not value:
+        return 3600
+    if value in LEGACY_INTERVALS:
+        return LEGACY_INTERVALS[value]
+    match = re.match(r"^(\d+)([mhd])$", value)
+    if not match or not int(match.group(1)):
+        raise ValueError("unknown interval: {0}".format(value))
+    return int(match.group(1)) * UNITS[match.group(2)]
+
+
+def parseOffset(value):
+    """
+    :param value: minutes east of UTC, such as "120" or "-300"; the offset
+        of the server's local time if empty
+    :return: the offset in seconds
+    """
+    if value is None or value == "":
+        return time.localtime().tm_gmtoff
+    return int(float(value) * 60)
+
+
+def dateFormatOf(interval):
+    if interval % UNITS["d"] == 0:
+        return '%Y-%m-%d'
+    if interval % UNITS["h"] == 0:
+        return '%Y-%m-%d %H'
+    return '%Y-%m-%d %H:%M'
+
+
+class SeriesQuery(object):
+    """the buckets of a getTimeseries call"""
+
+    def __init__(self, kwds, startedAt, endedAt):
+        self.interval = parseInterval(kwds.get('interval', None))
+        self.offset = parseOffset(kwds.get('tzOffset', None))
+        self.startedAt = startedAt
+        self.endedAt = endedAt
+        self.dateFormat = dateFormatOf(self.interval)
+        self.firstBucket = self.bucketOf(startedAt)
+        self.lastBucket = self.bucketOf(endedAt)
+        if (self.lastBucket - self.firstBucket) // self.interval > MAX_BUCKETS:
+            raise ValueError("too many buckets, choose a longer interval")
+
+    def bucketOf(self, timestamp):
+        """:return: the start of the bucket, in seconds since the epoch"""
+        return int((int(timestamp) + self.offset) // self.interval) * \
+            self.interval - self.offset
+
+    def label(self, bucket):
+        return (EPOCH + timedelta(seconds=bucket + self.offset)).strftime(
+            self.dateFormat)
+
+    def plan(self, granularities=GRANULARITIES):
+        """
+        the rollups whose buckets do not cross the buckets of the series are
+        used, e.g. only the minutely ones for 15 minute buckets.
+        :param granularities: of the rollups which may be read
+        """
+        granularities = [
+            g for g in granularities
+            if self.interval % g == 0 and self.offset % g == 0]
+        return planRanges(self.startedAt, self.endedAt, granularities)
+
+
+def mergeRows(rows, percentiles=None):
+    """
+    adds up the rows of the same bucket.
+    :param rows: iterable of (bucket, count, value) sorted by bucket. value
+        is None, a LatencySketch or the elapsed time of one measurement.
+    :return: list of [bucket, count, LatencySketch or None]
+    """
+    merged = []
+    for bucket, count, value in rows:
+        count = float(count)
+        if merged and merged[-1][0] == bucket:
+            last = merged[-1]
+            last[1] += count
+        else:
+            last = [bucket, count, LatencySketch() if percentiles else None]
+            merged.append(last)
+        if percentiles and value is not None:
+            if isinstance(value, LatencySketch):
+                last[2].merge(value)
+            else:
+                last[2].add(value, count)
+    return merged
+
+
+def collectSeries(query, readRollups, readRaw, percentiles=None,
+                  granularities=GRANULARITIES):
+    """
+    reads the counts of the buckets of the series.
+    :param readRollups: function(granularity, start, end) which returns the
+        (bucket, count, value) rows of the rollups in [start, end), sorted
+        by the bucket of the series
+    :param readRaw: function(start, end) which returns the (bucket, count,
+        value) rows of the measurements started in [start, end)
+    :param granularities: of the rollups which may be read
+    """
+    rows = []
+    for granularity, start, end in query.plan(granularities):
+        if granularity is None:
+            rows.extend(readRaw(start, end))
+        else:
+            rows.extend(readRollups(granularity, start, end))
+    return fillSeries(query, mergeRows(rows, percentiles), percentiles)
+
+
+def fillSeries(query, rows, percentiles=None):
+    """
+    builds the getTimeseries result in one pass over the buckets, the ones
+    without measurements get 0.
+    :param rows: list of [bucket, count, LatencySketch or None] sorted by
+        bucket
+    :param percentiles: if given, the values of the series are dicts such as
+        {"count": 10, "p50": 0.1, "p99": 0.3}
+    """
+    empty = LatencySketch().percentiles(percentiles) if percentiles else None
+    series = {}
+    rows = iter(rows)
+    row = next(rows, None)
+    for bucket in range(
+            query.firstBucket, query.lastBucket + 1, query.interval):
+        while row is not None and row[0] < bucket:
+            row = next(rows, None)
+        found = row is not None and row[0] == bucket
+        count = int(round(row[1])) if found else 0
+        if percentiles:
+            value = {"count": count}
+            value.update(
+                row[2].percentiles(percentiles) if found else empty)
+        else:
+            value = count
+        series[query.label(bucket)] = value
+    return series
@@ -0,0 +1,149 @@
+# -*- coding: utf8 -*-
+import atexit
+import logging
+import os
+import threading
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+logger = logging.getLogger("flask-profiler")
+
+# guards restarting the writers in a forked process, see
+# flask_profiler.storage.sqlite
+_forkLock = threading.Lock()
+
+
+def _newForkLock():
+    global _forkLock
+    _forkLock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_newForkLock)
+
+
+class WriteBehindQueue(object):
+    """
+    buffers measurements in a bounded in-process queue. a background thread
+    drains the queue into the storage in batches, so that profiled requests
+    never wait for the storage. when the queue is full, new measurements are
+    dropped and counted instead of blocking the request.
+    """
+
+    def __init__(self, collection, queueSize=10000, flushInterval=1.0,
+                 maxBatch=500):
+        super(WriteBehindQueue, self).__init__()
+        self.collection = collection
+        self.queueSize = queueSize
+        self.flushInterval = flushInterval
+        self.maxBatch = maxBatch
+        self._stopped = threading.Event()
+        self._start()
+        atexit.register(self.close)
+
+    def _start(self):
+        self._pid = os.getpid()
+        self.queue = queue.Queue(maxsize=self.queueSize)
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+
+        self._counterLock = threading.Lock()
+        self._flushLock = threading.Lock()
+        self._wakeup = threading.Event()
+
+        self._thread = threading.Thread(
+            target=self._run, name="flask-profiler-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _checkFork(self):
+        """
+        workers forked from a master which has already created the queue get
+        a background thread of their own. the measurements queued in the
+        master are left to it, so that they are not written twice.
+        """
+        if self._pid == os.getpid():
+            return
+        with _forkLock:
+            if self._pid != os.getpid():
+                stopped = self._stopped.is_set()
+                self._stopped = threading.Event()
+                if stopped:
+                    self._stopped.set()
+                self._start()
+
+    def put(self, measurement):
+        """
+        hands a measurement over to the background writer without blocking.
+        :return: False if the measurement is dropped because the queue is full
+        """
+        self._checkFork()
+        try:
+            self.queue.put_nowait(measurement)
+        except queue.Full:
+            with self._counterLock:
+                self.dropped += 1
+            return False
+
+        if self.queue.qsize() >= self.maxBatch:
+            self._wakeup.set()
+        return True
+
+    def flush(self):
+        """writes every queued measurement to the storage"""
+        self._checkFork()
+        with self._flushLock:
+            while True:
+                batch = self._drain()
+                if not batch:
+                    break
+                self._write(batch)
+
+    def close(self, timeout=5):
+        """stops the background thread and flushes what is left in the queue"""
+        self._checkFork()
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        return {
+            "queueSize": self.queueSize,
+            "queueDepth": self.queue.qsize(),
+            "dropped": self.dropped,
+            "written": self.written,
+            "failed": self.failed
+        }
+
+    def _drain(self):
+        batch = []
+        while len(batch) < self.maxBatch:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            self.collection.insert_many(batch)
+        except Exception:
+            logger.exception(
+                "flask-profiler could not store {0} measurements".format(
+                    len(batch)))
+            self.failed += len(batch)
+        else:
+            self.written += len(batch)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flushInterval)
+            self._wakeup.clear()
+            self.flush()
@@ -51,6 +51,11 @@ setup(
             'static/dist/index.html',
             ]
         },
+    entry_points={
+        'console_scripts': [
+            'flask-profiler-collector=flask_profiler.collector:main'
+        ]
+    },
     test_suite="tests.suite",
     zip_safe=False,
     platforms='any',
@@ -7,6 +7,24 @@ import sys
 from .test_endpoint_ignore import EndpointIgnoreTestCase
 from .test_measurement import MeasurementTest
 from .test_measure_endpoint import EndpointMeasurementTest, EndpointMeasurementTest2
+from .test_write_behind import WriteBehindQueueTest
+from .test_storage import StorageTest, RollupTest
+from .test_context_capture import ContextCaptureTest
+from .test_sampling import SamplerTest, SamplingMeasurementTest
+from .test_memory_storage import MemoryStorageTest
+from .test_sqlite_storage import SqliteStorageTest
+from .test_sqlalchemy_storage import SqlalchemyStorageTest
+from .test_sketch import LatencySketchTest
+from .test_export import ExportTest
+from .test_retention import RetentionTest
+from .test_partitioned_storage import PartitionedStorageTest
+from .test_profiling import ProfilingTest
+from .test_spans import SpanTest
+from .test_queries import QueryTest
+from .test_allocations import AllocationTest
+from .test_middleware import MiddlewareTest
+from .test_async import AsyncTest
+from .test_collector import CollectorTest
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 
@@ -16,4 +34,24 @@ def suite():
     suite.addTest(unittest.makeSuite(EndpointMeasurementTest))
     suite.addTest(unittest.makeSuite(EndpointIgnoreTestCase))
     suite.addTest(unittest.makeSuite(EndpointMeasurementTest2))
+    suite.addTest(unittest.makeSuite(WriteBehindQueueTest))
+    suite.addTest(unittest.makeSuite(StorageTest))
+    suite.addTest(unittest.makeSuite(ContextCaptureTest))
+    suite.addTest(unittest.makeSuite(SamplerTest))
+    suite.addTest(unittest.makeSuite(SamplingMeasurementTest))
+    suite.addTest(unittest.makeSuite(MemoryStorageTest))
+    suite.addTest(unittest.makeSuite(SqliteStorageTest))
+    suite.addTest(unittest.makeSuite(SqlalchemyStorageTest))
+    suite.addTest(unittest.makeSuite(LatencySketchTest))
+    suite.addTest(unittest.makeSuite(RollupTest))
+    suite.addTest(unittest.makeSuite(ExportTest))
+    suite.addTest(unittest.makeSuite(RetentionTest))
+    suite.addTest(unittest.makeSuite(PartitionedStorageTest))
+    suite.addTest(unittest.makeSuite(ProfilingTest))
+    suite.addTest(unittest.makeSuite(SpanTest))
+    suite.addTest(unittest.makeSuite(QueryTest))
+    suite.addTest(unittest.makeSuite(AllocationTest))
+    suite.addTest(unittest.makeSuite(MiddlewareTest))
+    suite.addTest(unittest.makeSuite(AsyncTest))
+    suite.addTest(unittest.makeSuite(CollectorTest))
     return suite
@@ -41,6 +41,15 @@ _CONFS = {
         "ignore": [
             "^/static/.*"
         ]
+    },
+    "memory": {
+        "enabled": True,
+        "storage": {
+            "engine": "memory"
+        },
+        "ignore": [
+            "^/static/.*"
+        ]
     }
 }
 CONF = _CONFS[environ.get('FLASK_PROFILER_TEST_CONF', 'sqlalchemy')]
@@ -0,0 +1,54 @@
+# -*- coding: utf8 -*-
+import tracemalloc
+import unittest
+
+from flask_profiler.allocations import AllocationTracker
+from .basetest import BasetTest, flask_profiler, measure
+
+kept = []
+
+
+def allocate():
+    kept.append(bytearray(1024 * 1024))
+    # freed before the call returns, counted by the peak only
+    buffer = bytearray(4 * 1024 * 1024)
+    del buffer
+
+
+class AllocationTest(BasetTest):
+
+    def tearDown(self):
+        flask_profiler.allocationTracker = None
+        del kept[:]
+
+    def test_01_traced_calls(self):
+        flask_profiler.allocationTracker = AllocationTracker(
+            {"fraction": 1, "top": 3})
+        measure(allocate, "allocate", "call")()
+        self.assertFalse(tracemalloc.is_tracing())
+
+        m = list(flask_profiler.collection.filter())[0]
+        self.assertGreaterEqual(m["peakBytes"], 5 * 1024 * 1024)
+        self.assertGreaterEqual(m["netBytes"], 1024 * 1024)
+        self.assertLess(m["netBytes"], 2 * 1024 * 1024)
+
+        sites = flask_profiler.collection.get(m["id"])["allocations"]
+        self.assertLessEqual(len(sites), 3)
+        self.assertTrue(sites[0]["file"].endswith("test_allocations.py"))
+        self.assertGreaterEqual(sites[0]["bytes"], 1024 * 1024)
+
+        summary = flask_profiler.collection.getSummary()
+        self.assertGreaterEqual(summary[0]["avgPeakBytes"], 5 * 1024 * 1024)
+
+    def test_02_untraced_calls(self):
+        flask_profiler.allocationTracker = AllocationTracker({"fraction": 0})
+        measure(allocate, "allocate", "call")()
+        m = list(flask_profiler.collection.filter())[0]
+        self.assertIsNone(m["peakBytes"])
+        self.assertIsNone(flask_profiler.collection.get(m["id"])["allocations"])
+        self.assertIsNone(
+            flask_profiler.collection.getSummary()[0]["avgPeakBytes"])
+
+
+if __name__ == '__main__':
+    unittest.main()
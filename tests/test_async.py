@@ -0,0 +1,94 @@
+# -*- coding: utf8 -*-
+import asyncio
+import inspect
+import unittest
+
+from flask_testing import TestCase as FlaskTestCase
+
+from flask_profiler import span
+from .basetest import BasetTest, flask_profiler, measure
+
+try:
+    import asgiref
+except ImportError:
+    asgiref = None
+
+
+@span()
+async def sleep(seconds):
+    await asyncio.sleep(seconds)
+
+
+async def wait(seconds):
+    await sleep(seconds)
+    return seconds
+
+
+class AsyncTest(BasetTest, FlaskTestCase):
+
+    def create_app(self):
+        app = super(AsyncTest, self).create_app()
+
+        @app.route("/api/async/<int:delay>")
+        @flask_profiler.profile()
+        async def asyncView(delay):
+            await asyncio.sleep(delay / 1000.0)
+            return "waited"
+
+        return app
+
+    def tearDown(self):
+        if flask_profiler.asyncWriter is not None:
+            flask_profiler.asyncWriter.close()
+            flask_profiler.asyncWriter = None
+
+    def test_01_coroutine_functions(self):
+        wrapped = measure(wait, "wait", "call")
+        self.assertTrue(inspect.iscoroutinefunction(wrapped))
+        self.assertEqual(asyncio.run(wrapped(0.05)), 0.05)
+
+        # handed over to a write-behind queue instead of the storage
+        self.assertIsNotNone(flask_profiler.asyncWriter)
+        flask_profiler.asyncWriter.flush()
+        m = list(flask_profiler.collection.filter())[0]
+        self.assertEqual(m["name"], "wait")
+        self.assertGreaterEqual(float(m["elapsed"]), 0.05)
+        spans = flask_profiler.collection.get(m["id"])["spans"]
+        self.assertEqual([s["name"] for s in spans], ["sleep"])
+        self.assertGreaterEqual(spans[0]["elapsed"], 0.05)
+
+    def test_02_concurrent_coroutines(self):
+        wrapped = measure(wait, "wait", "call")
+
+        async def main():
+            return await asyncio.gather(wrapped(0.05), wrapped(0.1))
+
+        asyncio.run(main())
+        flask_profiler.asyncWriter.flush()
+        elapsed = sorted(
+            float(m["elapsed"]) for m in flask_profiler.collection.filter())
+        self.assertEqual(len(elapsed), 2)
+        self.assertGreaterEqual(elapsed[0], 0.05)
+        self.assertLess(elapsed[0], 0.1)
+        self.assertGreaterEqual(elapsed[1], 0.1)
+
+    def test_03_async_views(self):
+        view = self.app.view_functions["asyncView"]
+        self.assertTrue(inspect.iscoroutinefunction(view))
+        with self.app.test_request_context("/api/async/50"):
+            self.assertEqual(asyncio.run(view(delay=50)), "waited")
+        flask_profiler.asyncWriter.flush()
+        m = list(flask_profiler.collection.filter())[0]
+        self.assertEqual(m["name"], "/api/async/<int:delay>")
+        self.assertGreaterEqual(float(m["elapsed"]), 0.05)
+
+    @unittest.skipIf(asgiref is None, "flask[async] is not installed")
+    def test_04_async_view_requests(self):
+        response = self.client.get("/api/async/10")
+        self.assertEqual(response.data, b"waited")
+        flask_profiler.asyncWriter.flush()
+        self.assertEqual(len(list(flask_profiler.collection.filter())), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# -*- coding: utf8 -*-
+import os
+import tempfile
+import time
+import unittest
+
+from flask_profiler.collector import Collector, CollectorClient, decode, \
+    encode
+from .basetest import BasetTest, measure, flask_profiler
+
+
+def doNothing(**kwargs):
+    return True
+
+
+def waitFor(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+class CollectorTest(BasetTest):
+
+    def setUp(self):
+        super(CollectorTest, self).setUp()
+        self.address = os.path.join(
+            tempfile.mkdtemp(), "flask-profiler.sock")
+
+    def tearDown(self):
+        if flask_profiler.sender is not None:
+            flask_profiler.sender.close()
+            flask_profiler.sender = None
+
+    def test_01_encoding(self):
+        small = {"name": "a", "args": [], "elapsed": 0.1}
+        self.assertEqual(decode(encode(small)), small)
+        large = dict(small, context={"body": "x" * 10000})
+        self.assertLess(len(encode(large)), 1000)
+        self.assertEqual(decode(encode(large)), large)
+
+    def test_02_without_collector(self):
+        client = CollectorClient(self.address)
+        self.assertFalse(client.send({"name": "a"}))
+        self.assertEqual(client.stats()["dropped"], 1)
+        client.close()
+
+    def test_03_measurements_are_collected(self):
+        collector = Collector(
+            flask_profiler.collection, self.address, flushInterval=0.05)
+        collector.start()
+        flask_profiler.sender = CollectorClient(self.address)
+        wrapped = measure(doNothing, "doNothing", "call")
+        for i in range(3):
+            self.assertTrue(wrapped(key=i))
+        self.assertEqual(flask_profiler.sender.stats()["sent"], 3)
+
+        waitFor(lambda: collector.stats()["written"] == 3)
+        collector.close()
+        self.assertFalse(os.path.exists(self.address))
+        measurements = list(flask_profiler.collection.filter())
+        self.assertEqual(len(measurements), 3)
+        self.assertEqual(
+            sorted(m["kwargs"]["key"] for m in measurements), [0, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# -*- coding: utf8 -*-
+import unittest
+
+from flask import Flask, request
+
+from flask_profiler.capture import ContextCapture
+
+
+class ContextCaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def capture(self, conf, *args, **kwargs):
+        with self.app.test_request_context(*args, **kwargs):
+            return ContextCapture(conf)(request)
+
+    def test_01_default_fields(self):
+        context = self.capture(
+            None, "/api/people/?q=1", method="POST", data="hello",
+            headers={"X-Token": "t"})
+        self.assertEqual(
+            set(context),
+            set(["url", "args", "form", "body", "headers", "func", "ip"]))
+        self.assertEqual(context["args"], {"q": "1"})
+        self.assertEqual(context["body"], "hello")
+        self.assertEqual(context["headers"]["X-Token"], "t")
+
+    def test_02_include(self):
+        context = self.capture({"include": ["url", "args"]}, "/a?q=1")
+        self.assertEqual(set(context), set(["url", "args"]))
+
+        with self.assertRaises(Exception):
+            ContextCapture({"include": ["cookies"]})
+
+    def test_03_header_allow_list(self):
+        context = self.capture(
+            {"headers": ["x-token"]}, "/",
+            headers={"X-Token": "t", "Authorization": "secret"})
+        self.assertEqual(context["headers"], {"X-Token": "t"})
+
+    def test_04_truncated_body(self):
+        context = self.capture(
+            {"maxBodySize": 4}, "/", method="POST", data="0123456789")
+        self.assertTrue(context["body"].startswith("0123<truncated"))
+        self.assertIn("10 bytes", context["body"])
+
+    def test_05_binary_body(self):
+        context = self.capture(
+            None, "/", method="POST", data=b"\x00\x01\x02",
+            content_type="application/octet-stream")
+        self.assertNotIn("\x00", context["body"])
+        self.assertIn("application/octet-stream", context["body"])
+
+        context = self.capture(
+            {"skipBinaryBody": False}, "/", method="POST",
+            data=b"\xff", content_type="application/octet-stream")
+        self.assertEqual(context["body"], u"�")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -63,6 +63,21 @@ class EndpointIgnoreTestCase(BasetTest, FlaskTestCase):
         measurements = list(flask_profiler.collection.filter())
         self.assertEqual(len(measurements), 2)
 
+    def test_03_ignored_endpoints_are_not_wrapped(self):
+        view = self.app.view_functions["getStaticPhoto"]
+        self.assertFalse(hasattr(view, "__wrapped__"))
+
+        view = self.app.view_functions["getApiStatic"]
+        self.assertTrue(hasattr(view, "__wrapped__"))
+
+    def test_04_compile_ignore_patterns(self):
+        conf = {"ignore": ["^/static/.*", "secret/$"]}
+        pattern = flask_profiler.compileIgnorePatterns(conf)
+        self.assertTrue(pattern.search("/static/a"))
+        self.assertTrue(pattern.search("/api/secret/"))
+        self.assertFalse(pattern.search("/api/secret/name"))
+        self.assertIsNone(flask_profiler.compileIgnorePatterns({}))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,125 @@
+# -*- coding: utf8 -*-
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from flask_testing import TestCase as FlaskTestCase
+
+from flask_profiler.export import exportMeasurements, importMeasurements
+from .basetest import BasetTest, flask_profiler
+from .test_storage import ListStorage, createMeasurement
+
+
+class ExportTest(BasetTest, FlaskTestCase):
+
+    def insert(self, count):
+        flask_profiler.collection.insert_many([
+            createMeasurement(name="/export/{0}".format(i % 3))
+            for i in range(count)])
+
+    def test_01_iterate_in_chunks(self):
+        self.insert(25)
+        ids = [m["id"] for m in flask_profiler.collection.iterate(
+            {"limit": 3, "skip": 5}, chunkSize=10)]
+        self.assertEqual(len(ids), 25)
+        self.assertEqual(len(set(ids)), 25)
+
+        names = set(m["name"] for m in flask_profiler.collection.iterate(
+            {"name": "/export/1"}, chunkSize=4))
+        self.assertEqual(names, set(["/export/1"]))
+
+    def test_02_ndjson(self):
+        self.insert(12)
+        response = self.client.get("/flask-profiler/db/export")
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = response.data.decode("utf-8").splitlines()
+        self.assertEqual(len(lines), 12)
+        m = json.loads(lines[0])
+        self.assertEqual(m["kwargs"], {"k": "v"})
+        self.assertEqual(m["context"], {"token": "x"})
+
+    def test_03_gzipped_csv(self):
+        self.insert(12)
+        response = self.client.get(
+            "/flask-profiler/db/export?format=csv&gzip=1&name=/export/2")
+        self.assertEqual(response.mimetype, "application/gzip")
+        self.assertIn(
+            "measurements.csv.gz", response.headers["Content-Disposition"])
+        data = gzip.decompress(response.data).decode("utf-8")
+        rows = list(csv.DictReader(io.StringIO(data)))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0]["name"], "/export/2")
+        self.assertEqual(json.loads(rows[0]["args"]), [1])
+
+    def test_04_unknown_format(self):
+        response = self.client.get("/flask-profiler/db/export?format=xml")
+        self.assertEqual(response.status_code, 400)
+
+    def test_05_import(self):
+        self.insert(12)
+        data = self.client.get("/flask-profiler/db/export").data
+        flask_profiler.collection.truncate()
+        batches = []
+        count = importMeasurements(
+            flask_profiler.collection,
+            io.StringIO(data.decode("utf-8")),
+            batchSize=5, progress=batches.append)
+        self.assertEqual(count, 12)
+        self.assertEqual(batches, [5, 10, 12])
+        measurements = list(flask_profiler.collection.filter())
+        self.assertEqual(len(measurements), 12)
+        self.assertEqual(measurements[0]["kwargs"], {"k": "v"})
+        self.assertEqual(measurements[0]["args"], (1, ))
+
+    def test_06_import_command(self):
+        self.insert(7)
+        data = self.client.get(
+            "/flask-profiler/db/export?format=csv&gzip=1").data
+        flask_profiler.collection.truncate()
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "measurements.csv.gz")
+            with open(path, "wb") as f:
+                f.write(data)
+            result = self.app.test_cli_runner().invoke(
+                args=["profiler", "import", path, "--batch-size", "3"])
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("imported 7 measurements", result.output)
+        self.assertEqual(len(list(flask_profiler.collection.filter())), 7)
+
+    def test_07_whole_database(self):
+        monthAgo = time.time() - 3600 * 24 * 30
+        flask_profiler.collection.insert_many([
+            createMeasurement(name="old", startedAt=monthAgo),
+            createMeasurement(name="new")])
+        lines = self.client.get(
+            "/flask-profiler/db/export").data.decode("utf-8").splitlines()
+        self.assertEqual(
+            sorted(json.loads(line)["name"] for line in lines),
+            ["new", "old"])
+
+        lines = self.client.get(
+            "/flask-profiler/db/export?startedAt={0}".format(monthAgo + 60)
+        ).data.decode("utf-8").splitlines()
+        self.assertEqual([json.loads(line)["name"] for line in lines], ["new"])
+
+    def test_08_engines_without_cursors(self):
+        collection = ListStorage()
+        collection.insert_many([createMeasurement() for i in range(2500)])
+        lines = list(exportMeasurements(collection, {}, chunkSize=1000)[0])
+        self.assertEqual(len(lines), 2500)
+
+        collection.measurements = collection.measurements[:2000]
+        self.assertEqual(len(list(collection.iterate(chunkSize=1000))), 2000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -41,6 +41,41 @@ class EndpointMeasurementTest(BasetTest, FlaskTestCase):
         self.assertEqual(m["kwargs"], {"message": "hello"})
         self.assertEqual(m["context"]["args"], {"q": "1"})
 
+    def test_03_paging_arguments(self):
+        self.client.get("/api/people/foo")
+        self.client.get("/api/people/bar")
+        url = "/flask-profiler/api/measurements/"
+        response = self.client.get(url + "?sort=elapsed&limit=1")
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.json["next"])
+
+        for query in ("?cursor=zzz", "?sort=bogus,desc"):
+            response = self.client.get(url + query)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("invalid", response.json["error"])
+
+    def test_04_unknown_measurement(self):
+        for measurementId in ("999999", "abc"):
+            response = self.client.get(
+                "/flask-profiler/api/measurements/" + measurementId)
+            self.assertEqual(response.status_code, 404)
+
+    def test_05_invalid_timeseries_arguments(self):
+        url = "/flask-profiler/api/measurements/timeseries/"
+        for query in ("?interval=7x", "?interval=1m&startedAt=0"):
+            response = self.client.get(url + query)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("interval", response.json["error"])
+
+    def test_06_invalid_percentiles(self):
+        for url in ("/flask-profiler/api/measurements/grouped",
+                    "/flask-profiler/api/measurements/timeseries/"):
+            for percentiles in ("abc", "150"):
+                response = self.client.get(
+                    url + "?percentiles=" + percentiles)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("percentiles", response.json["error"])
+
 
 class EndpointMeasurementTest2(BaseTest2, FlaskTestCase):
 
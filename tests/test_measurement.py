@@ -10,6 +10,13 @@ def doWait(seconds, **kwargs):
     return seconds
 
 
+def doWork(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+    return seconds
+
+
 class MeasurementTest(BasetTest):
 
     def setUp(self):
@@ -46,5 +53,27 @@ class MeasurementTest(BasetTest):
         self.assertEqual(m["context"], context)
         self.assertTrue(float(m["elapsed"]) >= waitSeconds)
 
+    def test_04_cpu_time(self):
+        measure(doWait, "doWait", "call")(0.2)
+        measure(doWork, "doWork", "call")(0.2)
+        measurements = dict(
+            (m["name"], m) for m in flask_profiler.collection.filter())
+
+        waiting = measurements["doWait"]
+        self.assertTrue(float(waiting["cpuTime"]) < 0.1)
+
+        working = measurements["doWork"]
+        self.assertTrue(float(working["cpuTime"]) > 0.1)
+        self.assertTrue(
+            float(working["cpuTime"]) <= float(working["elapsed"]) + 0.01)
+
+    def test_05_elapsed_resolution(self):
+        m = flask_profiler.Measurement("name", (), {}, "call")
+        m.start()
+        m.stop()
+        self.assertTrue(0 < m.elapsed < 0.01)
+        self.assertEqual(m.endedAt, m.startedAt + m.elapsed)
+
+
 if __name__ == '__main__':
     unittest.main()
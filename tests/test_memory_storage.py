@@ -0,0 +1,83 @@
+# -*- coding: utf8 -*-
+import time
+import unittest
+
+from flask_profiler import storage
+from .test_storage import createMeasurement
+
+
+class MemoryStorageTest(unittest.TestCase):
+
+    def test_01_ring_buffer(self):
+        collection = storage.getCollection(
+            {"engine": "memory", "MAX_RECORDS": 3})
+        for i in range(5):
+            collection.insert(createMeasurement(name="n{0}".format(i)))
+
+        measurements = list(collection.filter({"sort": "id,asc"}))
+        self.assertEqual(
+            [m["name"] for m in measurements], ["n2", "n3", "n4"])
+        self.assertEqual([m["id"] for m in measurements], [3, 4, 5])
+
+        self.assertIsNone(collection.get(1))
+        self.assertEqual(collection.get(4)["name"], "n3")
+
+    def test_02_max_age(self):
+        collection = storage.getCollection({"engine": "memory", "MAX_AGE": 60})
+        collection.insert(createMeasurement(
+            name="old", startedAt=time.time() - 120))
+        collection.insert(createMeasurement(name="new"))
+        self.assertEqual(
+            [m["name"] for m in collection.filter()], ["new"])
+        self.assertEqual(
+            [s["name"] for s in collection.getSummary()], ["new"])
+
+    def test_03_delete(self):
+        collection = storage.getCollection({"engine": "memory"})
+        collection.insert_many([createMeasurement(), createMeasurement()])
+        self.assertTrue(collection.delete(1))
+        self.assertFalse(collection.delete(1))
+        self.assertEqual([m["id"] for m in collection.filter()], [2])
+
+        self.assertTrue(collection.truncate())
+        self.assertEqual(list(collection.filter()), [])
+
+    def test_04_filter(self):
+        collection = storage.getCollection({"engine": "memory"})
+        collection.insert_many([
+            createMeasurement(name="a", method="GET", elapsed=0.1),
+            createMeasurement(name="a", method="POST", elapsed=0.3),
+            createMeasurement(name="b", method="GET", elapsed=0.2)])
+
+        measurements = list(collection.filter({"sort": "elapsed,desc"}))
+        self.assertEqual([m["elapsed"] for m in measurements], [0.3, 0.2, 0.1])
+        measurements = list(collection.filter({"name": "a", "method": "GET"}))
+        self.assertEqual(len(measurements), 1)
+        measurements = list(collection.filter({"elapsed": "0.15"}))
+        self.assertEqual(len(measurements), 2)
+        measurements = list(collection.filter({"name": "unknown"}))
+        self.assertEqual(len(measurements), 0)
+
+        summary = collection.getSummary({"sort": "maxElapsed,asc"})
+        self.assertEqual(
+            [(s["method"], s["name"]) for s in summary],
+            [("GET", "a"), ("GET", "b"), ("POST", "a")])
+        self.assertEqual(
+            collection.getMethodDistribution(), {"GET": 2, "POST": 1})
+
+    def test_05_summary_sort(self):
+        collection = storage.getCollection({"engine": "memory"})
+        collection.insert_many(
+            [dict(createMeasurement(name="a"), queries=2)] +
+            [createMeasurement(name="b") for i in range(2)])
+
+        summary = collection.getSummary()
+        self.assertEqual([s["name"] for s in summary], ["b", "a"])
+        summary = collection.getSummary({"sort": "avgQueries,desc"})
+        self.assertEqual(
+            [(s["name"], s["avgQueries"]) for s in summary],
+            [("a", 2), ("b", None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# -*- coding: utf8 -*-
+import time
+import unittest
+
+from flask import Flask, Response, stream_with_context
+from flask_testing import TestCase as FlaskTestCase
+
+from flask_profiler.middleware import ProfilerMiddleware
+from .basetest import BasetTest, CONF, flask_profiler
+
+
+class MiddlewareTest(BasetTest, FlaskTestCase):
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config["flask_profiler"] = dict(CONF, middleware={"enabled": True})
+        app.config['TESTING'] = True
+
+        @app.route("/stream")
+        def stream():
+            def generate():
+                yield "a" * 10
+                time.sleep(0.05)
+                yield "b" * 20
+            return Response(stream_with_context(generate()))
+
+        @app.route("/plain")
+        def plain():
+            return "plain"
+
+        @app.after_request
+        def slowHook(response):
+            time.sleep(0.01)
+            return response
+
+        flask_profiler.init_app(app)
+        return app
+
+    def test_01_streamed_response(self):
+        self.assertIsInstance(self.app.wsgi_app, ProfilerMiddleware)
+        response = self.client.get("/stream")
+        self.assertEqual(len(response.data), 30)
+        response.close()
+
+        m = list(flask_profiler.collection.filter({"name": "/stream"}))[0]
+        self.assertEqual(m["responseSize"], 30)
+        self.assertGreaterEqual(m["ttlb"], 0.05)
+        self.assertLess(m["ttfb"], m["ttlb"])
+        self.assertLess(m["viewTime"], 0.05)
+        self.assertAlmostEqual(float(m["elapsed"]), m["ttlb"], places=3)
+
+    def test_02_after_request_hooks(self):
+        self.client.get("/plain").close()
+        m = list(flask_profiler.collection.filter({"name": "/plain"}))[0]
+        self.assertEqual(m["responseSize"], 5)
+        self.assertGreaterEqual(m["ttlb"], 0.01)
+        self.assertGreaterEqual(m["ttfb"], 0.01)
+        self.assertLess(m["viewTime"], 0.01)
+
+        summary = flask_profiler.collection.getSummary()
+        self.assertEqual(summary[0]["avgResponseSize"], 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
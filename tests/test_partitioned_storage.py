@@ -0,0 +1,126 @@
+# -*- coding: utf8 -*-
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from flask_profiler import storage
+from flask_profiler.storage.partitioned import DAY, ID_STRIDE, dayOf
+from .test_storage import createMeasurement
+
+
+class PartitionedStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.conf = {
+            "engine": "sqlite",
+            "PARTITIONED": True,
+            "FILE": os.path.join(self.directory, "profiler.sql")}
+        self.collection = storage.getCollection(self.conf)
+        self.now = time.time() - 60
+        # 3, 2 and 4 measurements two days ago, yesterday and today
+        self.collection.insert_many(
+            [createMeasurement(name="a", startedAt=self.now - 2 * DAY + i)
+             for i in range(3)] +
+            [createMeasurement(name="b", startedAt=self.now - DAY + i)
+             for i in range(2)] +
+            [createMeasurement(name="a", startedAt=self.now + i, elapsed=0.5)
+             for i in range(4)])
+
+    def tearDown(self):
+        self.collection.close()
+        shutil.rmtree(self.directory)
+
+    def test_01_files_per_day(self):
+        days = [dayOf(self.now - 2 * DAY), dayOf(self.now - DAY),
+                dayOf(self.now)]
+        self.assertEqual(self.collection.days(), days)
+        self.assertTrue(os.path.exists(self.collection.fileOf(days[0])))
+
+        measurements = list(self.collection.filter({"startedAt": 0}))
+        self.assertEqual(len(measurements), 9)
+        self.assertEqual(
+            [m["endedAt"] for m in measurements],
+            sorted([m["endedAt"] for m in measurements], reverse=True))
+        m = measurements[-1]
+        self.assertEqual(m["id"] // ID_STRIDE, days[0])
+        self.assertEqual(self.collection.get(m["id"])["startedAt"],
+                         m["startedAt"])
+        self.collection.delete(m["id"])
+        self.assertIsNone(self.collection.get(m["id"]))
+        self.assertEqual(len(list(self.collection.filter({"startedAt": 0}))), 8)
+
+    def test_02_recent_queries_open_one_file(self):
+        collection = storage.getCollection(self.conf)
+        try:
+            summary = collection.getSummary({"startedAt": self.now - 10})
+            self.assertEqual(list(collection.partitions), [dayOf(self.now)])
+            self.assertEqual(
+                [(s["name"], s["count"]) for s in summary], [("a", 4)])
+        finally:
+            collection.close()
+
+    def test_03_merged_queries(self):
+        kwds = {"startedAt": self.now - 3 * DAY}
+        summary = dict(
+            (s["name"], s["count"])
+            for s in self.collection.getSummary(kwds))
+        self.assertEqual(summary, {"a": 7, "b": 2})
+        summary = self.collection.getSummary(dict(kwds, elapsed=0.4))
+        self.assertEqual([(s["name"], s["count"]) for s in summary], [("a", 4)])
+
+        series = self.collection.getTimeseries(dict(kwds, interval="1d"))
+        self.assertEqual(sum(series.values()), 9)
+        self.assertEqual(
+            self.collection.getMethodDistribution(kwds), {"call": 9})
+
+    def test_04_pages(self):
+        for sort in ("endedAt,desc", "elapsed,asc", "id,desc"):
+            ids, cursor = [], None
+            while True:
+                kwds = {"startedAt": 0, "limit": 4, "sort": sort}
+                if cursor:
+                    kwds["cursor"] = cursor
+                page, cursor = self.collection.paginate(kwds)
+                ids.extend(m["id"] for m in page)
+                if cursor is None:
+                    break
+            self.assertEqual(len(ids), 9)
+            self.assertEqual(len(set(ids)), 9)
+
+    def test_05_prune_drops_files(self):
+        oldest = self.collection.days()[0]
+        # everything before yesterday
+        maxAge = time.time() - dayOf(self.now - DAY) * DAY
+        while self.collection.prune(maxAge=maxAge):
+            pass
+        self.assertNotIn(oldest, self.collection.days())
+        self.assertFalse(os.path.exists(self.collection.fileOf(oldest)))
+        self.assertEqual(len(list(self.collection.filter({"startedAt": 0}))), 6)
+
+        while self.collection.prune(maxRowsPerEndpoint=1):
+            pass
+        self.assertEqual(len(list(self.collection.filter({"startedAt": 0}))), 2)
+
+    def test_06_open_files_are_bounded(self):
+        collection = storage.getCollection(
+            dict(self.conf, MAX_OPEN_PARTITIONS=1))
+        try:
+            self.assertEqual(
+                len(list(collection.filter({"startedAt": 0}))), 9)
+            self.assertEqual(list(collection.partitions), [dayOf(self.now)])
+            self.assertEqual(collection.users, {})
+
+            first = collection.days()[0]
+            collection.getSummary({"startedAt": first * DAY})
+            self.assertEqual(list(collection.partitions), [dayOf(self.now)])
+            collection.insert(createMeasurement(startedAt=first * DAY))
+            self.assertEqual(list(collection.partitions), [first])
+        finally:
+            collection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
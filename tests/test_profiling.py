@@ -0,0 +1,62 @@
+# -*- coding: utf8 -*-
+import unittest
+
+from flask_testing import TestCase as FlaskTestCase
+
+from flask_profiler.profiling import ProfileCapture
+from .basetest import BasetTest, flask_profiler, measure
+
+
+def slowFunction():
+    return sum(sorted(range(10000), key=lambda i: -i))
+
+
+class ProfilingTest(BasetTest, FlaskTestCase):
+
+    def tearDown(self):
+        flask_profiler.profiling = None
+
+    def test_01_slow_calls_keep_a_profile(self):
+        flask_profiler.profiling = ProfileCapture(
+            {"fraction": 1, "threshold": 0, "top": 5})
+        measure(slowFunction, "slowFunction", "call")()
+        m = list(flask_profiler.collection.filter())[0]
+        self.assertNotIn("profile", m)
+
+        profile = flask_profiler.collection.get(m["id"])["profile"]
+        self.assertEqual(len(profile), 5)
+        self.assertIn("slowFunction", [f["function"] for f in profile])
+        self.assertEqual(
+            [f["cumulativeTime"] for f in profile],
+            sorted([f["cumulativeTime"] for f in profile], reverse=True))
+
+        response = self.client.get(
+            "/flask-profiler/api/measurements/{0}/profile".format(m["id"]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["profile"], profile)
+
+    def test_02_fast_calls_drop_the_profile(self):
+        flask_profiler.profiling = ProfileCapture(
+            {"fraction": 0, "endpoints": ["^slow"], "threshold": 60})
+        measure(slowFunction, "slowFunction", "call")()
+        m = list(flask_profiler.collection.filter())[0]
+        self.assertIsNone(flask_profiler.collection.get(m["id"])["profile"])
+        response = self.client.get(
+            "/flask-profiler/api/measurements/{0}/profile".format(m["id"]))
+        self.assertEqual(response.status_code, 404)
+
+        response = self.client.get(
+            "/flask-profiler/api/measurements/999999/profile")
+        self.assertEqual(response.status_code, 404)
+
+    def test_03_one_profile_at_a_time(self):
+        capture = ProfileCapture({"fraction": 1, "threshold": 0})
+        profiler = capture.start("a")
+        self.assertIsNotNone(profiler)
+        self.assertIsNone(capture.start("b"))
+        self.assertTrue(capture.finish(profiler, 1))
+        self.assertIsNone(ProfileCapture({"fraction": 0}).start("a"))
+
+
+if __name__ == '__main__':
+    unittest.main()
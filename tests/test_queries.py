@@ -0,0 +1,95 @@
+# -*- coding: utf8 -*-
+import sqlite3
+import unittest
+
+from sqlalchemy import create_engine, text
+
+from flask_profiler import traceSqlite
+from flask_profiler.queries import QueryTracker, normalize
+from .basetest import BasetTest, flask_profiler, measure
+
+
+class QueryTest(BasetTest):
+
+    def setUp(self):
+        super(QueryTest, self).setUp()
+        flask_profiler.queryTracker = QueryTracker(
+            {"sqlalchemy": True, "top": 2, "nPlusOneThreshold": 3})
+
+    def tearDown(self):
+        flask_profiler.queryTracker = None
+
+    def test_01_normalize(self):
+        self.assertEqual(
+            normalize("SELECT * FROM t1\n WHERE id IN (1, 2, 3) "
+                      "AND name='o''k' AND x=:x_1 AND y=%(y)s LIMIT 10"),
+            "SELECT * FROM t1 WHERE id IN (?...) AND name=? AND x=? AND y=? "
+            "LIMIT ?")
+
+    def test_02_sqlalchemy(self):
+        engine = create_engine("sqlite://")
+
+        def listOrders():
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+                for i in range(4):
+                    connection.execute(
+                        text("SELECT :id + 1"), {"id": i})
+
+        measure(listOrders, "listOrders", "GET")()
+        # not measured
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 2"))
+
+        m = list(flask_profiler.collection.filter())[0]
+        self.assertEqual(m["queries"], 5)
+        self.assertGreater(m["dbTime"], 0)
+        statements = flask_profiler.collection.get(m["id"])["statements"]
+        self.assertEqual(len(statements), 2)
+        repeated = [s for s in statements if s["nPlusOne"]]
+        self.assertEqual(
+            [(s["statement"], s["count"]) for s in repeated],
+            [("SELECT ? + ?", 4)])
+
+        summary = flask_profiler.collection.getSummary()
+        self.assertEqual(summary[0]["avgQueries"], 5)
+        self.assertGreater(summary[0]["avgDbTime"], 0)
+
+    def test_03_sqlite3(self):
+        connection = sqlite3.connect(":memory:")
+        traceSqlite(connection)
+
+        def listOrders():
+            for i in range(3):
+                connection.execute("SELECT ?", (i, )).fetchall()
+
+        measure(listOrders, "listOrders", "GET")()
+        measure(lambda: None, "nothing", "GET")()
+        measurements = dict(
+            (m["name"], m) for m in flask_profiler.collection.filter())
+        m = measurements["listOrders"]
+        self.assertEqual(m["queries"], 3)
+        self.assertIsNone(m["dbTime"])
+        statements = flask_profiler.collection.get(m["id"])["statements"]
+        self.assertEqual(statements[0]["statement"], "SELECT ?")
+        self.assertTrue(statements[0]["nPlusOne"])
+        self.assertEqual(measurements["nothing"]["queries"], 0)
+
+    def test_04_nested_calls_do_not_count_the_storage(self):
+        helper = measure(lambda: None, "helper", "call")
+
+        def outer():
+            for i in range(3):
+                helper()
+
+        measure(outer, "outer", "GET")()
+        measurements = dict(
+            (m["name"], m) for m in flask_profiler.collection.filter())
+        self.assertEqual(measurements["outer"]["queries"], 0)
+        self.assertIsNone(
+            flask_profiler.collection.get(
+                measurements["outer"]["id"])["statements"])
+
+
+if __name__ == '__main__':
+    unittest.main()
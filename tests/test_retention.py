@@ -0,0 +1,62 @@
+# -*- coding: utf8 -*-
+import time
+import unittest
+
+from flask_profiler.retention import Pruner
+from .basetest import BasetTest, flask_profiler
+from .test_storage import createMeasurement
+
+
+class RetentionTest(BasetTest):
+
+    def test_01_max_age(self):
+        collection = flask_profiler.collection
+        old = time.time() - 3600 * 24 * 2
+        collection.insert_many(
+            [createMeasurement(name="a", startedAt=old + i) for i in range(5)] +
+            [createMeasurement(name="a") for i in range(3)])
+
+        self.assertEqual(collection.prune(maxAge=3600 * 24, batchSize=2), 2)
+        while collection.prune(maxAge=3600 * 24, batchSize=2):
+            pass
+        kwds = {"startedAt": 0}
+        self.assertEqual(len(list(collection.filter(kwds))), 3)
+        summary = collection.getSummary(kwds)
+        self.assertEqual([(s["name"], s["count"]) for s in summary], [("a", 3)])
+
+    def test_02_max_rows_per_endpoint(self):
+        collection = flask_profiler.collection
+        collection.insert_many(
+            [createMeasurement(name="a") for i in range(6)] +
+            [createMeasurement(name="b") for i in range(2)])
+        ids = sorted(m["id"] for m in collection.filter({"name": "a"}))
+
+        while collection.prune(maxRowsPerEndpoint=3, batchSize=2):
+            pass
+        remaining = sorted(m["id"] for m in collection.filter({"name": "a"}))
+        self.assertEqual(remaining, ids[3:])
+        self.assertEqual(len(list(collection.filter({"name": "b"}))), 2)
+        summary = dict(
+            (s["name"], s["count"]) for s in collection.getSummary())
+        self.assertEqual(summary, {"a": 3, "b": 2})
+
+    def test_03_pruner(self):
+        collection = flask_profiler.collection
+        collection.insert_many([createMeasurement() for i in range(5)])
+        self.assertRaises(ValueError, Pruner, collection)
+        pruner = Pruner(collection, maxRowsPerEndpoint=1, interval=3600)
+        try:
+            # the first run is started right away
+            for i in range(50):
+                if pruner.pruned:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(pruner.pruned, 4)
+            self.assertEqual(pruner.prune(), 0)
+        finally:
+            pruner.close()
+        self.assertEqual(len(list(collection.filter())), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
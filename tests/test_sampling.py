@@ -0,0 +1,122 @@
+# -*- coding: utf8 -*-
+import unittest
+
+from flask import Flask
+
+from flask_profiler.sampling import Sampler
+from .basetest import BasetTest, CONF, measure, flask_profiler
+from .test_storage import createMeasurement
+
+
+def doNothing(**kwargs):
+    return True
+
+
+class SamplerTest(unittest.TestCase):
+
+    def test_01_rate(self):
+        sampler = Sampler({"rate": 0.25})
+        weights = [sampler.sample("/a", "GET") for i in range(4000)]
+        sampled = [w for w in weights if w]
+        self.assertTrue(800 < len(sampled) < 1200)
+        self.assertEqual(set(sampled), set([4.0]))
+
+        self.assertEqual(Sampler({"rate": 0}).sample("/a", "GET"), 0)
+        self.assertEqual(Sampler({}).sample("/a", "GET"), 1)
+        with self.assertRaises(Exception):
+            Sampler({"rate": 2})
+
+    def test_02_routes(self):
+        sampler = Sampler({
+            "rate": 0,
+            "routes": [["^/api/orders/", 1], ["^/api/", 0.5]]})
+        self.assertEqual(sampler.rateFor("/api/orders/<id>"), 1)
+        self.assertEqual(sampler.rateFor("/api/people/"), 0.5)
+        self.assertEqual(sampler.rateFor("/health"), 0)
+
+    def test_03_token_bucket(self):
+        sampler = Sampler({"maxPerSecond": 2})
+        weights = [sampler.sample("/a", "GET") for i in range(5)]
+        self.assertEqual(weights, [1, 1, 0, 0, 0])
+        # the other endpoints have their own buckets
+        self.assertEqual(sampler.sample("/b", "GET"), 1)
+
+        # the rejected requests are added to the next stored one
+        state = sampler._state("/a", "GET")
+        state.updatedAt -= 1
+        weight = sampler.sample("/a", "GET")
+        self.assertEqual(sampler.keep("/a", "GET", 0.1, weight), 4)
+        self.assertEqual(state.debt, 0)
+
+    def test_04_tail_threshold(self):
+        sampler = Sampler({"rate": 0, "slowerThan": 0.5})
+        self.assertTrue(sampler.tail)
+        weight = sampler.sample("/a", "GET")
+        self.assertEqual(weight, 0)
+        self.assertEqual(sampler.keep("/a", "GET", 0.1, weight), 0)
+        self.assertEqual(sampler.keep("/a", "GET", 0.6, weight), 1)
+
+        # slow requests count once even if they are sampled by rate
+        sampler = Sampler({"rate": 0.5, "slowerThan": 0.5})
+        self.assertEqual(sampler.keep("/a", "GET", 0.6, 2.0), 1)
+        self.assertEqual(sampler.keep("/a", "GET", 0.1, 2.0), 2)
+
+    def test_05_tail_percentile(self):
+        sampler = Sampler({"rate": 0, "slowerThanPercentile": 99})
+        for i in range(1000):
+            sampler.keep("/a", "GET", i / 1000.0, 0)
+        self.assertEqual(sampler.keep("/a", "GET", 0.5, 0), 0)
+        self.assertEqual(sampler.keep("/a", "GET", 0.995, 0), 1)
+
+
+class SamplingMeasurementTest(BasetTest):
+
+    def tearDown(self):
+        flask_profiler.sampler = None
+        flask_profiler.samplingFunction = None
+
+    def test_01_weight_is_stored(self):
+        flask_profiler.sampler = Sampler({"rate": 0.5, "slowerThan": 0})
+        wrapped = measure(doNothing, "doNothing", "call")
+        wrapped()
+        m = list(flask_profiler.collection.filter())[0]
+        self.assertEqual(m["weight"], 1)
+
+    def test_02_not_sampled(self):
+        flask_profiler.sampler = Sampler({"rate": 0})
+        measure(doNothing, "doNothing", "call")()
+        self.assertEqual(len(list(flask_profiler.collection.filter())), 0)
+
+    def test_04_sampling_function_after_wrapping(self):
+        # decorated at import time, before init_app loads the config
+        wrapped = measure(doNothing, "doNothing", "call")
+        app = Flask(__name__)
+        app.config["flask_profiler"] = dict(
+            CONF, sampling_function=lambda: False)
+        flask_profiler.init_app(app)
+        wrapped()
+        self.assertEqual(len(list(flask_profiler.collection.filter())), 0)
+
+    def test_03_weighted_summary(self):
+        measurements = [
+            createMeasurement(name="a", elapsed=1),
+            createMeasurement(name="a", elapsed=2),
+            createMeasurement(name="b", elapsed=1)]
+        measurements[0]["weight"] = 3
+        flask_profiler.collection.insert_many(measurements)
+
+        summary = dict(
+            (s["name"], s) for s in flask_profiler.collection.getSummary())
+        self.assertEqual(summary["a"]["count"], 4)
+        self.assertAlmostEqual(float(summary["a"]["avgElapsed"]), 1.25)
+        self.assertEqual(summary["b"]["count"], 1)
+
+        distribution = flask_profiler.collection.getMethodDistribution()
+        self.assertEqual(distribution["call"], 5)
+
+        series = flask_profiler.collection.getTimeseries()
+        self.assertEqual(sum(series.values()), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# -*- coding: utf8 -*-
+import random
+import unittest
+
+from flask_profiler.sketch import (
+    LatencySketch, parsePercentiles, percentileKey)
+
+
+class LatencySketchTest(unittest.TestCase):
+
+    def assertRelativelyClose(self, expected, actual):
+        self.assertTrue(
+            abs(expected - actual) <= expected * 0.0101,
+            "{0} is not close to {1}".format(actual, expected))
+
+    def test_01_quantiles(self):
+        values = [random.uniform(0.0001, 10) for i in range(10000)]
+        sketch = LatencySketch()
+        for value in values:
+            sketch.add(value)
+        values.sort()
+        for q in (0.5, 0.9, 0.99, 0.999):
+            expected = values[int(q * len(values)) - 1]
+            self.assertRelativelyClose(expected, sketch.quantile(q))
+        self.assertEqual(sketch.count, len(values))
+
+    def test_02_merge(self):
+        first, second, both = LatencySketch(), LatencySketch(), LatencySketch()
+        for i in range(1, 1001):
+            (first if i % 2 else second).add(i / 1000.0)
+            both.add(i / 1000.0)
+        first.merge(second)
+        self.assertEqual(first.bins, both.bins)
+        self.assertRelativelyClose(0.99, first.quantile(0.99))
+
+    def test_03_weights_and_zero(self):
+        sketch = LatencySketch()
+        sketch.add(0)
+        sketch.add(1, weight=3)
+        self.assertEqual(sketch.quantile(0.25), 0)
+        self.assertRelativelyClose(1, sketch.quantile(0.5))
+        self.assertIsNone(LatencySketch().quantile(0.5))
+
+    def test_04_json(self):
+        sketch = LatencySketch()
+        for value in (0, 0.001, 0.5, 2):
+            sketch.add(value)
+        copy = LatencySketch.fromJson(sketch.__json__())
+        self.assertEqual(copy.bins, sketch.bins)
+        self.assertEqual(copy.zero, sketch.zero)
+
+    def test_05_percentiles(self):
+        self.assertEqual(percentileKey(50), "p50")
+        self.assertEqual(percentileKey(99.9), "p999")
+        self.assertEqual(parsePercentiles("50, 99.9"), [50, 99.9])
+        self.assertEqual(parsePercentiles(None), [50, 90, 95, 99, 99.9])
+        with self.assertRaises(ValueError):
+            parsePercentiles("101")
+
+
+if __name__ == '__main__':
+    unittest.main()
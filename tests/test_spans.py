@@ -0,0 +1,76 @@
+# -*- coding: utf8 -*-
+import time
+import unittest
+
+from flask_testing import TestCase as FlaskTestCase
+
+from flask_profiler import span
+from .basetest import BasetTest, flask_profiler, measure
+
+
+@span()
+def loadOrders():
+    with span("query"):
+        time.sleep(0.01)
+    with span("render"):
+        pass
+
+
+def handleRequest():
+    with span("authenticate"):
+        pass
+    loadOrders()
+    return "ok"
+
+
+class SpanTest(BasetTest, FlaskTestCase):
+
+    def test_01_spans_are_stored(self):
+        self.assertEqual(measure(handleRequest, "orders", "GET")(), "ok")
+        m = list(flask_profiler.collection.filter())[0]
+        self.assertNotIn("spans", m)
+
+        spans = flask_profiler.collection.get(m["id"])["spans"]
+        self.assertEqual(
+            [(s["order"], s["parent"], s["depth"], s["name"]) for s in spans],
+            [(0, None, 1, "authenticate"),
+             (1, None, 1, "loadOrders"),
+             (2, 1, 2, "query"),
+             (3, 1, 2, "render")])
+        self.assertGreaterEqual(spans[2]["elapsed"], 0.01)
+        self.assertGreaterEqual(spans[2]["start"], spans[1]["start"])
+
+    def test_02_waterfall(self):
+        measure(handleRequest, "orders", "GET")()
+        m = list(flask_profiler.collection.filter())[0]
+        response = self.client.get(
+            "/flask-profiler/api/measurements/{0}/waterfall".format(m["id"]))
+        self.assertEqual(response.status_code, 200)
+        spans = response.json["spans"]
+        self.assertEqual(
+            [s["name"] for s in spans],
+            ["authenticate", "loadOrders", "query", "render"])
+        self.assertGreater(spans[1]["share"], 0.5)
+        self.assertLessEqual(spans[1]["share"], 1)
+
+        response = self.client.get(
+            "/flask-profiler/api/measurements/999999/waterfall")
+        self.assertEqual(response.status_code, 404)
+
+    def test_03_outside_measured_calls(self):
+        loadOrders()
+        measure(lambda: None, "nothing", "GET")()
+        m = list(flask_profiler.collection.filter())[0]
+        self.assertEqual(flask_profiler.collection.get(m["id"])["spans"], [])
+
+    def test_04_deleted_with_the_measurement(self):
+        measure(handleRequest, "orders", "GET")()
+        measure(handleRequest, "orders", "GET")()
+        ids = [m["id"] for m in flask_profiler.collection.filter()]
+        flask_profiler.collection.delete(ids[0])
+        self.assertEqual(
+            len(flask_profiler.collection.get(ids[1])["spans"]), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# -*- coding: utf8 -*-
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from flask_profiler import storage
+from flask_profiler.storage.rollup import HOUR, MINUTE
+from flask_profiler.storage.timeseries import SeriesQuery
+from .test_storage import createMeasurement
+
+
+class SqlalchemyStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.collection = storage.getCollection({
+            "engine": "sqlalchemy",
+            "db_url": "sqlite:///" + os.path.join(
+                self.directory, "profiler.sql"),
+            "pool_size": 2,
+            "max_overflow": 0,
+            "pool_recycle": 600})
+
+    def tearDown(self):
+        self.collection.close()
+        shutil.rmtree(self.directory)
+
+    def test_01_pool_options(self):
+        pool = self.collection.db.pool
+        self.assertEqual(pool.size(), 2)
+        self.assertEqual(pool._recycle, 600)
+
+    def test_02_connections_are_returned(self):
+        collection = self.collection
+        for i in range(10):
+            collection.insert(createMeasurement())
+            list(collection.filter())
+            collection.getSummary({"elapsed": 0.01})
+        collection.delete(list(collection.filter())[0]["id"])
+        self.assertEqual(len(list(collection.filter())), 9)
+        self.assertEqual(collection.db.pool.checkedout(), 0)
+
+    def test_03_concurrently_inserted_rollup(self):
+        collection = self.collection
+        startedAt = time.time() // 60 * 60 + 1
+        collection.insert(createMeasurement(startedAt=startedAt))
+
+        # the rollup rows are inserted by another writer between the lookup
+        # and the insert of this one
+        lockRollup = collection._lockRollup
+        calls = []
+
+        def racingLockRollup(connection, table, condition):
+            calls.append(table.name)
+            if len(calls) % 2:
+                return None
+            return lockRollup(connection, table, condition)
+
+        collection._lockRollup = racingLockRollup
+        collection.insert(createMeasurement(startedAt=startedAt))
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(len(list(collection.filter())), 2)
+        for granularity in (MINUTE, HOUR):
+            rollups = collection._readRollups(granularity, 0, time.time())
+            self.assertEqual([r[3].count for r in rollups], [2])
+
+    def test_04_short_measurements(self):
+        collection = self.collection
+        startedAt = time.time() // 60 * 60 + 0.25
+        collection.insert(createMeasurement(elapsed=0.000031,
+                                            startedAt=startedAt))
+        collection.insert(createMeasurement(startedAt=startedAt + 0.5))
+        measurement = list(collection.filter({"sort": "elapsed,asc"}))[0]
+        self.assertAlmostEqual(measurement["elapsed"], 0.000031)
+        self.assertAlmostEqual(measurement["startedAt"], startedAt)
+        self.assertAlmostEqual(
+            measurement["endedAt"] - measurement["startedAt"], 0.000031)
+
+        # the raw series counts both in one bucket despite the fractions
+        query = SeriesQuery({"interval": "1m"}, startedAt - 1, startedAt + 1)
+        series = collection._readSeriesRaw(
+            query, None, startedAt - 1, startedAt + 1)
+        self.assertEqual([tuple(r[:2]) for r in series],
+                         [(startedAt - 0.25, 2)])
+
+    def test_05_rollups_rebuilt_in_background(self):
+        collection = self.collection
+        start = time.time() // HOUR * HOUR - HOUR
+        collection.insert_many([
+            createMeasurement(startedAt=start + i * 60) for i in range(25)])
+        # the rollups of an older version are dropped
+        with collection.db.begin() as connection:
+            collection._planRebuild(connection)
+        collection.rollupRebuild.complete = False
+        self.assertFalse(collection.rollupRebuild.ready())
+
+        # until they are rebuilt, the queries read the measurements
+        kwds = {"startedAt": start, "endedAt": time.time(), "tzOffset": 0}
+        measurement = list(collection.filter({"startedAt": start}))[0]
+        collection.delete(measurement["id"])
+        collection.insert(createMeasurement(startedAt=start + 1))
+        self.assertEqual(collection.getSummary(kwds)[0]["count"], 25)
+        self.assertEqual(sum(collection.getTimeseries(kwds).values()), 25)
+        self.assertEqual(collection.getMethodDistribution(kwds), {"call": 25})
+
+        # reopening does not wait for the rebuild
+        collection.close()
+        self.collection = collection = storage.getCollection({
+            "engine": "sqlalchemy",
+            "db_url": "sqlite:///" + os.path.join(
+                self.directory, "profiler.sql")})
+        collection.rollupRebuild.join(5)
+        self.assertTrue(collection.rollupRebuild.ready())
+        rollups = collection._readRollups(HOUR, 0, time.time())
+        self.assertEqual(sum(r[3].count for r in rollups), 25)
+        self.assertEqual(collection.getSummary(kwds)[0]["count"], 25)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+# -*- coding: utf8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from flask_profiler import storage
+from flask_profiler.storage.rollup import HOUR
+from flask_profiler.storage.sqlite import selectSql
+from .test_storage import createMeasurement
+
+
+class SqliteStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.collection = storage.getCollection({
+            "engine": "sqlite",
+            "FILE": os.path.join(self.directory, "profiler.sql")})
+
+    def tearDown(self):
+        self.collection.close()
+        shutil.rmtree(self.directory)
+
+    def test_01_wal(self):
+        mode = self.collection._read("PRAGMA journal_mode")[0][0]
+        self.assertEqual(mode.lower(), "wal")
+        # readers are read-only
+        with self.assertRaises(Exception):
+            self.collection._read("DELETE FROM measurements")
+
+    def test_02_concurrent_writes(self):
+        def work(i):
+            for j in range(20):
+                self.collection.insert(
+                    createMeasurement(name="n{0}".format(i)))
+
+        threads = [threading.Thread(target=work, args=(i, )) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        summary = self.collection.getSummary()
+        self.assertEqual(len(summary), 8)
+        self.assertEqual(set(s["count"] for s in summary), set([20]))
+
+    def test_03_failed_write(self):
+        def fail(cursor):
+            cursor.execute(
+                "INSERT INTO measurements (name) VALUES ('lost')")
+            raise ValueError("fail")
+
+        with self.assertRaises(ValueError):
+            self.collection._submit(fail)
+        self.collection.insert(createMeasurement(name="kept"))
+        self.assertEqual(
+            [m["name"] for m in self.collection.filter()], ["kept"])
+
+    def test_04_in_memory(self):
+        collection = storage.getCollection(
+            {"engine": "sqlite", "FILE": ":memory:"})
+        collection.insert_many([createMeasurement(), createMeasurement()])
+        self.assertEqual(len(list(collection.filter())), 2)
+        self.assertEqual(collection.getSummary()[0]["count"], 2)
+        collection.close()
+        with self.assertRaises(Exception):
+            collection.insert(createMeasurement())
+
+    def test_05_compact(self):
+        collection = self.collection
+        self.assertEqual(collection.autoVacuum, 2)
+        measurements = []
+        for i in range(2000):
+            m = createMeasurement(startedAt=1000.0 + i)
+            m["context"] = {"body": "x" * 1000}
+            measurements.append(m)
+        collection.insert_many(measurements)
+        path = os.path.join(self.directory, "profiler.sql")
+        collection._submit(
+            lambda cursor: cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)"))
+        size = os.path.getsize(path)
+
+        while collection.prune(maxAge=3600, batchSize=500):
+            pass
+        collection.compact()
+        collection._submit(
+            lambda cursor: cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)"))
+        self.assertEqual(list(collection.filter({"startedAt": 0})), [])
+        self.assertLess(os.path.getsize(path), size / 4)
+
+    def test_06_parameterized_queries(self):
+        collection = self.collection
+        name = 'it\'s "quoted"'
+        collection.insert(createMeasurement(name=name))
+        collection.insert(createMeasurement(name="other"))
+
+        selectSql.cache_clear()
+        for value in (name, "other", "missing"):
+            rows = list(collection.filter({"name": value}))
+            self.assertEqual([m["name"] for m in rows], [value][:len(rows)])
+        # the three filters share one statement
+        self.assertEqual(selectSql.cache_info().misses, 1)
+        self.assertEqual(selectSql.cache_info().hits, 2)
+
+        measurement = list(collection.filter({"name": name}))[0]
+        self.assertEqual(collection.get(measurement["id"])["name"], name)
+        for sort in ("elapsed;DROP TABLE measurements,desc", "elapsed,up"):
+            self.assertRaises(ValueError, collection.filter, {"sort": sort})
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_07_after_fork(self):
+        self.collection.insert(createMeasurement(name="parent"))
+        pid = os.fork()
+        if pid == 0:
+            # the child has no writer thread of its own until it writes
+            code = 1
+            try:
+                self.collection.insert(createMeasurement(name="child"))
+                code = 0 if len(list(self.collection.filter())) == 2 else 1
+            finally:
+                os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertEqual(
+            sorted(m["name"] for m in self.collection.filter()),
+            ["child", "parent"])
+
+    def test_08_writer_not_running(self):
+        self.collection.jobs.put(None)
+        self.collection.writer.join()
+        with self.assertRaises(Exception):
+            self.collection.insert(createMeasurement())
+
+    def test_09_rollups_rebuilt_in_background(self):
+        collection = self.collection
+        start = time.time() // HOUR * HOUR - HOUR
+        collection.insert_many([
+            createMeasurement(startedAt=start + i * 60) for i in range(25)])
+        # the rollups of an older version are dropped
+        collection._submit(collection._planRebuild)
+        collection.rollupRebuild.complete = False
+        self.assertFalse(collection.rollupRebuild.ready())
+
+        # until they are rebuilt, the queries read the measurements
+        kwds = {"startedAt": start, "endedAt": time.time(), "tzOffset": 0}
+        measurement = list(collection.filter({"startedAt": start}))[0]
+        collection.delete(measurement["id"])
+        collection.insert(createMeasurement(startedAt=start + 1))
+        self.assertEqual(collection.getSummary(kwds)[0]["count"], 25)
+        self.assertEqual(sum(collection.getTimeseries(kwds).values()), 25)
+        self.assertEqual(collection.getMethodDistribution(kwds), {"call": 25})
+
+        # reopening does not wait for the rebuild
+        collection.close()
+        self.collection = collection = storage.getCollection({
+            "engine": "sqlite",
+            "FILE": os.path.join(self.directory, "profiler.sql")})
+        collection.rollupRebuild.join(5)
+        self.assertTrue(collection.rollupRebuild.ready())
+        rollups = collection._readRollups(HOUR, 0, time.time())
+        self.assertEqual(sum(r[3].count for r in rollups), 25)
+        self.assertEqual(collection.getSummary(kwds)[0]["count"], 25)
+
+
+if __name__ == '__main__':
+    unittest.main()
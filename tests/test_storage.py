@@ -0,0 +1,237 @@
+# -*- coding: utf8 -*-
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from flask_profiler.storage.base import BaseStorage
+from flask_profiler.storage.rollup import (
+    HOUR, MINUTE, Rollup, bucketOf, planRanges)
+from flask_profiler.storage.timeseries import SeriesQuery, parseInterval
+from .basetest import BasetTest, flask_profiler
+
+
+def createMeasurement(name="doNothing", method="call", elapsed=0.1,
+                      startedAt=None):
+    if startedAt is None:
+        startedAt = time.time() - elapsed
+    return {
+        "name": name,
+        "args": (1, ),
+        "kwargs": {"k": "v"},
+        "method": method,
+        "startedAt": startedAt,
+        "endedAt": startedAt + elapsed,
+        "elapsed": elapsed,
+        "context": {"token": "x"}
+    }
+
+
+class ListStorage(BaseStorage):
+    """a custom engine which only implements single-row inserts"""
+
+    def __init__(self, config=None):
+        super(ListStorage, self).__init__()
+        self.measurements = []
+
+    def insert(self, measurement):
+        self.measurements.append(measurement)
+
+    def filter(self, criteria):
+        skip = int(criteria.get("skip", 0))
+        return iter(self.measurements[
+            skip:skip + int(criteria.get("limit", 100))])
+
+
+class StorageTest(BasetTest):
+
+    def test_01_insert_many(self):
+        measurements = [
+            createMeasurement(name="n{0}".format(i), elapsed=0.1 * i)
+            for i in range(1, 11)]
+        flask_profiler.collection.insert_many(measurements)
+
+        stored = list(flask_profiler.collection.filter())
+        self.assertEqual(len(stored), 10)
+        self.assertEqual(
+            set(m["name"] for m in stored),
+            set("n{0}".format(i) for i in range(1, 11)))
+        m = stored[0]
+        self.assertEqual(m["args"], (1, ))
+        self.assertEqual(m["kwargs"], {"k": "v"})
+        self.assertEqual(m["context"], {"token": "x"})
+
+    def test_02_insert_many_empty(self):
+        flask_profiler.collection.insert_many([])
+        self.assertEqual(len(list(flask_profiler.collection.filter())), 0)
+
+    def test_03_insert_many_fallback(self):
+        collection = ListStorage()
+        collection.insert_many([createMeasurement(), createMeasurement()])
+        self.assertEqual(len(collection.measurements), 2)
+
+    def test_04_percentiles(self):
+        collection = flask_profiler.collection
+        collection.insert_many([
+            createMeasurement(name="a", elapsed=i / 100.0)
+            for i in range(1, 101)])
+        collection.insert(createMeasurement(name="b", elapsed=1))
+
+        summary = dict((s["name"], s) for s in collection.getSummary())
+        self.assertAlmostEqual(summary["a"]["p50"], 0.5, delta=0.01)
+        self.assertAlmostEqual(summary["a"]["p99"], 0.99, delta=0.02)
+        self.assertAlmostEqual(summary["b"]["p999"], 1, delta=0.02)
+
+        summary = dict(
+            (s["name"], s) for s in collection.getSummary(
+                {"percentiles": "10", "elapsed": 0.5}))
+        self.assertAlmostEqual(summary["a"]["p10"], 0.55, delta=0.02)
+        self.assertNotIn("p50", summary["a"])
+
+        series = collection.getTimeseries({"percentiles": "50"})
+        bucket = [v for v in series.values() if v["count"]][-1]
+        self.assertEqual(bucket["count"], 101)
+        self.assertAlmostEqual(bucket["p50"], 0.51, delta=0.02)
+
+    def test_05_rollups(self):
+        collection = flask_profiler.collection
+        now = time.time()
+        start = bucketOf(now, HOUR) - 3 * HOUR
+        # every 10 minutes for two hours
+        measurements = [
+            createMeasurement(name="a", elapsed=0.5, startedAt=start + i * 600 + 7)
+            for i in range(12)]
+        measurements.append(createMeasurement(
+            name="b", method="POST", elapsed=2, startedAt=start + 1800))
+        collection.insert_many(measurements)
+
+        # neither aligned to minutes nor to hours
+        kwds = {"startedAt": start + 610.5, "endedAt": now}
+        summary = dict((s["name"], s) for s in collection.getSummary(kwds))
+        self.assertEqual(summary["a"]["count"], 10)
+        self.assertAlmostEqual(float(summary["a"]["avgElapsed"]), 0.5)
+        self.assertAlmostEqual(float(summary["a"]["maxElapsed"]), 0.5)
+        self.assertEqual(summary["b"]["count"], 1)
+        self.assertEqual(
+            collection.getMethodDistribution(kwds), {"call": 10, "POST": 1})
+        series = collection.getTimeseries({"startedAt": start, "endedAt": now})
+        self.assertEqual(sum(series.values()), 13)
+
+        measurement = list(collection.filter({"name": "b", "startedAt": start}))[0]
+        collection.delete(measurement["id"])
+        summary = dict((s["name"], s) for s in collection.getSummary(kwds))
+        self.assertNotIn("b", summary)
+
+    def test_06_timeseries_intervals(self):
+        collection = flask_profiler.collection
+        now = time.time()
+        start = bucketOf(now, HOUR) - 2 * HOUR
+        collection.insert_many([
+            createMeasurement(startedAt=start + offset)
+            for offset in (10, 70, 400, 3700)])
+
+        def label(timestamp, dateFormat):
+            return (datetime(1970, 1, 1) + timedelta(
+                seconds=timestamp)).strftime(dateFormat)
+
+        kwds = {"startedAt": start, "endedAt": now, "tzOffset": 0}
+        series = collection.getTimeseries(dict(kwds, interval="5m"))
+        dateFormat = '%Y-%m-%d %H:%M'
+        self.assertEqual(series[label(start, dateFormat)], 2)
+        self.assertEqual(series[label(start + 300, dateFormat)], 1)
+        self.assertEqual(series[label(start + 600, dateFormat)], 0)
+        self.assertEqual(series[label(start + 3600, dateFormat)], 1)
+        self.assertEqual(sum(series.values()), 4)
+
+        series = collection.getTimeseries(
+            dict(kwds, interval="1h", percentiles="50"))
+        dateFormat = '%Y-%m-%d %H'
+        self.assertEqual(series[label(start, dateFormat)]["count"], 3)
+        self.assertAlmostEqual(
+            series[label(start, dateFormat)]["p50"], 0.1, delta=0.01)
+        self.assertEqual(series[label(start + 3600, dateFormat)]["count"], 1)
+
+    def test_07_keyset_pagination(self):
+        collection = flask_profiler.collection
+        now = time.time() - 60
+        # groups of five share their endedAt, the id breaks the ties
+        collection.insert_many([
+            createMeasurement(startedAt=now + i // 5, elapsed=0.5)
+            for i in range(23)])
+
+        for sort in ("endedAt,desc", "elapsed,asc", "id,desc"):
+            ids, cursor, pages = [], None, 0
+            while True:
+                kwds = {"limit": 10, "sort": sort}
+                if cursor:
+                    kwds["cursor"] = cursor
+                page, cursor = collection.paginate(kwds)
+                ids.extend(m["id"] for m in page)
+                pages += 1
+                if cursor is None:
+                    break
+                # a new request does not shift the following pages
+                if pages == 1:
+                    collection.insert(createMeasurement(elapsed=0.5))
+            self.assertEqual(pages, 3)
+            self.assertEqual(len(ids), len(set(ids)))
+            self.assertGreaterEqual(len(ids), 23)
+
+        self.assertRaises(
+            ValueError, collection.paginate, {"cursor": "not-a-cursor"})
+
+    def test_08_summary_default_sort(self):
+        collection = flask_profiler.collection
+        collection.insert_many([
+            createMeasurement(name=name) for name in ("a", "b", "b", "c")])
+        for kwds in ({}, {"elapsed": 0.01}):
+            summary = collection.getSummary(kwds)
+            self.assertEqual([s["name"] for s in summary][0], "b")
+
+
+class RollupTest(unittest.TestCase):
+
+    def test_01_plan(self):
+        start = 10 * HOUR
+        plan = planRanges(start - 90.5, start + 2 * HOUR + 150)
+        self.assertEqual(plan, [
+            (None, start - 90.5, start - 60),
+            (MINUTE, start - 60, start),
+            (HOUR, start, start + 2 * HOUR),
+            (MINUTE, start + 2 * HOUR, start + 2 * HOUR + 120),
+            (None, start + 2 * HOUR + 120, start + 2 * HOUR + 150)])
+        self.assertEqual(planRanges(start + 1, start + 30), [
+            (None, start + 1, start + 30)])
+
+    def test_02_merge(self):
+        a = Rollup().add({"elapsed": 1, "cpuTime": 0.5, "weight": 3})
+        b = Rollup().add({"elapsed": 3})
+        a.merge(Rollup.fromRow(*b.toRow()))
+        summary = a.summary([50])
+        self.assertEqual(summary["count"], 4)
+        self.assertEqual(summary["minElapsed"], 1)
+        self.assertEqual(summary["maxElapsed"], 3)
+        self.assertAlmostEqual(summary["avgElapsed"], 1.5)
+        self.assertAlmostEqual(summary["avgCpuTime"], 0.5)
+
+        a.add({"elapsed": 3}, sign=-1)
+        self.assertEqual(a.summary([50])["count"], 3)
+        self.assertAlmostEqual(a.summary([50])["avgElapsed"], 1)
+
+    def test_03_series_query(self):
+        self.assertEqual(parseInterval("15m"), 900)
+        self.assertEqual(parseInterval("daily"), 86400)
+        with self.assertRaises(ValueError):
+            parseInterval("7x")
+
+        query = SeriesQuery(
+            {"interval": "1d", "tzOffset": "90"}, 10 * HOUR, 20 * HOUR)
+        # days start at 22:30 UTC
+        self.assertEqual(query.bucketOf(23 * HOUR), 22.5 * HOUR)
+        self.assertEqual(query.label(22.5 * HOUR), "1970-01-02")
+        # the hourly rollups do not fit days which start at half past
+        self.assertEqual(
+            [g for g, start, end in query.plan()], [MINUTE])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+# -*- coding: utf8 -*-
+import os
+import time
+import unittest
+
+from flask_profiler.writer import WriteBehindQueue
+from .basetest import BasetTest, measure, flask_profiler
+from .test_storage import createMeasurement
+
+
+def doNothing(**kwargs):
+    return True
+
+
+class WriteBehindQueueTest(BasetTest):
+
+    def tearDown(self):
+        if flask_profiler.writer is not None:
+            flask_profiler.writer.close()
+            flask_profiler.writer = None
+
+    def test_01_flush(self):
+        writer = WriteBehindQueue(
+            flask_profiler.collection, flushInterval=60, maxBatch=2)
+        for i in range(5):
+            self.assertTrue(writer.put(createMeasurement()))
+        writer.flush()
+
+        measurements = list(flask_profiler.collection.filter())
+        self.assertEqual(len(measurements), 5)
+        self.assertEqual(writer.stats()["written"], 5)
+        self.assertEqual(writer.stats()["queueDepth"], 0)
+        writer.close()
+
+    def test_02_drop_when_full(self):
+        writer = WriteBehindQueue(
+            flask_profiler.collection, queueSize=2, flushInterval=60,
+            maxBatch=10)
+        results = [writer.put(createMeasurement()) for i in range(3)]
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(writer.stats()["dropped"], 1)
+        self.assertEqual(writer.stats()["queueDepth"], 2)
+
+        writer.close()
+        self.assertEqual(writer.stats()["queueDepth"], 0)
+        self.assertEqual(len(list(flask_profiler.collection.filter())), 2)
+
+    def test_03_background_flush(self):
+        writer = WriteBehindQueue(
+            flask_profiler.collection, flushInterval=0.05)
+        writer.put(createMeasurement())
+        deadline = time.time() + 5
+        while writer.stats()["written"] < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(list(flask_profiler.collection.filter())), 1)
+        writer.close()
+
+    def test_04_measure_does_not_write_synchronously(self):
+        flask_profiler.writer = WriteBehindQueue(
+            flask_profiler.collection, flushInterval=60)
+        wrapped = measure(doNothing, "doNothing", "call")
+        self.assertTrue(wrapped())
+        self.assertEqual(len(list(flask_profiler.collection.filter())), 0)
+
+        flask_profiler.writer.flush()
+        self.assertEqual(len(list(flask_profiler.collection.filter())), 1)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_05_after_fork(self):
+        writer = WriteBehindQueue(
+            flask_profiler.collection, flushInterval=0.05)
+        writer.put(createMeasurement())
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                # the background thread of the parent is not forked
+                writer.put(createMeasurement())
+                deadline = time.time() + 5
+                while writer.stats()["written"] < 1 and \
+                        time.time() < deadline:
+                    time.sleep(0.01)
+                code = 0 if writer.stats()["written"] == 1 else 1
+            finally:
+                os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()